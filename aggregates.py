@@ -0,0 +1,224 @@
+"""Agregados financeiros materializados do MC PARK MANAGER.
+
+A tabela financial_aggregates.csv guarda, por dia, a soma (em centavos, como
+toda coluna 'money' lida pelo repository) e a quantidade de lançamentos de cada origem (transações, contas a receber e contas a pagar)
+agrupados por tipo, status e categoria. Ela é atualizada por delta a cada
+escrita nessas tabelas (via repository.register_write_hook) e pode ser
+reconstruída do zero com rebuild(). Dashboard, DRE e fluxo de caixa leem
+daqui em vez de percorrer todos os lançamentos.
+
+Os deltas são anexados ao fim da tabela (e ao DataFrame em cache) em vez de
+regravá-la: um bucket pode ocupar várias linhas até a próxima compactação,
+e as consultas sempre somam os buckets que selecionam.
+
+aggregate_sources.csv guarda a versão de cada tabela de origem que o agregado
+reflete. Uma origem alterada sem passar pelos hooks (edição externa do CSV,
+arquivo restaurado) fica com outra versão, e o agregado é reconstruído na
+próxima leitura ou escrita.
+"""
+import json
+
+import pandas as pd
+
+import repository
+
+AGGREGATE_TABLE = 'financial_aggregates.csv'
+VERSIONS_TABLE = 'aggregate_sources.csv'  # Versão de cada origem refletida no agregado
+KEY_COLUMNS = ['year', 'month', 'day', 'source', 'type', 'status', 'category']
+COMPACT_ROWS = 5000  # Linhas além de uma por bucket antes de compactar a tabela
+
+# Linhas da tabela na última compactação (uma por bucket; None = ainda não
+# medido neste processo, ver _should_compact)
+_compacted_rows = None
+
+# Origem de cada tabela: (nome da origem, coluna de data)
+SOURCES = {
+    'financial_transactions.csv': ('transacao', 'date'),
+    'accounts_receivable.csv': ('receber', 'due_date'),
+    'accounts_payable.csv': ('pagar', 'due_date'),
+}
+
+
+def _contributions(table, rows):
+    """Buckets (chave -> soma, quantidade) com que as linhas contribuem"""
+    source, date_column = SOURCES[table]
+    if rows is None or rows.empty:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['total', 'count'])
+
+    dates = pd.to_datetime(rows[date_column], errors='coerce')
+    amounts = pd.to_numeric(rows['amount'], errors='coerce')
+    if source == 'transacao':
+        types = rows['type']
+        statuses = 'realizado'
+        categories = rows['category']
+    elif source == 'receber':
+        types = 'entrada'
+        statuses = rows['status']
+        categories = 'assinatura'
+    else:
+        types = 'saida'
+        statuses = rows['status']
+        categories = rows['category']
+
+    buckets = pd.DataFrame({
+        'year': dates.dt.year.astype('Int64'),
+        'month': dates.dt.month.astype('Int64'),
+        'day': dates.dt.day.astype('Int64'),
+        'source': source,
+        'type': types,
+        'status': statuses,
+        'category': categories,
+        'total': amounts,
+        'count': 1,
+    }, index=rows.index)
+    # Lançamentos sem valor não entram em nenhum total; tipo, status e
+    # categoria podem ser categóricos: só as combinações que existem
+    buckets = buckets[amounts.notna()]
+    return (buckets.groupby(KEY_COLUMNS, dropna=False, sort=False, observed=True)[['total', 'count']]
+            .sum().reset_index())
+
+
+def _combine(frames):
+    """Soma buckets com a mesma chave e descarta os que zeraram (sem
+    lançamentos nem valor: um delta pode mudar só o valor)"""
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return repository.empty_table(AGGREGATE_TABLE)
+    combined = pd.concat(frames, ignore_index=True)
+    combined[['year', 'month', 'day']] = combined[['year', 'month', 'day']].astype('Int64')
+    combined[['type', 'status', 'category']] = combined[['type', 'status', 'category']].astype(object)
+    combined = (combined.groupby(KEY_COLUMNS, dropna=False, sort=True)[['total', 'count']]
+                .sum().reset_index())
+    # Centavos: somas exatas, sem arredondamento
+    combined['total'] = combined['total'].astype('int64')
+    combined['count'] = combined['count'].astype(int)
+    return combined[(combined['count'] != 0) | (combined['total'] != 0)]
+
+
+def _stored():
+    df = repository.read_csv_cached(AGGREGATE_TABLE)
+    return df[KEY_COLUMNS + ['total', 'count']] if not df.empty else df
+
+
+def _version_text(version):
+    # Em lista: 'null' (tabela inexistente) seria lido do CSV como vazio
+    return json.dumps([version])
+
+
+def _stored_versions():
+    """Versões das origens refletidas no agregado (texto, ver _version_text)"""
+    df = repository.read_csv_cached(VERSIONS_TABLE)
+    if df.empty:
+        return {}
+    return dict(zip(df['table'], df['version']))
+
+
+def _record_versions(tables):
+    """Grava a versão atual das tabelas informadas como refletida no agregado"""
+    versions = _stored_versions()
+    versions.update({table: _version_text(repository.table_version(table)) for table in tables})
+    repository.save_csv_and_invalidate(
+        pd.DataFrame({'table': list(versions), 'version': list(versions.values())}), VERSIONS_TABLE)
+
+
+def _is_current(expected=None):
+    """True se o agregado existe e reflete as origens: a versão atual de
+    cada uma, ou a informada em expected (tabela -> versão)"""
+    if not repository.table_exists(AGGREGATE_TABLE):
+        return False
+    expected = expected or {}
+    stored = _stored_versions()
+    return all(stored.get(table) == _version_text(expected[table] if table in expected
+                                                  else repository.table_version(table))
+               for table in SOURCES)
+
+
+def apply_changes(table, old_rows, new_rows, old_version):
+    """Hook de escrita: anexa ao agregado o delta dos buckets que mudaram
+    entre as linhas antigas e novas"""
+    if not _is_current({table: old_version}):
+        # Sem agregado salvo, ou com alguma origem alterada por fora, o delta
+        # não tem base: calcula tudo (já com esta escrita)
+        rebuild()
+        return
+    removed = _contributions(table, old_rows)
+    removed[['total', 'count']] = -removed[['total', 'count']]
+    delta = _combine([removed, _contributions(table, new_rows)])
+    if not delta.empty:
+        # Anexado ao arquivo e ao DataFrame em cache, sem reler nem regravar a tabela
+        repository.insert_records(AGGREGATE_TABLE, delta.astype(object).where(delta.notna(), None)
+                                  .to_dict('records'))
+    _record_versions([table])
+    if not delta.empty and _should_compact():
+        compact()
+
+
+def _should_compact():
+    """True se a tabela tem COMPACT_ROWS linhas a mais que na última compactação.
+
+    A conta usa as linhas da tabela, não as anexadas por este processo: vale
+    com vários workers e depois de reiniciar. Sem medida anterior neste
+    processo, a base é o número de buckets distintos.
+    """
+    global _compacted_rows
+    stored = _stored()
+    if _compacted_rows is None:
+        _compacted_rows = len(stored.drop_duplicates(KEY_COLUMNS)) if not stored.empty else 0
+    # Outro processo compactou: a tabela já tem uma linha por bucket
+    _compacted_rows = min(_compacted_rows, len(stored))
+    return len(stored) - _compacted_rows >= COMPACT_ROWS
+
+
+def compact():
+    """Regrava o agregado com uma linha por bucket, somando os deltas anexados"""
+    global _compacted_rows
+    with repository.transaction():
+        aggregate = _combine([_stored()])
+        repository.save_csv_and_invalidate(aggregate, AGGREGATE_TABLE)
+    _compacted_rows = len(aggregate)
+    return len(aggregate)
+
+
+def rebuild():
+    """Recalcula o agregado inteiro a partir das tabelas de origem"""
+    global _compacted_rows
+    with repository.transaction():
+        frames = [_contributions(table, repository.read_csv_cached(table)) for table in SOURCES]
+        aggregate = _combine(frames)
+        repository.save_csv_and_invalidate(aggregate, AGGREGATE_TABLE)
+        _record_versions(SOURCES)
+    _compacted_rows = len(aggregate)
+    return len(aggregate)
+
+
+def _prepare(df):
+    """Agregado com coluna de data (NaT para lançamentos sem data válida)"""
+    df = df.copy(deep=False)
+    df[['year', 'month', 'day']] = df[['year', 'month', 'day']].apply(pd.to_numeric, errors='coerce')
+    df['date'] = pd.to_datetime(df[['year', 'month', 'day']], errors='coerce') if not df.empty else pd.NaT
+    df['total'] = pd.to_numeric(df['total'], errors='coerce').fillna(0)
+    return df
+
+
+def load():
+    """Agregado pronto para consulta (compartilhado: filtre antes de alterar).
+
+    Reconstruído antes se ele não existe ou se alguma origem mudou por fora
+    dos hooks (ver aggregate_sources.csv).
+    """
+    if not _is_current():
+        with repository.transaction():
+            # Conferido de novo com as escritas travadas: a diferença pode ser
+            # só a transação de outro worker, que já atualizou o agregado
+            if not _is_current():
+                rebuild()
+    return repository.get_derived('financial_aggregates', (AGGREGATE_TABLE,), _prepare)
+
+
+def transactions(df=None):
+    """Buckets das transações realizadas (receitas e despesas)"""
+    df = load() if df is None else df
+    return df[df['source'] == 'transacao']
+
+
+repository.register_write_hook(SOURCES, apply_changes)
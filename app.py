@@ -12,13 +12,36 @@ from wtforms import (StringField, PasswordField, SubmitField, TextAreaField,
                     SelectField, DateField, DecimalField, IntegerField, HiddenField)
 from wtforms.validators import DataRequired, Email, Optional, NumberRange, Length
 from dateutil.relativedelta import relativedelta
-import time
 from threading import Lock
+from storage import create_storage, manifest_file, write_csv_atomic
+import repository
+import aggregates
+import search_index
+import pagination
+import filters
+from repository import (read_csv_cached, read_versioned, read_period, read_latest, get_record_by_id,
+                        insert_records, insert_new_record, update_record, delete_record, allocate_ids,
+                        to_cents, from_cents)
 
 # --- Configuração do Aplicativo ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'sua-chave-secreta-aqui'
-app.config['DATA_DIR'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Diretório das tabelas (padrão: data/ ao lado deste arquivo)
+app.config['DATA_DIR'] = os.environ.get('MCPARK_DATA_DIR',
+                                        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# Backend de armazenamento: 'csv' (padrão) ou 'sqlite'
+app.config['STORAGE_BACKEND'] = os.environ.get('MCPARK_STORAGE', 'csv')
+app.config['SQLITE_PATH'] = os.environ.get('MCPARK_SQLITE_PATH', os.path.join(app.config['DATA_DIR'], 'mcpark.db'))
+# Detecção de mudanças nos dados: 'stat' (padrão) ou 'inotify' (Linux)
+app.config['CACHE_WATCHER'] = os.environ.get('MCPARK_CACHE_WATCHER', 'stat')
+# Snapshots binários das tabelas CSV para cargas a frio rápidas ('1' ou '0')
+app.config['SNAPSHOTS'] = os.environ.get('MCPARK_SNAPSHOTS', '1') == '1'
+# Espera o fsync (em grupo) antes de concluir cada escrita nos CSVs ('1' ou '0')
+app.config['FSYNC'] = os.environ.get('MCPARK_FSYNC', '1') == '1'
+# Memória máxima do cache de tabelas em MB; as menos usadas saem (vazio = sem limite)
+app.config['CACHE_MAX_MB'] = os.environ.get('MCPARK_CACHE_MB')
+# Serve a versão em cache de uma tabela alterada enquanto ela é recarregada ('1' ou '0')
+app.config['CACHE_SWR'] = os.environ.get('MCPARK_CACHE_SWR', '0') == '1'
 
 # Configuração do Flask-Login
 login_manager = LoginManager()
@@ -27,12 +50,13 @@ login_manager.login_view = 'login'
 
 # Constantes
 DATA_DIR = app.config['DATA_DIR']
-
-# Sistema de cache global
-CSV_CACHE = {}
-CACHE_LOCK = Lock()
-CACHE_TIMEOUT = 30  # Cache expira em 30 segundos
-CACHE_TIMESTAMPS = {}
+storage = create_storage(app.config['STORAGE_BACKEND'], DATA_DIR, app.config['SQLITE_PATH'],
+                         durable=app.config['FSYNC'])
+repository.configure(storage, DATA_DIR, watch=app.config['CACHE_WATCHER'] == 'inotify',
+                     use_snapshots=app.config['SNAPSHOTS'] and storage.name == 'csv',
+                     max_cache_bytes=(int(float(app.config['CACHE_MAX_MB']) * 1024 * 1024)
+                                      if app.config['CACHE_MAX_MB'] else None),
+                     serve_stale=app.config['CACHE_SWR'])
 
 # --- Filtros Jinja2 ---
 @app.template_filter('format_cpf')
@@ -69,18 +93,25 @@ def format_cep_filter(cep):
 
 @app.template_filter('format_currency')
 def format_currency_filter(value):
-    """Formata valor monetário: R$ 1.234,56"""
+    """Formata valor monetário em centavos: 123456 -> R$ 1.234,56"""
     if value is None:
         return 'R$ 0,00'
     try:
-        return f'R$ {float(value):,.2f}'.replace(',', 'X').replace('.', ',').replace('X', '.')
+        return f'R$ {from_cents(value):,.2f}'.replace(',', 'X').replace('.', ',').replace('X', '.')
     except:
         return 'R$ 0,00'
 
+@app.template_filter('reais')
+def reais_filter(value):
+    """Centavos em reais (float), para formatos próprios e campos de formulário"""
+    if value is None or pd.isna(value):
+        return value
+    return float(from_cents(value))
+
 @app.template_filter('format_date')
 def format_date_filter(date):
     """Formata data: 20/11/2025"""
-    if not date:
+    if not date or (not isinstance(date, str) and pd.isna(date)):
         return '-'
     if isinstance(date, str):
         try:
@@ -92,7 +123,7 @@ def format_date_filter(date):
 @app.template_filter('format_datetime')
 def format_datetime_filter(datetime_obj):
     """Formata data e hora: 20/11/2025 14:30"""
-    if not datetime_obj:
+    if not datetime_obj or (not isinstance(datetime_obj, str) and pd.isna(datetime_obj)):
         return '-'
     if isinstance(datetime_obj, str):
         try:
@@ -101,63 +132,19 @@ def format_datetime_filter(datetime_obj):
             return datetime_obj
     return datetime_obj.strftime('%d/%m/%Y %H:%M') if hasattr(datetime_obj, 'strftime') else str(datetime_obj)
 
+@app.template_filter('format_iso_date')
+def format_iso_date_filter(date):
+    """Data como nos campos type="date": 2025-11-20 (vazio se não houver)"""
+    if date is None or (not isinstance(date, str) and pd.isna(date)):
+        return ''
+    return date.strftime('%Y-%m-%d') if hasattr(date, 'strftime') else str(date)
+
 # --- Funções de Apoio ---
 def format_currency(value):
-    return f'R$ {value:,.2f}'.replace('.', '|').replace(',', '.').replace('|', ',')
-
-def read_csv_cached(filename, force_reload=False):
-    """Lê arquivo CSV com cache para melhorar performance"""
-    global CSV_CACHE, CACHE_TIMESTAMPS
-    
-    filepath = os.path.join(DATA_DIR, filename)
-    current_time = time.time()
-    
-    with CACHE_LOCK:
-        # Verifica se o cache existe e não expirou
-        if not force_reload and filename in CSV_CACHE:
-            cache_age = current_time - CACHE_TIMESTAMPS.get(filename, 0)
-            if cache_age < CACHE_TIMEOUT:
-                return CSV_CACHE[filename].copy()
-        
-        # Lê o arquivo e armazena no cache
-        try:
-            df = pd.read_csv(filepath)
-            # Otimiza tipos de dados para reduzir memória
-            for col in df.columns:
-                if df[col].dtype == 'float64':
-                    df[col] = pd.to_numeric(df[col], downcast='float', errors='ignore')
-                elif df[col].dtype == 'int64':
-                    df[col] = pd.to_numeric(df[col], downcast='integer', errors='ignore')
-            
-            CSV_CACHE[filename] = df
-            CACHE_TIMESTAMPS[filename] = current_time
-            return df.copy()
-        except FileNotFoundError:
-            return pd.DataFrame()
-
-def invalidate_cache(filename=None):
-    """Invalida o cache de um arquivo específico ou de todos"""
-    global CSV_CACHE, CACHE_TIMESTAMPS
-    with CACHE_LOCK:
-        if filename:
-            CSV_CACHE.pop(filename, None)
-            CACHE_TIMESTAMPS.pop(filename, None)
-        else:
-            CSV_CACHE.clear()
-            CACHE_TIMESTAMPS.clear()
+    """Centavos formatados: R$ 1.234,56"""
+    return f'R$ {from_cents(value):,.2f}'.replace('.', '|').replace(',', '.').replace('|', ',')
 
-def save_csv_and_invalidate(df, filename):
-    """Salva CSV e invalida o cache"""
-    filepath = os.path.join(DATA_DIR, filename)
-    df.to_csv(filepath, index=False)
-    invalidate_cache(filename)
-
-def get_next_id(filename):
-    try:
-        df = read_csv_cached(filename)
-        return int(df['id'].max() + 1) if not df.empty else 1
-    except (KeyError, ValueError):
-        return 1
+RECEIVABLES_LOCK = Lock()  # Evita gerar a mesma conta a receber em paralelo
 
 # --- Funções de Decorador ---
 def admin_required(f):
@@ -279,22 +266,17 @@ class User(UserMixin):
         return str(self.id)
 
 def get_user_by_id(user_id):
+    user_data = get_record_by_id('users.csv', user_id)
+    if user_data is None:
+        return None
     try:
-        users_df = read_csv_cached('users.csv')
-        if users_df.empty:
-            return None
-        # Usar loc é mais rápido que filtragem booleana para um único resultado
-        user_data = users_df.loc[users_df['id'] == int(user_id)]
-        if user_data.empty:
-            return None
-        user_data = user_data.iloc[0]
         return User(
             id=int(user_data['id']), 
             username=user_data['username'], 
             role=user_data['role'],
             name=user_data.get('name', '')
         )
-    except (IndexError, KeyError, ValueError):
+    except KeyError:
         return None
 
 @login_manager.user_loader
@@ -302,44 +284,28 @@ def load_user(user_id):
     return get_user_by_id(user_id)
 
 def get_customer_by_id(customer_id):
-    try:
-        customers_df = read_csv_cached('customers.csv')
-        if customers_df.empty:
-            return None
-        result = customers_df.loc[customers_df['id'] == int(customer_id)]
-        return result.iloc[0].to_dict() if not result.empty else None
-    except (IndexError, KeyError, ValueError):
-        return None
+    return get_record_by_id('customers.csv', customer_id)
 
 def get_vehicle_by_id(vehicle_id):
-    try:
-        vehicles_df = read_csv_cached('vehicles.csv')
-        if vehicles_df.empty:
-            return None
-        result = vehicles_df.loc[vehicles_df['id'] == int(vehicle_id)]
-        return result.iloc[0].to_dict() if not result.empty else None
-    except (IndexError, KeyError, ValueError):
-        return None
+    return get_record_by_id('vehicles.csv', vehicle_id)
 
 def get_plan_by_id(plan_id):
-    try:
-        plans_df = read_csv_cached('plans.csv')
-        if plans_df.empty:
-            return None
-        result = plans_df.loc[plans_df['id'] == int(plan_id)]
-        return result.iloc[0].to_dict() if not result.empty else None
-    except (IndexError, KeyError, ValueError):
-        return None
+    return get_record_by_id('plans.csv', plan_id)
 
 def get_subscription_by_id(subscription_id):
-    try:
-        subs_df = read_csv_cached('subscriptions.csv')
-        if subs_df.empty:
-            return None
-        result = subs_df.loc[subs_df['id'] == int(subscription_id)]
-        return result.iloc[0].to_dict() if not result.empty else None
-    except (IndexError, KeyError, ValueError):
-        return None
+    return get_record_by_id('subscriptions.csv', subscription_id)
+
+def vehicle_label(vehicle):
+    return f"{vehicle['plate']} - {vehicle['model']}"
+
+def plan_label(plan):
+    return f"{plan['name']} (R$ {from_cents(plan['price']):.2f} - {plan['duration_days']} dias)"
+
+def selected_choices(get_record, ids, label):
+    """Choices de um select com busca no servidor (/api/<tabela>/search): só
+    as linhas já escolhidas, para o formulário exibir e validar"""
+    records = [get_record(record_id) for record_id in ids if record_id not in (None, '')]
+    return [(int(record['id']), label(record)) for record in records if record is not None]
 
 def get_financial_summary():
     """Retorna um resumo financeiro para o dashboard"""
@@ -352,20 +318,16 @@ def get_financial_summary():
     }
     
     try:
-        # Cálculo de receitas e despesas do mês atual
-        transactions_df = read_csv_cached('financial_transactions.csv')
-        if not transactions_df.empty:
-            transactions_df['date'] = pd.to_datetime(transactions_df['date'], errors='coerce')
-            
+        # Cálculo de receitas e despesas do mês atual (a partir dos agregados diários)
+        transactions_agg = aggregates.transactions()
+        if not transactions_agg.empty:
             current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            # Filtragem eficiente
-            monthly_transactions = transactions_df[transactions_df['date'] >= current_month]
+            monthly_transactions = transactions_agg[transactions_agg['date'] >= current_month]
             
             if not monthly_transactions.empty:
-                # Usar groupby é mais eficiente que filtros múltiplos
-                grouped = monthly_transactions.groupby('type')['amount'].sum()
-                summary['receita_mensal'] = float(grouped.get('receita', 0))
-                summary['despesa_mensal'] = float(grouped.get('despesa', 0))
+                grouped = monthly_transactions.groupby('type')['total'].sum()
+                summary['receita_mensal'] = int(grouped.get('receita', 0))
+                summary['despesa_mensal'] = int(grouped.get('despesa', 0))
         
         # Cálculo do saldo atual
         summary['saldo_atual'] = summary['receita_mensal'] - summary['despesa_mensal']
@@ -387,6 +349,77 @@ def get_financial_summary():
         
     return summary
 
+def build_receivable(sub, receivable_id, today=None):
+    """Monta a conta a receber gerada automaticamente para uma assinatura"""
+    today = today or pd.Timestamp.now()
+    customer = get_customer_by_id(sub['customer_id'])
+    plan = get_plan_by_id(sub['plan_id'])
+    customer_name = customer['name'] if customer is not None else 'Cliente não encontrado'
+    plan_name = plan['name'] if plan is not None else 'Plano não encontrado'
+    
+    # Processa múltiplos veículos
+    vehicle_ids_str = str(sub.get('vehicle_ids', sub.get('vehicle_id', '')))
+    vehicle_ids = [int(vid.strip()) for vid in vehicle_ids_str.split(',') if vid.strip()]
+    
+    # Obtém modelos dos veículos
+    vehicle_models = []
+    for vid in vehicle_ids:
+        v = get_vehicle_by_id(vid)
+        if v is not None:
+            vehicle_models.append(f"{v['model']}")
+    
+    vehicles_text = ', '.join(vehicle_models) if vehicle_models else 'Veículo não encontrado'
+    
+    status = 'pendente'
+    due_date = sub['end_date']
+    if pd.to_datetime(due_date) < today:
+        status = 'vencido'
+    if isinstance(due_date, pd.Timestamp):
+        due_date = due_date.strftime('%Y-%m-%d')
+    
+    return {
+        'id': receivable_id,
+        'subscription_id': sub['id'],
+        'customer_id': sub['customer_id'],
+        'description': f'Assinatura {plan_name} - {customer_name} - {vehicles_text}',
+        'amount': int(sub['amount']),
+        'due_date': due_date,
+        'payment_date': '',
+        'status': status,
+        'payment_method': '',
+        'notes': f'Gerado automaticamente da assinatura #{sub["id"]}',
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'updated_at': ''
+    }
+
+def generate_receivables(subscription_ids=None):
+    """Gera contas a receber para as assinaturas que ainda não têm nenhuma.
+
+    Com subscription_ids processa apenas essas assinaturas. Retorna quantas
+    contas foram criadas.
+    """
+    # A transação vem antes do lock: rotas chamam esta função já dentro de uma
+    with repository.transaction(), RECEIVABLES_LOCK:
+        subs_df = read_csv_cached('subscriptions.csv')
+        receivables_df = read_csv_cached('accounts_receivable.csv')
+        if subs_df.empty:
+            return 0
+        
+        if subscription_ids is not None:
+            subs_df = subs_df[subs_df['id'].isin([int(sid) for sid in subscription_ids])]
+        if 'subscription_id' in receivables_df.columns:
+            subs_df = subs_df[~subs_df['id'].isin(receivables_df['subscription_id'].dropna())]
+        if subs_df.empty:
+            return 0
+        
+        # Um bloco de ids para o lote inteiro
+        first_id = allocate_ids('accounts_receivable.csv', len(subs_df))
+        today = pd.Timestamp.now()
+        new_receivables = [build_receivable(sub, first_id + offset, today)
+                           for offset, sub in enumerate(subs_df.to_dict('records'))]
+        insert_records('accounts_receivable.csv', new_receivables)
+        return len(new_receivables)
+
 # --- Rotas Principais ---
 @app.route('/')
 @login_required
@@ -401,9 +434,11 @@ def index():
 def admin_dashboard():
     financial_summary = get_financial_summary()
     
-    # Carregar todos os DataFrames uma única vez
-    transactions_df = read_csv_cached('financial_transactions.csv')
-    customers_df = read_csv_cached('customers.csv')
+    # Carregar todos os DataFrames uma única vez (das transações, só os
+    # últimos meses: bastam para as 5 mais recentes)
+    transactions_df = read_latest('financial_transactions.csv', 5)
+    # Dos clientes só a contagem e o id/nome dos modais
+    customers_df = read_csv_cached('customers.csv', columns=['id', 'name'])
     subs_df = read_csv_cached('subscriptions.csv')
     vehicles_df = read_csv_cached('vehicles.csv')
     payments_df = read_csv_cached('payments.csv')
@@ -413,7 +448,8 @@ def admin_dashboard():
     transactions = []
     if not transactions_df.empty:
         transactions_df['date'] = pd.to_datetime(transactions_df['date'], errors='coerce')
-        transactions_df = transactions_df.sort_values('date', ascending=False).head(5)
+        # Empates na data: a lançada por último primeiro
+        transactions_df = transactions_df.sort_values(['date', 'id'], ascending=False).head(5)
         
         # Merge com clientes de uma vez (mais eficiente que loops)
         if not customers_df.empty and not subs_df.empty:
@@ -421,12 +457,11 @@ def admin_dashboard():
                 trans_dict = trans.to_dict()
                 if pd.notna(trans_dict.get('related_id')):
                     try:
-                        sub = subs_df.loc[subs_df['id'] == trans_dict['related_id']]
-                        if not sub.empty:
-                            customer_id = sub.iloc[0]['customer_id']
-                            customer = customers_df.loc[customers_df['id'] == customer_id]
-                            if not customer.empty:
-                                trans_dict['customer_name'] = customer.iloc[0]['name']
+                        sub = get_subscription_by_id(trans_dict['related_id'])
+                        if sub is not None:
+                            customer = get_customer_by_id(sub['customer_id'])
+                            if customer is not None:
+                                trans_dict['customer_name'] = customer['name']
                     except:
                         pass
                 transactions.append(trans_dict)
@@ -446,7 +481,7 @@ def admin_dashboard():
     total_vehicles = len(vehicles_df) if not vehicles_df.empty else 0
     
     # Receita mensal
-    monthly_revenue = float(financial_summary.get('receita_mensal', 0) or 0)
+    monthly_revenue = int(financial_summary.get('receita_mensal', 0) or 0)
     
     # Vencimentos hoje
     due_today = 0
@@ -462,32 +497,20 @@ def admin_dashboard():
         overdue_mask = (payments_df['status'] == 'pendente') & (payments_df['payment_date'].dt.date < datetime.now().date())
         overdue_count = int(overdue_mask.sum())
     
-    # Dados para o gráfico financeiro (últimos 6 meses) - otimizado
+    # Dados para o gráfico financeiro (últimos 6 meses) - a partir dos agregados diários
     financial_chart_data = {'labels': [], 'receitas': [], 'despesas': []}
-    if not transactions_df.empty:
+    transactions_agg = aggregates.transactions()
+    if not transactions_agg.empty:
         today = datetime.now()
+        monthly_totals = (transactions_agg[transactions_agg['date'] <= today]
+                          .groupby(['year', 'month', 'type'])['total'].sum())
         for i in range(5, -1, -1):
             month_date = today - relativedelta(months=i)
             month_start = month_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            if i == 0:
-                month_end = today
-            else:
-                month_end = (month_start + relativedelta(months=1)) - timedelta(days=1)
-            
-            # Filtra transações do mês
-            month_transactions = transactions_df[
-                (transactions_df['date'] >= month_start) & 
-                (transactions_df['date'] <= month_end)
-            ]
-            
-            # Usa groupby para cálculo eficiente
-            if not month_transactions.empty:
-                grouped = month_transactions.groupby('type')['amount'].sum()
-                receitas = float(grouped.get('receita', 0))
-                despesas = float(grouped.get('despesa', 0))
-            else:
-                receitas = 0
-                despesas = 0
+            
+            # Gráfico em reais
+            receitas = monthly_totals.get((month_start.year, month_start.month, 'receita'), 0) / 100
+            despesas = monthly_totals.get((month_start.year, month_start.month, 'despesa'), 0) / 100
             
             financial_chart_data['labels'].append(month_start.strftime('%b'))
             financial_chart_data['receitas'].append(receitas)
@@ -512,17 +535,16 @@ def admin_dashboard():
             
             # Merge com planos para obter nomes
             for plan_id, count in plan_counts.items():
-                plan = plans_df.loc[plans_df['id'] == plan_id]
-                if not plan.empty:
-                    plan_name = plan.iloc[0]['name']
+                plan = get_plan_by_id(plan_id)
+                if plan is not None:
+                    plan_name = plan['name']
                     plans_chart_data['labels'].append(plan_name)
                     plans_chart_data['values'].append(int(count))
     
     if not plans_chart_data['labels']:
         plans_chart_data = {'labels': ['Sem dados'], 'values': [1]}
     
-    # Listas para os modais
-    customers_list = customers_df.to_dict('records') if not customers_df.empty else []
+    # Planos para os modais (os clientes vêm de /api/customers/search)
     plans_list = plans_df[plans_df['is_active'] == True].to_dict('records') if not plans_df.empty else []
     
     return render_template('admin/dashboard.html', 
@@ -537,7 +559,6 @@ def admin_dashboard():
                          plans_chart_data=plans_chart_data,
                          total_vehicles=total_vehicles,
                          overdue_count=overdue_count,
-                         customers=customers_list,
                          plans=plans_list)
 
 @app.route('/dashboard')
@@ -551,14 +572,14 @@ def customer_dashboard():
     
     # Carrega os veículos do cliente
     try:
-        vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
+        vehicles_df = read_csv_cached('vehicles.csv')
         vehicles = vehicles_df[vehicles_df['customer_id'] == current_user.id].to_dict('records')
-    except FileNotFoundError:
+    except KeyError:
         vehicles = []
     
     # Carrega as assinaturas ativas do cliente
     try:
-        subs_df = pd.read_csv(os.path.join(DATA_DIR, 'subscriptions.csv'))
+        subs_df = read_csv_cached('subscriptions.csv')
         subs_df = subs_df[subs_df['customer_id'] == current_user.id]
         
         # Adiciona informações adicionais às assinaturas
@@ -572,7 +593,7 @@ def customer_dashboard():
             sub_dict['plan_name'] = plan['name'] if plan else 'N/A'
             subscriptions.append(sub_dict)
             
-    except FileNotFoundError:
+    except KeyError:
         subscriptions = []
     
     return render_template('customer/dashboard.html',
@@ -635,6 +656,13 @@ def logout():
 # --- Rotas de Gerenciamento (Admin) ---
 
 # --- Clientes ---
+# Filtros das listagens (ver filters.py)
+CUSTOMER_FILTERS = {
+    # Nome, CPF e placa pelo índice de trigramas (sem acentos)
+    'search': ('ids', 'id', search_index.search_customers),
+    'status': ('equals', 'status'),
+}
+
 @app.route('/admin/customers')
 @admin_required
 def list_customers():
@@ -648,43 +676,13 @@ def list_customers():
         vehicles_df = read_csv_cached('vehicles.csv')
         
         # Aplicar filtros de busca
-        search = request.args.get('search', '').strip()
-        status = request.args.get('status', '')
-        
-        if search:
-            search_normalized = ''.join(filter(str.isalnum, search.lower()))
-            
-            # Usar operações vetorizadas (muito mais rápidas)
-            name_mask = customers_df['name'].str.lower().str.contains(search.lower(), na=False, regex=False)
-            cpf_mask = customers_df['cpf'].fillna('').astype(str).str.replace(r'\D', '', regex=True).str.lower().str.contains(search_normalized, na=False, regex=False)
-            
-            # Busca por placa de veículo
-            plate_matches = []
-            if not vehicles_df.empty:
-                plate_mask = vehicles_df['plate'].fillna('').astype(str).str.replace(r'\W', '', regex=True).str.lower().str.contains(search_normalized, na=False, regex=False)
-                plate_matches = vehicles_df.loc[plate_mask, 'customer_id'].unique().tolist()
-            
-            # Combinar filtros
-            if plate_matches:
-                customers_df = customers_df[name_mask | cpf_mask | customers_df['id'].isin(plate_matches)]
-            else:
-                customers_df = customers_df[name_mask | cpf_mask]
+        mask = filters.mask('customers', ('customers.csv',), customers_df,
+                            CUSTOMER_FILTERS, request.args)
         
-        # Filtrar por status
-        if status:
-            customers_df = customers_df[customers_df['status'] == status]
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(customers_df)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
-        customers_paginated = customers_df.iloc[start_idx:end_idx]
-        customers = customers_paginated.to_dict('records')
+        # Paginação pelo índice ordenado por id: só as linhas da página viram dicts
+        pager = pagination.paginate('customers', ('customers.csv',), customers_df,
+                                    [('id', True)], mask, request.args)
+        customers = pager.rows.to_dict('records')
         
         # Adicionar veículos usando merge (mais eficiente que loop)
         if not vehicles_df.empty and customers:
@@ -708,9 +706,10 @@ def list_customers():
         
         return render_template('admin/customers/list.html', 
                              customers=customers,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
     except Exception as e:
         print(f"Erro ao listar clientes: {str(e)}")
         import traceback
@@ -724,7 +723,7 @@ def list_customers():
 def add_customer():
     if request.method == 'POST':
         try:
-            customers_df = read_csv_cached('customers.csv')
+            customers_df, customers_version = read_versioned('customers.csv')
             
             name = request.form.get('name', '').strip()
             email = request.form.get('email', '').strip()
@@ -742,11 +741,9 @@ def add_customer():
                 return redirect(url_for('list_customers'))
             
             # Adiciona o novo cliente
-            new_id = get_next_id('customers.csv')
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            new_customer = pd.DataFrame([{
-                'id': new_id,
+            new_customer = {
                 'name': name,
                 'email': email,
                 'phone': phone,
@@ -766,10 +763,10 @@ def add_customer():
                 'status': request.form.get('status', 'ativo'),
                 'created_at': now,
                 'updated_at': now
-            }])
+            }
             
-            updated_df = pd.concat([customers_df, new_customer], ignore_index=True)
-            save_csv_and_invalidate(updated_df, 'customers.csv')
+            # Falha se outro cliente foi gravado depois da verificação do CPF
+            insert_new_record('customers.csv', new_customer, expected_version=customers_version)
             
             flash('Cliente cadastrado com sucesso!', 'success')
             
@@ -786,11 +783,22 @@ def add_customer():
     form = CustomerForm()
     return render_template('admin/customers/form.html', form=form, title='Adicionar Cliente')
 
+@repository.retry_on_conflict
+def update_customer(customer_id, values):
+    """Grava a edição do cliente se o CPF não for de outro cliente; repete se
+    outro worker alterou os clientes entre a verificação e a escrita. Retorna
+    a mensagem de erro, ou None se gravou"""
+    customers_df, version = read_versioned('customers.csv', columns=['id', 'cpf'])
+    if not customers_df[(customers_df['cpf'] == values['cpf']) & (customers_df['id'] != customer_id)].empty:
+        return 'Já existe outro cliente cadastrado com este CPF.'
+    update_record('customers.csv', customer_id, values, expected_version=version)
+    return None
+
 @app.route('/admin/customers/edit/<int:customer_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_customer(customer_id):
     try:
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
+        customers_df = read_csv_cached('customers.csv')
         customer = customers_df[customers_df['id'] == customer_id].iloc[0].to_dict()
         
         if request.method == 'POST':
@@ -804,33 +812,31 @@ def edit_customer(customer_id):
                 flash('Preencha todos os campos obrigatórios.', 'danger')
                 return redirect(url_for('list_customers'))
             
-            # Verifica se o CPF já está em uso por outro cliente
-            if not customers_df[(customers_df['cpf'] == cpf) & (customers_df['id'] != customer_id)].empty:
-                flash('Já existe outro cliente cadastrado com este CPF.', 'danger')
-                return redirect(url_for('list_customers'))
-            
-            # Atualiza o cliente
+            # Atualiza o cliente, se o CPF não estiver em uso por outro cliente
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            customers_df.loc[customers_df['id'] == customer_id, 'name'] = name
-            customers_df.loc[customers_df['id'] == customer_id, 'email'] = email
-            customers_df.loc[customers_df['id'] == customer_id, 'phone'] = phone
-            customers_df.loc[customers_df['id'] == customer_id, 'phone2'] = request.form.get('phone2', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'cpf'] = cpf
-            customers_df.loc[customers_df['id'] == customer_id, 'rg'] = request.form.get('rg', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'birth_date'] = request.form.get('birth_date', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'cep'] = request.form.get('cep', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'street'] = request.form.get('street', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'number'] = request.form.get('number', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'complement'] = request.form.get('complement', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'neighborhood'] = request.form.get('neighborhood', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'city'] = request.form.get('city', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'state'] = request.form.get('state', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'notes'] = request.form.get('notes', '').strip()
-            customers_df.loc[customers_df['id'] == customer_id, 'status'] = request.form.get('status', 'ativo')
-            customers_df.loc[customers_df['id'] == customer_id, 'updated_at'] = now
-            
-            customers_df.to_csv(os.path.join(DATA_DIR, 'customers.csv'), index=False)
+            error = update_customer(customer_id, {
+                'name': name,
+                'email': email,
+                'phone': phone,
+                'phone2': request.form.get('phone2', '').strip(),
+                'cpf': cpf,
+                'rg': request.form.get('rg', '').strip(),
+                'birth_date': request.form.get('birth_date', '').strip(),
+                'cep': request.form.get('cep', '').strip(),
+                'street': request.form.get('street', '').strip(),
+                'number': request.form.get('number', '').strip(),
+                'complement': request.form.get('complement', '').strip(),
+                'neighborhood': request.form.get('neighborhood', '').strip(),
+                'city': request.form.get('city', '').strip(),
+                'state': request.form.get('state', '').strip(),
+                'notes': request.form.get('notes', '').strip(),
+                'status': request.form.get('status', 'ativo'),
+                'updated_at': now
+            })
+            if error:
+                flash(error, 'danger')
+                return redirect(url_for('list_customers'))
             
             flash('Cliente atualizado com sucesso!', 'success')
             return redirect(url_for('list_customers'))
@@ -855,25 +861,31 @@ def edit_customer(customer_id):
         flash(f'Erro ao editar cliente: {str(e)}', 'danger')
         return redirect(url_for('list_customers'))
 
+@repository.retry_on_conflict
+def delete_customer_record(customer_id):
+    """Remove o cliente se ele não tiver veículos; repete se outro worker
+    alterou os clientes entre a leitura e a escrita. Retorna a mensagem de
+    erro, ou None se removeu"""
+    customers_df, version = read_versioned('customers.csv', columns=['id'])
+    if customer_id not in customers_df['id'].values:
+        return 'Cliente não encontrado.'
+    with repository.transaction():
+        # Lidos dentro da transação: nenhum veículo é vinculado até a exclusão terminar
+        vehicles_df = read_csv_cached('vehicles.csv', columns=['customer_id'])
+        if (vehicles_df['customer_id'] == customer_id).any():
+            return 'Não é possível excluir o cliente pois existem veículos vinculados a ele.'
+        delete_record('customers.csv', customer_id, expected_version=version)
+    return None
+
 @app.route('/admin/customers/delete/<int:customer_id>', methods=['POST'])
 @admin_required
 def delete_customer(customer_id):
     try:
-        customers_df = read_csv_cached('customers.csv')
-        if customers_df.empty or customer_id not in customers_df['id'].values:
-            flash('Cliente não encontrado.', 'danger')
-            return redirect(url_for('list_customers'))
-        
-        # Verifica se o cliente possui veículos cadastrados
-        vehicles_df = read_csv_cached('vehicles.csv')
-        if not vehicles_df.empty and not vehicles_df[vehicles_df['customer_id'] == customer_id].empty:
-            flash('Não é possível excluir o cliente pois existem veículos vinculados a ele.', 'danger')
+        error = delete_customer_record(customer_id)
+        if error:
+            flash(error, 'danger')
             return redirect(url_for('list_customers'))
         
-        # Remove o cliente
-        customers_df = customers_df[customers_df['id'] != customer_id]
-        save_csv_and_invalidate(customers_df, 'customers.csv')
-        
         flash('Cliente excluído com sucesso!', 'success')
         
     except Exception as e:
@@ -882,85 +894,62 @@ def delete_customer(customer_id):
     return redirect(url_for('list_customers'))
 
 # --- Veículos ---
+VEHICLE_FILTERS = {
+    # Placa pelo índice de trigramas, modelo e marca, ou nome do cliente
+    'search': ('any', [('ids', 'id', search_index.search_plates),
+                       ('text', ['model', 'brand']),
+                       ('ids', 'customer_id', search_index.search_customer_names)]),
+    'status': ('equals', 'status'),
+    'customer': ('equals', 'customer_id', int),
+}
+
 @app.route('/admin/vehicles')
 @admin_required
 def list_vehicles():
     try:
         vehicles_df = read_csv_cached('vehicles.csv')
-        customers_df = read_csv_cached('customers.csv')
         
         if vehicles_df.empty:
             return render_template('admin/vehicles/list.html', 
-                                 vehicles=[], customers=[], page=1, total_pages=0, total=0)
-        
-        # Merge eficiente com clientes
-        if not customers_df.empty:
-            vehicles_df = vehicles_df.merge(
-                customers_df[['id', 'name']], 
-                left_on='customer_id', 
-                right_on='id', 
-                how='left', 
-                suffixes=('', '_customer')
-            )
-            vehicles_df.rename(columns={'name': 'customer_name'}, inplace=True)
-        else:
-            vehicles_df['customer_name'] = 'N/A'
+                                 vehicles=[], page=1, total_pages=0, total=0)
         
         # Aplicar filtros
-        search = request.args.get('search', '').strip()
-        status = request.args.get('status', '')
         customer_filter = request.args.get('customer', '')
-        
-        if search:
-            search_normalized = ''.join(filter(str.isalnum, search.lower()))
-            # Usar operações vetorizadas
-            mask = (
-                vehicles_df['plate'].fillna('').astype(str).str.replace(r'\W', '', regex=True).str.lower().str.contains(search_normalized, na=False, regex=False) |
-                vehicles_df['model'].fillna('').astype(str).str.lower().str.contains(search.lower(), na=False, regex=False) |
-                vehicles_df['brand'].fillna('').astype(str).str.lower().str.contains(search.lower(), na=False, regex=False) |
-                vehicles_df['customer_name'].fillna('').astype(str).str.lower().str.contains(search.lower(), na=False, regex=False)
-            )
-            vehicles_df = vehicles_df[mask]
-        
-        if status:
-            vehicles_df = vehicles_df[vehicles_df['status'] == status]
-        
-        if customer_filter:
-            vehicles_df = vehicles_df[vehicles_df['customer_id'] == int(customer_filter)]
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(vehicles_df)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
-        vehicles_paginated = vehicles_df.iloc[start_idx:end_idx]
-        
-        customers_list = customers_df.to_dict('records') if not customers_df.empty else []
+        mask = filters.mask('vehicles', ('vehicles.csv',), vehicles_df,
+                            VEHICLE_FILTERS, request.args)
+        
+        # Paginação pelo índice ordenado por id; o nome do cliente só nas linhas da página
+        pager = pagination.paginate('vehicles', ('vehicles.csv',), vehicles_df,
+                                    [('id', True)], mask, request.args)
+        page_df = pager.rows.copy()
+        customers_df = read_csv_cached('customers.csv', columns=['id', 'name'])
+        page_customers = customers_df[customers_df['id'].isin(page_df['customer_id'])]
+        page_df['customer_name'] = repository.map_by_id(
+            page_df['customer_id'], page_customers, 'name').fillna('N/A')
+        vehicles = page_df.to_dict('records')
         
         return render_template('admin/vehicles/list.html', 
-                             vehicles=vehicles_paginated.to_dict('records'),
-                             customers=customers_list,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
+                             vehicles=vehicles,
+                             selected_customer=get_customer_by_id(customer_filter) if customer_filter else None,
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
     except Exception as e:
         print(f"Erro ao listar veículos: {str(e)}")
         import traceback
         traceback.print_exc()
         flash(f'Erro ao carregar veículos: {str(e)}', 'danger')
         return render_template('admin/vehicles/list.html', 
-                             vehicles=[], customers=[], page=1, total_pages=0, total=0)
+                             vehicles=[], page=1, total_pages=0, total=0)
 
 @app.route('/admin/vehicles/add', methods=['GET', 'POST'])
 @admin_required
 def add_vehicle():
     if request.method == 'POST':
         try:
-            vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
+            # A leitura versionada deixa o cache (e o índice de placas) na versão atual
+            _, vehicles_version = read_versioned('vehicles.csv', columns=['id'])
             
             plate = request.form.get('plate', '').strip().upper()
             customer_id = request.form.get('customer_id', '')
@@ -972,17 +961,15 @@ def add_vehicle():
                 flash('Preencha todos os campos obrigatórios.', 'danger')
                 return redirect(url_for('list_vehicles'))
             
-            # Verifica se já existe um veículo com a mesma placa
-            if not vehicles_df[vehicles_df['plate'] == plate].empty:
+            # Verifica se já existe um veículo com a mesma placa (em qualquer formato)
+            if search_index.find_plates(plate):
                 flash('Já existe um veículo cadastrado com esta placa.', 'danger')
                 return redirect(url_for('list_vehicles'))
             
             # Adiciona o novo veículo
-            new_id = get_next_id('vehicles.csv')
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            new_vehicle = pd.DataFrame([{
-                'id': new_id,
+            new_vehicle = {
                 'customer_id': int(customer_id),
                 'plate': plate,
                 'brand': brand,
@@ -996,10 +983,10 @@ def add_vehicle():
                 'status': request.form.get('status', 'ativo'),
                 'created_at': now,
                 'updated_at': now
-            }])
+            }
             
-            updated_df = pd.concat([vehicles_df, new_vehicle], ignore_index=True)
-            updated_df.to_csv(os.path.join(DATA_DIR, 'vehicles.csv'), index=False)
+            # Falha se outro veículo foi gravado depois da verificação da placa
+            insert_new_record('vehicles.csv', new_vehicle, expected_version=vehicles_version)
             
             flash('Veículo cadastrado com sucesso!', 'success')
             
@@ -1016,20 +1003,31 @@ def add_vehicle():
     
     # GET - renderizar formulário antigo para compatibilidade
     form = VehicleForm()
-    try:
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
-        form.customer_id.choices = [(row['id'], row['name']) for _, row in customers_df.iterrows()]
-    except FileNotFoundError:
+    customers_df = read_csv_cached('customers.csv', columns=['id', 'name'])
+    if customers_df.empty:
         flash('Nenhum cliente cadastrado. Cadastre um cliente antes de adicionar um veículo.', 'warning')
         return redirect(url_for('add_customer'))
+    form.customer_id.choices = [(row['id'], row['name']) for _, row in customers_df.iterrows()]
     
     return render_template('admin/vehicles/form.html', form=form, title='Adicionar Veículo')
 
+@repository.retry_on_conflict
+def update_vehicle(vehicle_id, values):
+    """Grava a edição do veículo se a placa não for de outro veículo; repete
+    se outro worker alterou os veículos entre a verificação e a escrita.
+    Retorna a mensagem de erro, ou None se gravou"""
+    # A leitura versionada deixa o cache (e o índice de placas) na versão atual
+    _, version = read_versioned('vehicles.csv', columns=['id'])
+    if set(search_index.find_plates(values['plate'])) - {vehicle_id}:
+        return 'Já existe outro veículo cadastrado com esta placa.'
+    update_record('vehicles.csv', vehicle_id, values, expected_version=version)
+    return None
+
 @app.route('/admin/vehicles/edit/<int:vehicle_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_vehicle(vehicle_id):
     try:
-        vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
+        vehicles_df = read_csv_cached('vehicles.csv')
         vehicle = vehicles_df[vehicles_df['id'] == vehicle_id].iloc[0].to_dict()
         
         if request.method == 'POST':
@@ -1043,35 +1041,33 @@ def edit_vehicle(vehicle_id):
                 flash('Preencha todos os campos obrigatórios.', 'danger')
                 return redirect(url_for('list_vehicles'))
             
-            # Verifica se a placa já está em uso por outro veículo
-            if not vehicles_df[(vehicles_df['plate'] == plate) & (vehicles_df['id'] != vehicle_id)].empty:
-                flash('Já existe outro veículo cadastrado com esta placa.', 'danger')
-                return redirect(url_for('list_vehicles'))
-            
-            # Atualiza o veículo
+            # Atualiza o veículo, se a placa não estiver em uso por outro veículo
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'customer_id'] = int(customer_id)
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'plate'] = plate
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'brand'] = brand
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'model'] = model
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'color'] = request.form.get('color_name', '').strip()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'year'] = request.form.get('year', '').strip()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'type'] = request.form.get('type', '').strip()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'renavam'] = request.form.get('renavam', '').strip()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'chassis'] = request.form.get('chassis', '').strip().upper()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'notes'] = request.form.get('notes', '').strip()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'status'] = request.form.get('status', 'ativo')
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'updated_at'] = now
-            
-            vehicles_df.to_csv(os.path.join(DATA_DIR, 'vehicles.csv'), index=False)
+            error = update_vehicle(vehicle_id, {
+                'customer_id': int(customer_id),
+                'plate': plate,
+                'brand': brand,
+                'model': model,
+                'color': request.form.get('color_name', '').strip(),
+                'year': request.form.get('year', '').strip(),
+                'type': request.form.get('type', '').strip(),
+                'renavam': request.form.get('renavam', '').strip(),
+                'chassis': request.form.get('chassis', '').strip().upper(),
+                'notes': request.form.get('notes', '').strip(),
+                'status': request.form.get('status', 'ativo'),
+                'updated_at': now
+            })
+            if error:
+                flash(error, 'danger')
+                return redirect(url_for('list_vehicles'))
             
             flash('Veículo atualizado com sucesso!', 'success')
             return redirect(url_for('list_vehicles'))
         
         # GET - renderizar formulário antigo para compatibilidade
         form = VehicleForm()
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
+        customers_df = read_csv_cached('customers.csv', columns=['id', 'name'])
         form.customer_id.choices = [(row['id'], row['name']) for _, row in customers_df.iterrows()]
         
         form.id.data = vehicle['id']
@@ -1088,27 +1084,24 @@ def edit_vehicle(vehicle_id):
         form.status.data = vehicle.get('status', 'ativo')
         
         if form.validate_on_submit():
-            # Verifica se a placa já está em uso por outro veículo
-            if not vehicles_df[(vehicles_df['plate'] == form.plate.data.upper()) & 
-                              (vehicles_df['id'] != vehicle_id)].empty:
-                flash('Já existe um veículo cadastrado com esta placa.', 'danger')
+            # Atualiza os dados do veículo, se a placa não estiver em uso por outro veículo
+            error = update_vehicle(vehicle_id, {
+                'customer_id': form.customer_id.data,
+                'plate': form.plate.data.upper(),
+                'brand': form.brand.data if form.brand.data else '',
+                'model': form.model.data,
+                'color': form.color_name.data if form.color_name.data else '',
+                'year': form.year.data if form.year.data else '',
+                'type': form.type.data if form.type.data else '',
+                'renavam': form.renavam.data if form.renavam.data else '',
+                'chassis': form.chassis.data.upper() if form.chassis.data else '',
+                'notes': form.notes.data if form.notes.data else '',
+                'status': form.status.data if form.status.data else 'ativo',
+                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            })
+            if error:
+                flash(error, 'danger')
                 return render_template('admin/vehicles/form.html', form=form, title='Editar Veículo')
-            
-            # Atualiza os dados do veículo
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'customer_id'] = form.customer_id.data
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'plate'] = form.plate.data.upper()
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'brand'] = form.brand.data if form.brand.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'model'] = form.model.data
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'color'] = form.color_name.data if form.color_name.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'year'] = form.year.data if form.year.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'type'] = form.type.data if form.type.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'renavam'] = form.renavam.data if form.renavam.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'chassis'] = form.chassis.data.upper() if form.chassis.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'notes'] = form.notes.data if form.notes.data else ''
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'status'] = form.status.data if form.status.data else 'ativo'
-            vehicles_df.loc[vehicles_df['id'] == vehicle_id, 'updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            vehicles_df.to_csv(os.path.join(DATA_DIR, 'vehicles.csv'), index=False)
             flash('Veículo atualizado com sucesso!', 'success')
             return redirect(url_for('list_vehicles'))
         
@@ -1124,30 +1117,32 @@ def edit_vehicle(vehicle_id):
         flash(f'Erro ao editar veículo: {str(e)}', 'danger')
         return redirect(url_for('list_vehicles'))
 
+@repository.retry_on_conflict
+def delete_vehicle_record(vehicle_id):
+    """Remove o veículo se ele não estiver em uma assinatura ativa; repete se
+    outro worker alterou os veículos entre a leitura e a escrita. Retorna a
+    mensagem de erro, ou None se removeu"""
+    vehicles_df, version = read_versioned('vehicles.csv', columns=['id'])
+    if vehicle_id not in vehicles_df['id'].values:
+        return 'Veículo não encontrado.'
+    with repository.transaction():
+        # Lidas dentro da transação: nenhuma assinatura é criada até a exclusão terminar
+        subs_df = read_csv_cached('subscriptions.csv', columns=['vehicle_id', 'end_date'])
+        end_dates = pd.to_datetime(subs_df['end_date'], errors='coerce')
+        if ((subs_df['vehicle_id'] == vehicle_id) & (end_dates >= datetime.now())).any():
+            return 'Não é possível excluir o veículo pois ele está vinculado a uma assinatura ativa.'
+        delete_record('vehicles.csv', vehicle_id, expected_version=version)
+    return None
+
 @app.route('/admin/vehicles/delete/<int:vehicle_id>', methods=['POST'])
 @admin_required
 def delete_vehicle(vehicle_id):
     try:
-        vehicles_df = read_csv_cached('vehicles.csv')
-        if vehicles_df.empty or vehicle_id not in vehicles_df['id'].values:
-            flash('Veículo não encontrado.', 'danger')
+        error = delete_vehicle_record(vehicle_id)
+        if error:
+            flash(error, 'danger')
             return redirect(url_for('list_vehicles'))
         
-        # Verifica se o veículo está vinculado a alguma assinatura ativa
-        subs_df = read_csv_cached('subscriptions.csv')
-        if not subs_df.empty:
-            subs_df['end_date'] = pd.to_datetime(subs_df['end_date'], errors='coerce')
-            active_subs = subs_df[(subs_df['vehicle_id'] == vehicle_id) & 
-                                 (subs_df['end_date'] >= datetime.now())]
-            
-            if not active_subs.empty:
-                flash('Não é possível excluir o veículo pois ele está vinculado a uma assinatura ativa.', 'danger')
-                return redirect(url_for('list_vehicles'))
-        
-        # Remove o veículo
-        vehicles_df = vehicles_df[vehicles_df['id'] != vehicle_id]
-        save_csv_and_invalidate(vehicles_df, 'vehicles.csv')
-        
         flash('Veículo excluído com sucesso!', 'success')
         
     except Exception as e:
@@ -1161,7 +1156,7 @@ def delete_vehicle(vehicle_id):
 def view_vehicle(vehicle_id):
     try:
         # Carrega os dados do veículo
-        vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
+        vehicles_df = read_csv_cached('vehicles.csv')
         vehicles_df['id'] = vehicles_df['id'].astype(int)  # Garante que o ID seja inteiro
         
         # Filtra o veículo pelo ID
@@ -1174,13 +1169,13 @@ def view_vehicle(vehicle_id):
             vehicle['updated_at'] = pd.to_datetime(vehicle['updated_at'])
         
         # Carrega os dados do cliente proprietário
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
+        customers_df = read_csv_cached('customers.csv')
         customer = customers_df[customers_df['id'] == vehicle['customer_id']].iloc[0].to_dict()
         vehicle['customer'] = customer
         
         # Carrega as fotos do veículo (se houver)
         try:
-            photos_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicle_photos.csv'))
+            photos_df = read_csv_cached('vehicle_photos.csv')
             vehicle_photos = photos_df[photos_df['vehicle_id'] == vehicle_id].to_dict('records')
             # Adiciona o caminho completo para as fotos e converte datas
             for photo in vehicle_photos:
@@ -1191,13 +1186,18 @@ def view_vehicle(vehicle_id):
                 if 'upload_date' in photo and pd.notna(photo['upload_date']):
                     photo['upload_date'] = pd.to_datetime(photo['upload_date'])
             vehicle['photos'] = vehicle_photos
-        except FileNotFoundError:
+        except KeyError:
             vehicle['photos'] = []
         
         # Carrega as movimentações do veículo (entradas/saídas)
         movements = []
         try:
-            movements_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicle_movements.csv'))
+            # Só as partições (meses) a partir do mês do cadastro do veículo,
+            # mais a das movimentações sem data
+            registered = vehicle.get('created_at')
+            movements_df = read_period('vehicle_movements.csv',
+                                       start=registered.normalize().replace(day=1) if pd.notna(registered) else None,
+                                       include_undated=True)
             movements_df = movements_df[movements_df['vehicle_id'] == vehicle_id]
             
             if not movements_df.empty:
@@ -1206,7 +1206,7 @@ def view_vehicle(vehicle_id):
                 movements_df = movements_df.sort_values('date_time', ascending=False)
                 
                 # Adiciona o nome do usuário que registrou a movimentação
-                users_df = pd.read_csv(os.path.join(DATA_DIR, 'users.csv'))
+                users_df = read_csv_cached('users.csv')
                 movements_df = pd.merge(movements_df, users_df[['id', 'name']], 
                                      left_on='user_id', right_on='id', 
                                      how='left', suffixes=('', '_user'))
@@ -1215,7 +1215,7 @@ def view_vehicle(vehicle_id):
                 # Adiciona o objeto user em cada movimentação
                 for mov in movements:
                     mov['user'] = {'name': mov.get('name', 'Desconhecido')}
-        except FileNotFoundError:
+        except KeyError:
             pass
         except Exception as e:
             print(f"Erro ao carregar movimentações: {e}")
@@ -1223,7 +1223,7 @@ def view_vehicle(vehicle_id):
         # Carrega os serviços realizados no veículo
         services = []
         try:
-            services_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicle_services.csv'))
+            services_df = read_csv_cached('vehicle_services.csv')
             services_df = services_df[services_df['vehicle_id'] == vehicle_id]
             
             if not services_df.empty:
@@ -1231,7 +1231,7 @@ def view_vehicle(vehicle_id):
                 services_df['date'] = pd.to_datetime(services_df['date'], errors='coerce')
                 services_df = services_df.sort_values('date', ascending=False)
                 services = services_df.to_dict('records')
-        except FileNotFoundError:
+        except KeyError:
             pass
         except Exception as e:
             print(f"Erro ao carregar serviços: {e}")
@@ -1239,13 +1239,13 @@ def view_vehicle(vehicle_id):
         # Carrega os documentos do veículo
         documents = []
         try:
-            docs_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicle_documents.csv'))
+            docs_df = read_csv_cached('vehicle_documents.csv')
             docs_df = docs_df[docs_df['vehicle_id'] == vehicle_id]
             
             if not docs_df.empty:
                 docs_df['expiration_date'] = pd.to_datetime(docs_df['expiration_date'], errors='coerce')
                 documents = docs_df.to_dict('records')
-        except FileNotFoundError:
+        except KeyError:
             pass
         except Exception as e:
             print(f"Erro ao carregar documentos: {e}")
@@ -1253,7 +1253,7 @@ def view_vehicle(vehicle_id):
         # Carrega o histórico de alterações do veículo
         history = []
         try:
-            history_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicle_history.csv'))
+            history_df = read_csv_cached('vehicle_history.csv')
             history_df = history_df[history_df['vehicle_id'] == vehicle_id]
             
             if not history_df.empty:
@@ -1264,7 +1264,7 @@ def view_vehicle(vehicle_id):
                 history_df = history_df.sort_values('created_at', ascending=False)
                 
                 # Adiciona o nome do usuário que fez a alteração
-                users_df = pd.read_csv(os.path.join(DATA_DIR, 'users.csv'))
+                users_df = read_csv_cached('users.csv')
                 history_df = pd.merge(history_df, users_df[['id', 'name']], 
                                     left_on='user_id', right_on='id', 
                                     how='left', suffixes=('', '_user'))
@@ -1278,7 +1278,7 @@ def view_vehicle(vehicle_id):
                         item['changes'] = json.loads(item.get('changes', '{}'))
                     except:
                         item['changes'] = {}
-        except FileNotFoundError:
+        except KeyError:
             pass
         except Exception as e:
             print(f"Erro ao carregar histórico: {e}")
@@ -1299,50 +1299,33 @@ def view_vehicle(vehicle_id):
         return redirect(url_for('list_vehicles'))
 
 # --- Planos ---
+PLAN_FILTERS = {
+    'search': ('text', ['name', 'description']),
+    'status': ('equals', 'is_active', lambda status: status == 'ativo'),
+}
+
 @app.route('/admin/plans')
 @admin_required
 def list_plans():
     try:
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        
-        # Aplicar filtros
-        search = request.args.get('search', '').strip()
-        status = request.args.get('status', '')
-        
-        if search:
-            # Buscar por nome ou descrição
-            mask = (
-                plans_df['name'].fillna('').astype(str).str.lower().str.contains(search.lower(), na=False) |
-                plans_df['description'].fillna('').astype(str).str.lower().str.contains(search.lower(), na=False)
-            )
-            plans_df = plans_df[mask]
-        
-        if status:
-            is_active = status == 'ativo'
-            plans_df = plans_df[plans_df['is_active'] == is_active]
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(plans_df)
-        total_pages = (total + per_page - 1) // per_page
+        plans_df = read_csv_cached('plans.csv')
+        if plans_df.empty:
+            return render_template('admin/plans/list.html', 
+                                 plans=[], page=1, total_pages=0, total=0)
         
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
+        # Aplicar filtros (nome ou descrição, status)
+        mask = filters.mask('plans', ('plans.csv',), plans_df, PLAN_FILTERS, request.args)
         
-        plans_paginated = plans_df.iloc[start_idx:end_idx]
+        # Paginação pelo índice ordenado por id
+        pager = pagination.paginate('plans', ('plans.csv',), plans_df,
+                                    [('id', True)], mask, request.args)
         
         return render_template('admin/plans/list.html', 
-                             plans=plans_paginated.to_dict('records'),
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
-    except FileNotFoundError:
-        return render_template('admin/plans/list.html', 
-                             plans=[],
-                             page=1,
-                             total_pages=0,
-                             total=0)
+                             plans=pager.rows.to_dict('records'),
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
     except Exception as e:
         print(f"Erro ao listar planos: {str(e)}")
         import traceback
@@ -1359,7 +1342,7 @@ def list_plans():
 def add_plan():
     if request.method == 'POST':
         try:
-            plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
+            plans_df, plans_version = read_versioned('plans.csv')
             
             name = request.form.get('name', '').strip()
             description = request.form.get('description', '').strip()
@@ -1377,19 +1360,17 @@ def add_plan():
                 return redirect(url_for('list_plans'))
             
             # Adiciona o novo plano
-            new_id = get_next_id('plans.csv')
-            new_plan = pd.DataFrame([{
-                'id': new_id,
+            new_plan = {
                 'name': name,
                 'description': description,
-                'price': float(price),
+                'price': to_cents(price),
                 'duration_days': int(duration_days),
                 'is_active': True,
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }])
+            }
             
-            updated_df = pd.concat([plans_df, new_plan], ignore_index=True)
-            updated_df.to_csv(os.path.join(DATA_DIR, 'plans.csv'), index=False)
+            # Falha se outro plano foi gravado depois da verificação do nome
+            insert_new_record('plans.csv', new_plan, expected_version=plans_version)
             
             flash('Plano cadastrado com sucesso!', 'success')
             return redirect(url_for('list_plans'))
@@ -1402,11 +1383,23 @@ def add_plan():
     form = PlanForm()
     return render_template('admin/plans/form.html', form=form, title='Adicionar Plano')
 
+@repository.retry_on_conflict
+def update_plan(plan_id, values):
+    """Grava a edição do plano se o nome não for de outro plano; repete se
+    outro worker alterou os planos entre a verificação e a escrita. Retorna
+    a mensagem de erro, ou None se gravou"""
+    plans_df, version = read_versioned('plans.csv', columns=['id', 'name'])
+    if not plans_df[(plans_df['name'].str.lower() == values['name'].lower()) &
+                    (plans_df['id'] != plan_id)].empty:
+        return 'Já existe um plano com este nome.'
+    update_record('plans.csv', plan_id, values, expected_version=version)
+    return None
+
 @app.route('/admin/plans/edit/<int:plan_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_plan(plan_id):
     try:
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
+        plans_df = read_csv_cached('plans.csv')
         plan = plans_df[plans_df['id'] == plan_id].iloc[0].to_dict()
         
         if request.method == 'POST':
@@ -1420,20 +1413,17 @@ def edit_plan(plan_id):
                 flash('Nome do plano é obrigatório.', 'danger')
                 return redirect(url_for('list_plans'))
             
-            # Verifica se o nome já está em uso por outro plano
-            if not plans_df[(plans_df['name'].str.lower() == name.lower()) & 
-                           (plans_df['id'] != plan_id)].empty:
-                flash('Já existe um plano com este nome.', 'danger')
+            # Atualiza o plano, se o nome não estiver em uso por outro plano
+            error = update_plan(plan_id, {
+                'name': name,
+                'description': description,
+                'price': to_cents(price),
+                'duration_days': int(duration_days)
+            })
+            if error:
+                flash(error, 'danger')
                 return redirect(url_for('list_plans'))
             
-            # Atualiza o plano
-            plans_df.loc[plans_df['id'] == plan_id, 'name'] = name
-            plans_df.loc[plans_df['id'] == plan_id, 'description'] = description
-            plans_df.loc[plans_df['id'] == plan_id, 'price'] = float(price)
-            plans_df.loc[plans_df['id'] == plan_id, 'duration_days'] = int(duration_days)
-            
-            plans_df.to_csv(os.path.join(DATA_DIR, 'plans.csv'), index=False)
-            
             flash('Plano atualizado com sucesso!', 'success')
             return redirect(url_for('list_plans'))
         
@@ -1441,7 +1431,7 @@ def edit_plan(plan_id):
         form = PlanForm()
         form.name.data = plan['name']
         form.description.data = plan['description']
-        form.price.data = plan['price']
+        form.price.data = from_cents(plan['price'])
         form.duration_days.data = plan['duration_days']
         
         return render_template('admin/plans/form.html', form=form, title='Editar Plano')
@@ -1462,16 +1452,20 @@ def edit_plan(plan_id):
         flash(f'Erro ao editar plano: {str(e)}', 'danger')
         return redirect(url_for('list_plans'))
 
+@repository.retry_on_conflict
+def toggle_plan_status(plan_id):
+    """Alterna o status do plano; repete se outro worker alterou os planos
+    entre a leitura e a escrita. Retorna o status anterior"""
+    plans_df, version = read_versioned('plans.csv')
+    current_status = plans_df.loc[plans_df['id'] == plan_id, 'is_active'].values[0]
+    update_record('plans.csv', plan_id, {'is_active': not current_status}, expected_version=version)
+    return current_status
+
 @app.route('/admin/plans/toggle/<int:plan_id>', methods=['POST'])
 @admin_required
 def toggle_plan(plan_id):
     try:
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        
-        # Alterna o status do plano
-        current_status = plans_df.loc[plans_df['id'] == plan_id, 'is_active'].values[0]
-        plans_df.loc[plans_df['id'] == plan_id, 'is_active'] = not current_status
-        plans_df.to_csv(os.path.join(DATA_DIR, 'plans.csv'), index=False)
+        current_status = toggle_plan_status(plan_id)
         
         status = 'ativado' if not current_status else 'desativado'
         flash(f'Plano {status} com sucesso!', 'success')
@@ -1482,99 +1476,82 @@ def toggle_plan(plan_id):
     return redirect(url_for('list_plans'))
 
 # --- Assinaturas ---
+def build_subscriptions_listing(subs_df, customers_df, vehicles_df, plans_df):
+    """Assinaturas com nomes de cliente, placa e plano e data de término já
+    convertida; recalculado só quando alguma tabela muda"""
+    listing = subs_df.copy(deep=False)
+    listing['customer_name'] = repository.map_by_id(
+        listing['customer_id'], customers_df, 'name').fillna('Cliente não encontrado')
+    listing['vehicle_plate'] = repository.map_by_id(
+        listing['vehicle_id'], vehicles_df, 'plate').fillna('Veículo não encontrado')
+    listing['plan_name'] = repository.map_by_id(
+        listing['plan_id'], plans_df, 'name').fillna('Plano não encontrado')
+    listing['end_ts'] = pd.to_datetime(listing['end_date'], errors='coerce')
+    listing['amount_value'] = pd.to_numeric(listing.get('amount', 0), errors='coerce')
+    return listing
+
+def subscription_status_mask(listing, status):
+    """Assinaturas ainda vigentes ('ativa') ou já encerradas ('inativa')"""
+    is_active = listing['end_ts'] >= pd.Timestamp(datetime.now())
+    if status == 'ativa':
+        return is_active
+    if status == 'inativa':
+        return ~is_active
+    return pd.Series(True, index=listing.index)
+
+SUBSCRIPTION_LISTING_TABLES = ('subscriptions.csv', 'customers.csv', 'vehicles.csv', 'plans.csv')
+SUBSCRIPTION_FILTERS = {
+    'search': ('text', ['customer_name', 'vehicle_plate', 'plan_name']),
+    'status': ('mask', subscription_status_mask),
+    'customer': ('equals', 'customer_id', int),
+}
+
 @app.route('/admin/subscriptions')
 @admin_required
 def list_subscriptions():
     try:
-        subs_df = pd.read_csv(os.path.join(DATA_DIR, 'subscriptions.csv'))
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        
-        # Aplicar filtros
-        search = request.args.get('search', '').strip()
-        status = request.args.get('status', '')
+        subs_df = repository.get_derived('subscriptions_listing', SUBSCRIPTION_LISTING_TABLES,
+                                         build_subscriptions_listing)
+        plans_df = read_csv_cached('plans.csv')
         customer_filter = request.args.get('customer', '')
         
-        # Adiciona informações adicionais às assinaturas
-        subscriptions = []
-        total_monthly = 0
-        
-        for _, sub in subs_df.iterrows():
-            sub_dict = sub.to_dict()
-            
-            # Obtém informações do cliente
-            customer = get_customer_by_id(sub['customer_id'])
-            sub_dict['customer_name'] = customer['name'] if customer else 'Cliente não encontrado'
-            
-            # Obtém informações do veículo
-            vehicle = get_vehicle_by_id(sub['vehicle_id'])
-            sub_dict['vehicle_plate'] = vehicle['plate'] if vehicle else 'Veículo não encontrado'
-            
-            # Obtém informações do plano
-            plan = get_plan_by_id(sub['plan_id'])
-            sub_dict['plan_name'] = plan['name'] if plan else 'Plano não encontrado'
-            
-            # Mantém as datas originais e cria versões formatadas
-            sub_dict['start_date_raw'] = sub['start_date']
-            sub_dict['start_date'] = pd.to_datetime(sub['start_date']).strftime('%d/%m/%Y')
-            sub_dict['end_date'] = pd.to_datetime(sub['end_date']).strftime('%d/%m/%Y')
-            
-            # Verifica se a assinatura está ativa
-            sub_dict['is_active'] = pd.to_datetime(sub['end_date']) >= datetime.now()
-            
-            # Soma o valor se a assinatura estiver ativa
-            if sub_dict['is_active']:
-                total_monthly += float(sub.get('amount', 0))
-            
-            subscriptions.append(sub_dict)
-        
-        # Aplicar filtros
-        if search:
-            search_lower = search.lower()
-            subscriptions = [s for s in subscriptions if 
-                           search_lower in s['customer_name'].lower() or 
-                           search_lower in s['vehicle_plate'].lower() or 
-                           search_lower in s['plan_name'].lower()]
-        
-        if status:
-            if status == 'ativa':
-                subscriptions = [s for s in subscriptions if s['is_active']]
-            elif status == 'inativa':
-                subscriptions = [s for s in subscriptions if not s['is_active']]
-        
-        if customer_filter:
-            subscriptions = [s for s in subscriptions if s['customer_id'] == int(customer_filter)]
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(subscriptions)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
-        subscriptions_paginated = subscriptions[start_idx:end_idx]
-        
-        # Prepara listas para o modal
-        customers = [{'id': int(row['id']), 'name': row['name']} for _, row in customers_df.iterrows()]
-        plans = [{'id': int(row['id']), 'name': row['name'], 'price': float(row['price'])} 
-                for _, row in plans_df[plans_df['is_active'] == True].iterrows()]
+        # Verifica quais assinaturas estão ativas e soma o valor delas
+        is_active = subscription_status_mask(subs_df, 'ativa')
+        total_monthly = int(subs_df.loc[is_active, 'amount_value'].sum())
+        
+        # Aplicar filtros como máscaras antes da paginação
+        mask = filters.mask('subscriptions', SUBSCRIPTION_LISTING_TABLES, subs_df,
+                            SUBSCRIPTION_FILTERS, request.args)
+        
+        # Paginação pelo índice ordenado por id; formata as datas apenas das linhas da página
+        pager = pagination.paginate('subscriptions', SUBSCRIPTION_LISTING_TABLES, subs_df,
+                                    [('id', True)], mask, request.args)
+        page_df = pager.rows.copy()
+        page_df['is_active'] = is_active[page_df.index]
+        page_df['start_date_raw'] = page_df['start_date']
+        page_df['start_date'] = pd.to_datetime(page_df['start_date'], errors='coerce').dt.strftime('%d/%m/%Y')
+        page_df['end_date'] = pd.to_datetime(page_df['end_date'], errors='coerce').dt.strftime('%d/%m/%Y')
+        subscriptions_paginated = page_df.drop(columns=['end_ts', 'amount_value']).to_dict('records')
+        
+        # Planos para o modal (os clientes vêm de /api/customers/search)
+        active_plans = plans_df[plans_df['is_active'] == True]
+        plans = [{'id': int(pid), 'name': name, 'price': int(price)}
+                 for pid, name, price in zip(active_plans['id'], active_plans['name'], active_plans['price'])]
         
         return render_template('admin/subscriptions/list.html', 
                              subscriptions=subscriptions_paginated, 
                              total_monthly=total_monthly,
-                             customers=customers,
+                             selected_customer=get_customer_by_id(customer_filter) if customer_filter else None,
                              plans=plans,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
         
-    except FileNotFoundError:
+    except KeyError:
         return render_template('admin/subscriptions/list.html', 
                              subscriptions=[], 
                              total_monthly=0,
-                             customers=[],
                              plans=[],
                              page=1,
                              total_pages=0,
@@ -1587,12 +1564,24 @@ def list_subscriptions():
         return render_template('admin/subscriptions/list.html', 
                              subscriptions=[], 
                              total_monthly=0,
-                             customers=[],
                              plans=[],
                              page=1,
                              total_pages=0,
                              total=0)
 
+@repository.retry_on_conflict
+def update_subscription(subscription_id, values):
+    """Grava a edição da assinatura e gera as contas a receber dela; repete
+    se outro worker alterou as assinaturas entre a leitura e a escrita.
+    Retorna a mensagem de erro, ou None se gravou"""
+    subs_df, version = read_versioned('subscriptions.csv', columns=['id'])
+    if subscription_id not in subs_df['id'].values:
+        return 'Assinatura não encontrada.'
+    with repository.transaction():
+        update_record('subscriptions.csv', subscription_id, values, expected_version=version)
+        generate_receivables([subscription_id])
+    return None
+
 @app.route('/admin/subscriptions/add', methods=['GET', 'POST'])
 @admin_required
 def add_subscription():
@@ -1614,9 +1603,8 @@ def add_subscription():
                 return redirect(url_for('list_subscriptions'))
             
             # Carrega os dados necessários
-            vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
-            plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-            subs_df = pd.read_csv(os.path.join(DATA_DIR, 'subscriptions.csv'))
+            vehicles_df = read_csv_cached('vehicles.csv')
+            plans_df = read_csv_cached('plans.csv')
             
             # Verifica se o veículo pertence ao cliente
             vehicle = vehicles_df[vehicles_df['id'] == vehicle_id]
@@ -1633,33 +1621,34 @@ def add_subscription():
             
             # Se tem subscription_id, é uma edição
             if subscription_id and subscription_id != '':
-                subscription_id = int(subscription_id)
-                subs_df.loc[subs_df['id'] == subscription_id, 'customer_id'] = customer_id
-                subs_df.loc[subs_df['id'] == subscription_id, 'vehicle_id'] = vehicle_id
-                subs_df.loc[subs_df['id'] == subscription_id, 'plan_id'] = plan_id
-                subs_df.loc[subs_df['id'] == subscription_id, 'amount'] = float(plan['price'])
-                subs_df.loc[subs_df['id'] == subscription_id, 'start_date'] = start_date.strftime('%Y-%m-%d')
-                subs_df.loc[subs_df['id'] == subscription_id, 'end_date'] = end_date.strftime('%Y-%m-%d')
-                
-                subs_df.to_csv(os.path.join(DATA_DIR, 'subscriptions.csv'), index=False)
-                flash('Assinatura atualizada com sucesso!', 'success')
+                error = update_subscription(int(subscription_id), {
+                    'customer_id': customer_id,
+                    'vehicle_id': vehicle_id,
+                    'plan_id': plan_id,
+                    'amount': int(plan['price']),
+                    'start_date': start_date.strftime('%Y-%m-%d'),
+                    'end_date': end_date.strftime('%Y-%m-%d')
+                })
+                if error:
+                    flash(error, 'danger')
+                else:
+                    flash('Assinatura atualizada com sucesso!', 'success')
             else:
                 # Cria a nova assinatura
-                new_id = get_next_id('subscriptions.csv')
-                new_sub = pd.DataFrame([{
-                    'id': new_id,
+                new_sub = {
                     'customer_id': customer_id,
                     'vehicle_id': vehicle_id,
                     'plan_id': plan_id,
-                    'amount': float(plan['price']),
+                    'amount': int(plan['price']),
                     'start_date': start_date.strftime('%Y-%m-%d'),
                     'end_date': end_date.strftime('%Y-%m-%d'),
                     'status': 'ativa',
                     'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }])
+                }
                 
-                updated_df = pd.concat([subs_df, new_sub], ignore_index=True)
-                updated_df.to_csv(os.path.join(DATA_DIR, 'subscriptions.csv'), index=False)
+                with repository.transaction():
+                    new_id = insert_new_record('subscriptions.csv', new_sub)
+                    generate_receivables([new_id])
                 flash('Assinatura cadastrada com sucesso!', 'success')
             
             # Verifica se veio do dashboard
@@ -1677,16 +1666,14 @@ def add_subscription():
     form = SubscriptionForm()
     
     try:
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
-        form.customer_id.choices = [(row['id'], row['name']) for _, row in customers_df.iterrows()]
+        # Clientes vêm de /api/customers/search e os veículos do cliente escolhido
+        form.customer_id.choices = []
+        form.vehicle_id.choices = []
         
-        vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
-        form.vehicle_id.choices = [(row['id'], f"{row['plate']} - {row['model']}") for _, row in vehicles_df.iterrows()]
-        
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        form.plan_id.choices = [(row['id'], f"{row['name']} (R$ {row['price']:.2f} - {row['duration_days']} dias)") 
+        plans_df = read_csv_cached('plans.csv')
+        form.plan_id.choices = [(row['id'], plan_label(row)) 
                               for _, row in plans_df[plans_df['is_active'] == True].iterrows()]
-    except FileNotFoundError as e:
+    except KeyError as e:
         flash('Erro ao carregar dados necessários.', 'danger')
         return redirect(url_for('admin_dashboard'))
     
@@ -1697,23 +1684,24 @@ def add_subscription():
 def edit_subscription(subscription_id):
     form = SubscriptionForm()
     
-    # Preenche as opções de clientes, veículos e planos
+    # Preenche as opções: de clientes e veículos só os escolhidos (os demais
+    # vêm da busca), de planos todos os ativos
     try:
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
-        form.customer_id.choices = [(row['id'], row['name']) for _, row in customers_df.iterrows()]
+        current = get_subscription_by_id(subscription_id) or {}
+        form.customer_id.choices = selected_choices(
+            get_customer_by_id, [request.form.get('customer_id', current.get('customer_id'))], lambda c: c['name'])
+        form.vehicle_id.choices = selected_choices(
+            get_vehicle_by_id, [request.form.get('vehicle_id', current.get('vehicle_id'))], vehicle_label)
         
-        vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
-        form.vehicle_id.choices = [(row['id'], f"{row['plate']} - {row['model']}") for _, row in vehicles_df.iterrows()]
-        
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        form.plan_id.choices = [(row['id'], f"{row['name']} (R$ {row['price']:.2f} - {row['duration_days']} dias)") 
+        plans_df = read_csv_cached('plans.csv')
+        form.plan_id.choices = [(row['id'], plan_label(row)) 
                               for _, row in plans_df[plans_df['is_active'] == True].iterrows()]
-    except FileNotFoundError as e:
+    except KeyError as e:
         flash('Erro ao carregar dados necessários.', 'danger')
         return redirect(url_for('list_subscriptions'))
     
     try:
-        subs_df = pd.read_csv(os.path.join(DATA_DIR, 'subscriptions.csv'))
+        subs_df = read_csv_cached('subscriptions.csv')
         subscription = subs_df[subs_df['id'] == subscription_id].iloc[0]
         
         if request.method == 'GET':
@@ -1732,14 +1720,17 @@ def edit_subscription(subscription_id):
             end_date = start_date + timedelta(days=int(plan['duration_days']))
             
             # Atualiza a assinatura
-            subs_df.loc[subs_df['id'] == subscription_id, 'customer_id'] = form.customer_id.data
-            subs_df.loc[subs_df['id'] == subscription_id, 'vehicle_id'] = form.vehicle_id.data
-            subs_df.loc[subs_df['id'] == subscription_id, 'plan_id'] = form.plan_id.data
-            subs_df.loc[subs_df['id'] == subscription_id, 'amount'] = float(plan['price'])
-            subs_df.loc[subs_df['id'] == subscription_id, 'start_date'] = start_date.strftime('%Y-%m-%d')
-            subs_df.loc[subs_df['id'] == subscription_id, 'end_date'] = end_date.strftime('%Y-%m-%d')
-            
-            subs_df.to_csv(os.path.join(DATA_DIR, 'subscriptions.csv'), index=False)
+            error = update_subscription(subscription_id, {
+                'customer_id': form.customer_id.data,
+                'vehicle_id': form.vehicle_id.data,
+                'plan_id': form.plan_id.data,
+                'amount': int(plan['price']),
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d')
+            })
+            if error:
+                flash(error, 'danger')
+                return redirect(url_for('list_subscriptions'))
             
             flash('Assinatura atualizada com sucesso!', 'success')
             return redirect(url_for('list_subscriptions'))
@@ -1750,18 +1741,25 @@ def edit_subscription(subscription_id):
     
     return render_template('admin/subscriptions/form.html', form=form, title='Editar Assinatura')
 
+@repository.retry_on_conflict
+def delete_subscription_record(subscription_id):
+    """Remove a assinatura; repete se outro worker alterou as assinaturas
+    entre a leitura e a escrita. Retorna a mensagem de erro, ou None se removeu"""
+    subs_df, version = read_versioned('subscriptions.csv', columns=['id'])
+    if subscription_id not in subs_df['id'].values:
+        return 'Assinatura não encontrada.'
+    delete_record('subscriptions.csv', subscription_id, expected_version=version)
+    return None
+
 @app.route('/admin/subscriptions/delete/<int:subscription_id>', methods=['POST'])
 @admin_required
 def delete_subscription(subscription_id):
     try:
-        subs_df = read_csv_cached('subscriptions.csv')
-        if subs_df.empty:
-            flash('Assinatura não encontrada.', 'danger')
+        error = delete_subscription_record(subscription_id)
+        if error:
+            flash(error, 'danger')
             return redirect(url_for('list_subscriptions'))
         
-        subs_df = subs_df[subs_df['id'] != subscription_id]
-        save_csv_and_invalidate(subs_df, 'subscriptions.csv')
-        
         flash('Assinatura excluída com sucesso!', 'success')
     except Exception as e:
         flash(f'Erro ao excluir assinatura: {str(e)}', 'danger')
@@ -1773,19 +1771,18 @@ def delete_subscription(subscription_id):
 @admin_required
 def financial_transactions():
     try:
-        transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-        transactions_df['date'] = pd.to_datetime(transactions_df['date'])
-        transactions_df = transactions_df.sort_values('date', ascending=False)
-        
         # Filtros
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         transaction_type = request.args.get('type')
         
-        if start_date:
-            transactions_df = transactions_df[transactions_df['date'] >= pd.to_datetime(start_date)]
-        if end_date:
-            transactions_df = transactions_df[transactions_df['date'] <= pd.to_datetime(end_date) + timedelta(days=1)]
+        # Com período, só as partições dos meses dele são lidas
+        transactions_df = read_period('financial_transactions.csv',
+                                      start=pd.to_datetime(start_date) if start_date else None,
+                                      end=pd.to_datetime(end_date) + timedelta(days=1) if end_date else None)
+        transactions_df['date'] = pd.to_datetime(transactions_df['date'])
+        transactions_df = transactions_df.sort_values('date', ascending=False)
+        
         if transaction_type:
             transactions_df = transactions_df[transactions_df['type'] == transaction_type]
         
@@ -1799,7 +1796,7 @@ def financial_transactions():
         for _, row in transactions_df.iterrows():
             trans = row.to_dict()
             trans['date'] = trans['date'].strftime('%d/%m/%Y')
-            trans['amount'] = f"R$ {trans['amount']:,.2f}".replace('.', '|').replace(',', '.').replace('|', ',')
+            trans['amount'] = format_currency(trans['amount'])
             transactions.append(trans)
         
         return render_template('admin/financial/transactions.html',
@@ -1811,7 +1808,7 @@ def financial_transactions():
                              end_date=end_date,
                              transaction_type=transaction_type)
         
-    except FileNotFoundError:
+    except KeyError:
         return render_template('admin/financial/transactions.html',
                              transactions=[],
                              total_receita=0,
@@ -1825,22 +1822,17 @@ def add_financial_transaction():
     
     if form.validate_on_submit():
         try:
-            transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-            
-            new_id = get_next_id('financial_transactions.csv')
-            new_transaction = pd.DataFrame([{
-                'id': new_id,
+            new_transaction = {
                 'description': form.description.data,
-                'amount': float(form.amount.data),
+                'amount': to_cents(form.amount.data),
                 'date': form.transaction_date.data.strftime('%Y-%m-%d'),
                 'category': form.category.data,
                 'type': form.type.data,
                 'related_id': None,
                 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            }])
+            }
             
-            updated_df = pd.concat([transactions_df, new_transaction], ignore_index=True)
-            updated_df.to_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'), index=False)
+            insert_new_record('financial_transactions.csv', new_transaction)
             
             flash('Transação registrada com sucesso!', 'success')
             return redirect(url_for('financial_transactions'))
@@ -1851,149 +1843,74 @@ def add_financial_transaction():
     return render_template('admin/financial/transaction_form.html', form=form, title='Nova Transação')
 
 # --- Contas a Receber ---
+def build_receivables_listing(receivables_df, subs_df, customers_df):
+    """Primeira conta a receber de cada assinatura, na ordem das assinaturas,
+    com o nome do cliente; recalculado só quando alguma tabela muda"""
+    if 'subscription_id' not in receivables_df.columns:
+        receivables_df = repository.empty_table('accounts_receivable.csv')
+    receivables_df = receivables_df[receivables_df['subscription_id'].notna()]
+    receivables_df = receivables_df.drop_duplicates('subscription_id')
+    
+    subs_keys = pd.DataFrame({
+        'subscription_id': pd.to_numeric(subs_df['id'], errors='coerce'),
+        'sub_customer_id': subs_df['customer_id'],
+    }).dropna(subset=['subscription_id'])
+    receivables_df = receivables_df.assign(
+        subscription_id=pd.to_numeric(receivables_df['subscription_id'], errors='coerce'))
+    # Inner join preserva a ordem das assinaturas
+    listing = subs_keys.merge(receivables_df, on='subscription_id', how='inner')
+    
+    listing['customer_name'] = repository.map_by_id(
+        listing['sub_customer_id'], customers_df, 'name').fillna('Cliente não encontrado')
+    listing = listing.drop(columns=['sub_customer_id'])
+    listing['amount_value'] = pd.to_numeric(listing['amount'], errors='coerce').fillna(0)
+    return listing
+
+RECEIVABLE_LISTING_TABLES = ('accounts_receivable.csv', 'subscriptions.csv', 'customers.csv')
+RECEIVABLE_FILTERS = {
+    'search': ('text', ['customer_name', 'description']),
+    'status': ('equals', 'status'),
+    'customer': ('equals', 'customer_id', int),
+}
+
 @app.route('/admin/financial/accounts-receivable')
 @admin_required
 def accounts_receivable():
     try:
-        # Carrega assinaturas
-        subscriptions_df = pd.read_csv(os.path.join(DATA_DIR, 'subscriptions.csv'))
-        customers_df = pd.read_csv(os.path.join(DATA_DIR, 'customers.csv'))
-        plans_df = pd.read_csv(os.path.join(DATA_DIR, 'plans.csv'))
-        
-        # Filtros
-        search = request.args.get('search', '').strip()
-        status_filter = request.args.get('status', '')
-        customer_filter = request.args.get('customer', '')
-        
-        # Carrega contas a receber existentes
-        try:
-            receivables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_receivable.csv'))
-            if receivables_df.empty or 'subscription_id' not in receivables_df.columns:
-                receivables_df = pd.DataFrame(columns=['id', 'subscription_id', 'customer_id', 'description', 
-                                                       'amount', 'due_date', 'payment_date', 'status', 
-                                                       'payment_method', 'notes', 'created_at', 'updated_at'])
-        except (FileNotFoundError, pd.errors.EmptyDataError):
-            receivables_df = pd.DataFrame(columns=['id', 'subscription_id', 'customer_id', 'description', 
-                                                   'amount', 'due_date', 'payment_date', 'status', 
-                                                   'payment_method', 'notes', 'created_at', 'updated_at'])
-        
-        receivables_list = []
-        next_id = receivables_df['id'].max() + 1 if len(receivables_df) > 0 and not pd.isna(receivables_df['id'].max()) else 1
-        
-        # Processa cada assinatura
-        for _, sub in subscriptions_df.iterrows():
-            # Busca se já existe conta a receber para esta assinatura
-            existing = receivables_df[receivables_df['subscription_id'] == sub['id']]
-            
-            # Obtém dados do cliente e plano
-            customer = customers_df[customers_df['id'] == sub['customer_id']].iloc[0] if len(customers_df[customers_df['id'] == sub['customer_id']]) > 0 else None
-            plan = plans_df[plans_df['id'] == sub['plan_id']].iloc[0] if len(plans_df[plans_df['id'] == sub['plan_id']]) > 0 else None
-            
-            customer_name = customer['name'] if customer is not None else 'Cliente não encontrado'
-            plan_name = plan['name'] if plan is not None else 'Plano não encontrado'
-            
-            end_date = pd.to_datetime(sub['end_date'])
-            today = pd.Timestamp.now()
-            
-            if len(existing) > 0:
-                # Usa conta existente
-                rec = existing.iloc[0].to_dict()
-                rec['customer_name'] = customer_name
-                rec['due_date_formatted'] = pd.to_datetime(rec['due_date']).strftime('%d/%m/%Y')
-                receivables_list.append(rec)
-            else:
-                # Cria nova conta a receber automaticamente
-                status = 'pendente'
-                if end_date < today:
-                    status = 'vencido'
-                
-                # Processa múltiplos veículos
-                vehicle_ids_str = str(sub.get('vehicle_ids', sub.get('vehicle_id', '')))
-                vehicle_ids = [int(vid.strip()) for vid in vehicle_ids_str.split(',') if vid.strip()]
-                vehicle_count = len(vehicle_ids)
-                
-                # Obtém modelos dos veículos
-                vehicles_df = pd.read_csv(os.path.join(DATA_DIR, 'vehicles.csv'))
-                vehicle_models = []
-                for vid in vehicle_ids:
-                    vehicle = vehicles_df[vehicles_df['id'] == vid]
-                    if len(vehicle) > 0:
-                        v = vehicle.iloc[0]
-                        vehicle_models.append(f"{v['model']}")
-                
-                vehicles_text = ', '.join(vehicle_models) if vehicle_models else 'Veículo não encontrado'
-                
-                new_receivable = {
-                    'id': next_id,
-                    'subscription_id': sub['id'],
-                    'customer_id': sub['customer_id'],
-                    'description': f'Assinatura {plan_name} - {customer_name} - {vehicles_text}',
-                    'amount': float(sub['amount']),
-                    'due_date': sub['end_date'],
-                    'payment_date': '',
-                    'status': status,
-                    'payment_method': '',
-                    'notes': f'Gerado automaticamente da assinatura #{sub["id"]}',
-                    'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'updated_at': ''
-                }
-                
-                receivables_df = pd.concat([receivables_df, pd.DataFrame([new_receivable])], ignore_index=True)
-                
-                new_receivable['customer_name'] = customer_name
-                new_receivable['due_date_formatted'] = pd.to_datetime(new_receivable['due_date']).strftime('%d/%m/%Y')
-                receivables_list.append(new_receivable)
-                next_id += 1
-        
-        # Salva contas a receber atualizadas
-        receivables_df.to_csv(os.path.join(DATA_DIR, 'accounts_receivable.csv'), index=False)
+        # Contas a receber de cada assinatura (geradas por generate_receivables)
+        listing_df = repository.get_derived('receivables_listing', RECEIVABLE_LISTING_TABLES,
+                                            build_receivables_listing)
         
         # Filtros
-        search = request.args.get('search', '').strip()
         status_filter = request.args.get('status', '')
         customer_filter = request.args.get('customer', '')
-        
-        # Aplicar filtros
-        if search:
-            search_lower = search.lower()
-            receivables_list = [r for r in receivables_list if 
-                              search_lower in r.get('customer_name', '').lower() or
-                              search_lower in r.get('description', '').lower()]
-        
-        if status_filter:
-            receivables_list = [r for r in receivables_list if r['status'] == status_filter]
-        
-        if customer_filter:
-            receivables_list = [r for r in receivables_list if r.get('customer_id') == int(customer_filter)]
-        
-        # Calcula totais (antes da paginação)
-        total_pendente = sum(float(r['amount']) for r in receivables_list if r['status'] in ['pendente', 'vencido'])
-        total_pago = sum(float(r['amount']) for r in receivables_list if r['status'] == 'pago')
-        total_vencido = sum(float(r['amount']) for r in receivables_list if r['status'] == 'vencido')
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(receivables_list)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        receivables_paginated = receivables_list[start_idx:end_idx]
-        
-        # Prepara lista de clientes para filtro
-        customers_list = [{'id': int(row['id']), 'name': row['name']} for _, row in customers_df.iterrows()]
+        mask = filters.mask('receivables', RECEIVABLE_LISTING_TABLES, listing_df,
+                            RECEIVABLE_FILTERS, request.args)
+        
+        # Calcula totais (antes da paginação) sobre a máscara
+        amounts = listing_df['amount_value'].where(mask, 0)
+        total_pendente = int(amounts[listing_df['status'].isin(['pendente', 'vencido'])].sum())
+        total_pago = int(amounts[listing_df['status'] == 'pago'].sum())
+        total_vencido = int(amounts[listing_df['status'] == 'vencido'].sum())
+        
+        # Paginação pelo índice ordenado por assinatura
+        pager = pagination.paginate('receivables', RECEIVABLE_LISTING_TABLES, listing_df,
+                                    [('subscription_id', True)], mask, request.args)
+        page_df = pager.rows.copy()
+        page_df['due_date_formatted'] = pd.to_datetime(page_df['due_date'], errors='coerce').dt.strftime('%d/%m/%Y')
+        receivables_paginated = page_df.drop(columns=['amount_value']).to_dict('records')
         
         return render_template('admin/financial/accounts_receivable.html',
                              receivables=receivables_paginated,
-                             customers=customers_list,
+                             selected_customer=get_customer_by_id(customer_filter) if customer_filter else None,
                              total_pendente=total_pendente,
                              total_pago=total_pago,
                              total_vencido=total_vencido,
                              status_filter=status_filter,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
     except Exception as e:
         flash(f'Erro ao carregar contas a receber: {str(e)}', 'danger')
         return render_template('admin/financial/accounts_receivable.html',
@@ -2007,40 +1924,43 @@ def accounts_receivable():
 @admin_required
 def receive_payment(receivable_id):
     try:
-        receivables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_receivable.csv'))
-        
-        # Encontra a conta
-        idx = receivables_df[receivables_df['id'] == receivable_id].index
-        if len(idx) == 0:
-            flash('Conta a receber não encontrada.', 'danger')
-            return redirect(url_for('accounts_receivable'))
-        
-        # Atualiza status para pago
-        receivables_df.loc[idx, 'status'] = 'pago'
-        receivables_df.loc[idx, 'payment_date'] = datetime.now().strftime('%Y-%m-%d')
-        receivables_df.loc[idx, 'payment_method'] = request.form.get('payment_method', 'dinheiro')
-        receivables_df.loc[idx, 'updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        receivables_df.to_csv(os.path.join(DATA_DIR, 'accounts_receivable.csv'), index=False)
-        
-        # Registra transação financeira
-        transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-        receivable = receivables_df.loc[idx].iloc[0]
-        
-        new_transaction_id = transactions_df['id'].max() + 1 if len(transactions_df) > 0 else 1
-        new_transaction = {
-            'id': new_transaction_id,
-            'description': receivable['description'],
-            'amount': float(receivable['amount']),
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'category': 'assinatura',
-            'type': 'receita',
-            'related_id': receivable['subscription_id'],
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        # Baixa da conta e transação gravadas juntas (ou nenhuma das duas); a
+        # conta é lida dentro da transação para que dois envios simultâneos
+        # não registrem a mesma receita duas vezes
+        with repository.transaction():
+            receivables_df, receivables_version = read_versioned('accounts_receivable.csv')
+            
+            # Encontra a conta
+            idx = receivables_df[receivables_df['id'] == receivable_id].index
+            if len(idx) == 0:
+                flash('Conta a receber não encontrada.', 'danger')
+                return redirect(url_for('accounts_receivable'))
+            
+            receivable = receivables_df.loc[idx].iloc[0]
+            if receivable['status'] == 'pago':
+                flash('Esta conta já foi recebida.', 'danger')
+                return redirect(url_for('accounts_receivable'))
+            
+            # Atualiza status para pago
+            update_record('accounts_receivable.csv', receivable_id, {
+                'status': 'pago',
+                'payment_date': datetime.now().strftime('%Y-%m-%d'),
+                'payment_method': request.form.get('payment_method', 'dinheiro'),
+                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }, expected_version=receivables_version)
+        
+            # Registra transação financeira
+            new_transaction = {
+                'description': receivable['description'],
+                'amount': int(receivable['amount']),
+                'date': datetime.now().strftime('%Y-%m-%d'),
+                'category': 'assinatura',
+                'type': 'receita',
+                'related_id': receivable['subscription_id'],
+                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
         
-        transactions_df = pd.concat([transactions_df, pd.DataFrame([new_transaction])], ignore_index=True)
-        transactions_df.to_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'), index=False)
+            insert_new_record('financial_transactions.csv', new_transaction)
         
         flash('Pagamento recebido com sucesso!', 'success')
         return redirect(url_for('accounts_receivable'))
@@ -2050,54 +1970,50 @@ def receive_payment(receivable_id):
         return redirect(url_for('accounts_receivable'))
 
 # --- Contas a Pagar ---
+def build_payables_listing(payables_df):
+    """Contas a pagar com vencimento já convertido; recalculado só quando a
+    tabela muda"""
+    listing = payables_df.copy(deep=False)
+    listing['due_ts'] = pd.to_datetime(listing['due_date'], errors='coerce')
+    listing['amount_value'] = pd.to_numeric(listing['amount'], errors='coerce').fillna(0)
+    return listing
+
+PAYABLE_FILTERS = {
+    'search': ('text', ['supplier', 'description']),
+    'status': ('equals', 'status'),
+    'category': ('equals', 'category'),
+}
+
 @app.route('/admin/financial/accounts-payable')
 @admin_required
 def accounts_payable():
     try:
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        payables_df['due_date'] = pd.to_datetime(payables_df['due_date'])
+        payables_df = repository.get_derived('payables_listing', ('accounts_payable.csv',),
+                                             build_payables_listing)
         
         # Filtros
-        search = request.args.get('search', '').strip()
         status_filter = request.args.get('status', '')
-        category_filter = request.args.get('category', '')
+        mask = filters.mask('payables', ('accounts_payable.csv',), payables_df,
+                            PAYABLE_FILTERS, request.args)
         
-        # Formata dados para exibição
-        payables_list = []
-        for _, row in payables_df.iterrows():
-            payable = row.to_dict()
-            payable['due_date_raw'] = row['due_date']
-            payable['due_date'] = row['due_date'].strftime('%d/%m/%Y')
-            payable['is_overdue'] = row['status'] == 'pendente' and row['due_date'] < pd.Timestamp.now()
-            payables_list.append(payable)
-        
-        # Aplicar filtros
-        if search:
-            search_lower = search.lower()
-            payables_list = [p for p in payables_list if 
-                           search_lower in p.get('supplier', '').lower() or
-                           search_lower in p.get('description', '').lower()]
-        
-        if status_filter:
-            payables_list = [p for p in payables_list if p.get('status') == status_filter]
-        
-        if category_filter:
-            payables_list = [p for p in payables_list if p.get('category') == category_filter]
+        is_overdue = (payables_df['status'] == 'pendente') & (payables_df['due_ts'] < pd.Timestamp.now())
         
         # Calcula totais (antes da paginação)
-        total_geral = sum(p.get('amount', 0) for p in payables_list)
-        total_pago = sum(p.get('amount', 0) for p in payables_list if p.get('status') == 'pago')
-        total_vencido = sum(p.get('amount', 0) for p in payables_list if p.get('is_overdue', False))
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(payables_list)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        payables_paginated = payables_list[start_idx:end_idx]
+        amounts = payables_df['amount_value'].where(mask, 0)
+        total_geral = int(amounts.sum())
+        total_pago = int(amounts[payables_df['status'] == 'pago'].sum())
+        total_vencido = int(amounts[is_overdue].sum())
+        
+        # Paginação pelo índice ordenado por id; formata apenas as linhas da página
+        pager = pagination.paginate('payables', ('accounts_payable.csv',), payables_df,
+                                    [('id', True)], mask, request.args)
+        page_df = pager.rows.copy()
+        page_df['is_overdue'] = is_overdue[page_df.index]
+        page_df['due_date'] = page_df['due_ts'].dt.strftime('%d/%m/%Y').fillna('')
+        payables_paginated = page_df.drop(columns=['amount_value']).to_dict('records')
+        for payable in payables_paginated:
+            due_ts = payable.pop('due_ts')
+            payable['due_date_raw'] = due_ts if pd.notna(due_ts) else None
         
         return render_template('admin/financial/accounts_payable.html',
                              payables=payables_paginated,
@@ -2105,10 +2021,11 @@ def accounts_payable():
                              total_pago=total_pago,
                              total_vencido=total_vencido,
                              status_filter=status_filter,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
-    except FileNotFoundError:
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
+    except KeyError:
         return render_template('admin/financial/accounts_payable.html',
                              payables=[],
                              total_geral=0,
@@ -2123,18 +2040,12 @@ def accounts_payable():
 @admin_required
 def add_account_payable():
     try:
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        
-        # Obtém próximo ID
-        next_id = payables_df['id'].max() + 1 if len(payables_df) > 0 and not pd.isna(payables_df['id'].max()) else 1
-        
-        # Cria nova conta a pagar
+        # Cria nova conta a pagar (o id é gerado na inserção)
         new_payable = {
-            'id': next_id,
             'supplier': request.form.get('supplier'),
             'description': request.form.get('description'),
             'category': request.form.get('category'),
-            'amount': float(request.form.get('amount')),
+            'amount': to_cents(request.form.get('amount')),
             'due_date': request.form.get('due_date'),
             'payment_date': '',
             'status': 'pendente',
@@ -2144,8 +2055,7 @@ def add_account_payable():
             'updated_at': ''
         }
         
-        payables_df = pd.concat([payables_df, pd.DataFrame([new_payable])], ignore_index=True)
-        payables_df.to_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'), index=False)
+        insert_new_record('accounts_payable.csv', new_payable)
         
         flash('Conta a pagar adicionada com sucesso!', 'success')
         return redirect(url_for('accounts_payable'))
@@ -2158,40 +2068,43 @@ def add_account_payable():
 @admin_required
 def pay_account(payable_id):
     try:
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        
-        # Encontra a conta
-        idx = payables_df[payables_df['id'] == payable_id].index
-        if len(idx) == 0:
-            flash('Conta a pagar não encontrada.', 'danger')
-            return redirect(url_for('accounts_payable'))
-        
-        # Atualiza status para pago
-        payables_df.loc[idx, 'status'] = 'pago'
-        payables_df.loc[idx, 'payment_date'] = datetime.now().strftime('%Y-%m-%d')
-        payables_df.loc[idx, 'payment_method'] = request.form.get('payment_method', 'dinheiro')
-        payables_df.loc[idx, 'updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        payables_df.to_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'), index=False)
-        
-        # Registra transação financeira
-        transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-        payable = payables_df.loc[idx].iloc[0]
-        
-        new_transaction_id = transactions_df['id'].max() + 1 if len(transactions_df) > 0 else 1
-        new_transaction = {
-            'id': new_transaction_id,
-            'description': payable['description'],
-            'amount': float(payable['amount']),
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'category': payable['category'],
-            'type': 'despesa',
-            'related_id': payable['id'],
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        # Baixa da conta e transação gravadas juntas (ou nenhuma das duas); a
+        # conta é lida dentro da transação para que dois envios simultâneos
+        # não registrem a mesma despesa duas vezes
+        with repository.transaction():
+            payables_df, payables_version = read_versioned('accounts_payable.csv')
+            
+            # Encontra a conta
+            idx = payables_df[payables_df['id'] == payable_id].index
+            if len(idx) == 0:
+                flash('Conta a pagar não encontrada.', 'danger')
+                return redirect(url_for('accounts_payable'))
+            
+            payable = payables_df.loc[idx].iloc[0]
+            if payable['status'] == 'pago':
+                flash('Esta conta já foi paga.', 'danger')
+                return redirect(url_for('accounts_payable'))
+            
+            # Atualiza status para pago
+            update_record('accounts_payable.csv', payable_id, {
+                'status': 'pago',
+                'payment_date': datetime.now().strftime('%Y-%m-%d'),
+                'payment_method': request.form.get('payment_method', 'dinheiro'),
+                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }, expected_version=payables_version)
+        
+            # Registra transação financeira
+            new_transaction = {
+                'description': payable['description'],
+                'amount': int(payable['amount']),
+                'date': datetime.now().strftime('%Y-%m-%d'),
+                'category': payable['category'],
+                'type': 'despesa',
+                'related_id': payable['id'],
+                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }
         
-        transactions_df = pd.concat([transactions_df, pd.DataFrame([new_transaction])], ignore_index=True)
-        transactions_df.to_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'), index=False)
+            insert_new_record('financial_transactions.csv', new_transaction)
         
         flash('Pagamento realizado com sucesso!', 'success')
         return redirect(url_for('accounts_payable'))
@@ -2200,28 +2113,34 @@ def pay_account(payable_id):
         flash(f'Erro ao realizar pagamento: {str(e)}', 'danger')
         return redirect(url_for('accounts_payable'))
 
+@repository.retry_on_conflict
+def update_account_payable(payable_id, values):
+    """Grava a edição da conta a pagar; repete se outro worker alterou as
+    contas entre a leitura e a escrita. Retorna a mensagem de erro, ou None
+    se gravou"""
+    payables_df, version = read_versioned('accounts_payable.csv', columns=['id'])
+    if payable_id not in payables_df['id'].values:
+        return 'Conta a pagar não encontrada.'
+    update_record('accounts_payable.csv', payable_id, values, expected_version=version)
+    return None
+
 @app.route('/admin/financial/accounts-payable/<int:payable_id>/edit', methods=['POST'])
 @admin_required
 def edit_account_payable(payable_id):
     try:
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        
-        # Encontra a conta
-        idx = payables_df[payables_df['id'] == payable_id].index
-        if len(idx) == 0:
-            flash('Conta a pagar não encontrada.', 'danger')
-            return redirect(url_for('accounts_payable'))
-        
         # Atualiza dados
-        payables_df.loc[idx, 'supplier'] = request.form.get('supplier')
-        payables_df.loc[idx, 'description'] = request.form.get('description')
-        payables_df.loc[idx, 'category'] = request.form.get('category')
-        payables_df.loc[idx, 'amount'] = float(request.form.get('amount'))
-        payables_df.loc[idx, 'due_date'] = request.form.get('due_date')
-        payables_df.loc[idx, 'notes'] = request.form.get('notes', '')
-        payables_df.loc[idx, 'updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        payables_df.to_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'), index=False)
+        error = update_account_payable(payable_id, {
+            'supplier': request.form.get('supplier'),
+            'description': request.form.get('description'),
+            'category': request.form.get('category'),
+            'amount': to_cents(request.form.get('amount')),
+            'due_date': request.form.get('due_date'),
+            'notes': request.form.get('notes', ''),
+            'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('accounts_payable'))
         
         flash('Conta a pagar atualizada com sucesso!', 'success')
         return redirect(url_for('accounts_payable'))
@@ -2230,27 +2149,29 @@ def edit_account_payable(payable_id):
         flash(f'Erro ao atualizar conta: {str(e)}', 'danger')
         return redirect(url_for('accounts_payable'))
 
+@repository.retry_on_conflict
+def delete_account_payable_record(payable_id):
+    """Remove a conta a pagar se ela ainda não foi paga; repete se outro
+    worker alterou as contas entre a verificação e a escrita (ex.: pagou a
+    conta). Retorna a mensagem de erro, ou None se removeu"""
+    payables_df, version = read_versioned('accounts_payable.csv', columns=['id', 'status'])
+    payable = payables_df[payables_df['id'] == payable_id]
+    if payable.empty:
+        return 'Conta a pagar não encontrada.'
+    if payable['status'].iloc[0] == 'pago':
+        return 'Não é possível excluir uma conta já paga.'
+    delete_record('accounts_payable.csv', payable_id, expected_version=version)
+    return None
+
 @app.route('/admin/financial/accounts-payable/<int:payable_id>/delete', methods=['POST'])
 @admin_required
 def delete_account_payable(payable_id):
     try:
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        
-        # Verifica se a conta existe
-        idx = payables_df[payables_df['id'] == payable_id].index
-        if len(idx) == 0:
-            flash('Conta a pagar não encontrada.', 'danger')
+        error = delete_account_payable_record(payable_id)
+        if error:
+            flash(error, 'danger')
             return redirect(url_for('accounts_payable'))
         
-        # Verifica se a conta já foi paga
-        if payables_df.loc[idx, 'status'].iloc[0] == 'pago':
-            flash('Não é possível excluir uma conta já paga.', 'danger')
-            return redirect(url_for('accounts_payable'))
-        
-        # Remove a conta
-        payables_df = payables_df[payables_df['id'] != payable_id]
-        payables_df.to_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'), index=False)
-        
         flash('Conta a pagar removida com sucesso!', 'success')
         return redirect(url_for('accounts_payable'))
         
@@ -2259,185 +2180,109 @@ def delete_account_payable(payable_id):
         return redirect(url_for('accounts_payable'))
 
 # --- Fluxo de Caixa ---
+def build_cash_flow_movements(transactions_df, receivables_df, payables_df):
+    """Junta transações realizadas e contas a receber/pagar em aberto em um único
+    DataFrame, da data mais recente para a mais antiga"""
+    # Transações realizadas (receitas e despesas)
+    transactions_df = transactions_df[transactions_df['type'].isin(['receita', 'despesa'])]
+    realizados = pd.DataFrame({
+        'date': pd.to_datetime(transactions_df['date'], errors='coerce'),
+        'description': transactions_df['description'],
+        'type': transactions_df['type'].map({'receita': 'entrada', 'despesa': 'saida'}),
+        'category': transactions_df['category'],
+        'amount': pd.to_numeric(transactions_df['amount'], errors='coerce'),
+        'status': 'realizado',
+    })
+    # Receitas antes das despesas nas datas iguais, como na listagem original
+    realizados = realizados.iloc[np.argsort((realizados['type'] == 'saida').to_numpy(), kind='stable')]
+    
+    def open_accounts(df, type_, category, label):
+        # APENAS pendentes e vencidas - pagas já viraram transações
+        df = df[df['status'] != 'pago']
+        overdue = df['status'] == 'vencido'
+        return pd.DataFrame({
+            'date': pd.to_datetime(df['due_date'], errors='coerce'),
+            'description': df['description'].astype(str) + np.where(overdue, ' (Vencido)', f' ({label})'),
+            'type': type_,
+            'category': category if category is not None else df['category'],
+            'amount': pd.to_numeric(df['amount'], errors='coerce'),
+            'status': np.where(overdue, 'vencido', 'previsto'),
+        })
+    
+    movements = pd.concat([
+        realizados,
+        open_accounts(receivables_df, 'entrada', 'assinatura', 'A receber'),
+        open_accounts(payables_df, 'saida', None, 'A pagar'),
+    ], ignore_index=True)
+    movements = movements[movements['amount'].notna()]
+    # Posição antes da ordenação: desempata a chave (data, seq) da paginação
+    movements['seq'] = np.arange(len(movements))
+    movements = movements.sort_values('date', ascending=False, kind='stable', na_position='last')
+    movements['type'] = pd.Categorical(movements['type'], categories=['entrada', 'saida'])
+    movements['status'] = pd.Categorical(movements['status'], categories=['realizado', 'previsto', 'vencido'])
+    return movements.reset_index(drop=True)
+
+CASH_FLOW_TABLES = ('financial_transactions.csv', 'accounts_receivable.csv', 'accounts_payable.csv')
+CASH_FLOW_FILTERS = {
+    'search': ('text', ['description', 'category']),
+    'type': ('equals', 'type'),
+    'status': ('equals', 'status'),
+}
+
 @app.route('/admin/financial/cash-flow')
 @admin_required
 def cash_flow():
     try:
-        # Carrega transações financeiras (receitas e despesas já realizadas)
-        transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-        transactions_df['date'] = pd.to_datetime(transactions_df['date'])
-        
-        # Carrega contas a receber
-        receivables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_receivable.csv'))
-        receivables_df['due_date'] = pd.to_datetime(receivables_df['due_date'])
-        
-        # Carrega contas a pagar
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        payables_df['due_date'] = pd.to_datetime(payables_df['due_date'])
-        
-        # Cria lista de movimentações
-        movements = []
-        
-        # Adiciona transações realizadas (receitas e despesas)
-        for _, trans in transactions_df[transactions_df['type'] == 'receita'].iterrows():
-            if pd.notna(trans['amount']) and trans['amount'] != '':
-                movements.append({
-                    'date': trans['date'],
-                    'description': trans['description'],
-                    'type': 'entrada',
-                    'category': trans['category'],
-                    'amount': float(trans['amount']),
-                    'status': 'realizado'
-                })
-        
-        for _, trans in transactions_df[transactions_df['type'] == 'despesa'].iterrows():
-            if pd.notna(trans['amount']) and trans['amount'] != '':
-                movements.append({
-                    'date': trans['date'],
-                    'description': trans['description'],
-                    'type': 'saida',
-                    'category': trans['category'],
-                    'amount': float(trans['amount']),
-                    'status': 'realizado'
-                })
-        
-        # Adiciona contas a receber (APENAS pendentes e vencidas - pagas já viraram transações)
-        for _, rec in receivables_df.iterrows():
-            if pd.notna(rec['amount']) and rec['amount'] != '' and rec['status'] != 'pago':
-                # Define status e data baseado no pagamento
-                if rec['status'] == 'vencido':
-                    status = 'vencido'
-                    date = rec['due_date']
-                    desc = f"{rec['description']} (Vencido)"
-                else:  # pendente
-                    status = 'previsto'
-                    date = rec['due_date']
-                    desc = f"{rec['description']} (A receber)"
-                
-                movements.append({
-                    'date': date,
-                    'description': desc,
-                    'type': 'entrada',
-                    'category': 'assinatura',
-                    'amount': float(rec['amount']),
-                    'status': status
-                })
-        
-        # Adiciona contas a pagar (APENAS pendentes e vencidas - pagas já viraram transações)
-        for _, pay in payables_df.iterrows():
-            if pd.notna(pay['amount']) and pay['amount'] != '' and pay['status'] != 'pago':
-                # Define status e data baseado no pagamento
-                if pay['status'] == 'vencido':
-                    status = 'vencido'
-                    date = pay['due_date']
-                    desc = f"{pay['description']} (Vencido)"
-                else:  # pendente
-                    status = 'previsto'
-                    date = pay['due_date']
-                    desc = f"{pay['description']} (A pagar)"
-                
-                movements.append({
-                    'date': date,
-                    'description': desc,
-                    'type': 'saida',
-                    'category': pay.get('category', 'Outros'),
-                    'amount': float(pay['amount']),
-                    'status': status
-                })
-        
-        # Ordena por data
-        movements.sort(key=lambda x: x['date'], reverse=True)
+        # Movimentações (transações, contas a receber e a pagar) já ordenadas
+        movements_df = repository.get_derived('cash_flow_movements', CASH_FLOW_TABLES,
+                                              build_cash_flow_movements)
         
         # Aplicar filtros
-        search = request.args.get('search', '').strip()
-        type_filter = request.args.get('type', '')
-        status_filter = request.args.get('status', '')
+        mask = filters.mask('cash_flow', CASH_FLOW_TABLES, movements_df,
+                            CASH_FLOW_FILTERS, request.args)
         
-        movements_filtered = movements.copy()
-        
-        if search:
-            search_lower = search.lower()
-            movements_filtered = [m for m in movements_filtered if 
-                                search_lower in m.get('description', '').lower() or
-                                search_lower in m.get('category', '').lower()]
-        
-        if type_filter:
-            movements_filtered = [m for m in movements_filtered if m.get('type') == type_filter]
-        
-        if status_filter:
-            movements_filtered = [m for m in movements_filtered if m.get('status') == status_filter]
-        
-        # Calcula saldo e totais
-        saldo_atual = 0
-        entradas_mes = 0
-        saidas_mes = 0
-        entradas_previstas = 0
-        saidas_previstas = 0
-        entradas_vencidas = 0
-        saidas_vencidas = 0
+        # Calcula saldo e totais a partir dos agregados diários
+        financial_agg = aggregates.load()
+        realizado = financial_agg[(financial_agg['source'] == 'transacao') &
+                                  financial_agg['type'].isin(['receita', 'despesa'])]
+        receber = financial_agg[financial_agg['source'] == 'receber']
+        pagar = financial_agg[financial_agg['source'] == 'pagar']
         
         today = pd.Timestamp.now()
-        current_month_start = today.replace(day=1)
-        
-        for mov in movements:
-            if mov['status'] == 'realizado':
-                if mov['type'] == 'entrada':
-                    saldo_atual += mov['amount']
-                    if mov['date'] >= current_month_start:
-                        entradas_mes += mov['amount']
-                else:
-                    saldo_atual -= mov['amount']
-                    if mov['date'] >= current_month_start:
-                        saidas_mes += mov['amount']
-            elif mov['status'] == 'previsto':
-                if mov['type'] == 'entrada':
-                    entradas_previstas += mov['amount']
-                else:
-                    saidas_previstas += mov['amount']
-            elif mov['status'] == 'vencido':
-                if mov['type'] == 'entrada':
-                    entradas_vencidas += mov['amount']
-                else:
-                    saidas_vencidas += mov['amount']
-        
-        # Paginação
-        page = request.args.get('page', 1, type=int)
-        per_page = 15
-        total = len(movements_filtered)
-        total_pages = (total + per_page - 1) // per_page
-        
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
-        # Formata movimentações para exibição
-        movements_display = []
-        for mov in movements_filtered[start_idx:end_idx]:
-            mov_display = mov.copy()
-            mov_display['date'] = mov['date'].strftime('%d/%m/%Y')
-            movements_display.append(mov_display)
+        current_month_start = today.normalize().replace(day=1)
+        
+        totals = realizado.groupby('type')['total'].sum()
+        month_totals = realizado[realizado['date'] >= current_month_start].groupby('type')['total'].sum()
+        saldo_atual = int(totals.get('receita', 0)) - int(totals.get('despesa', 0))
+        entradas_mes = int(month_totals.get('receita', 0))
+        saidas_mes = int(month_totals.get('despesa', 0))
+        
+        # Pendentes viram "previsto"; pagas já estão nas transações
+        entradas_previstas = int(receber.loc[~receber['status'].isin(['pago', 'vencido']), 'total'].sum())
+        saidas_previstas = int(pagar.loc[~pagar['status'].isin(['pago', 'vencido']), 'total'].sum())
+        entradas_vencidas = int(receber.loc[receber['status'] == 'vencido', 'total'].sum())
+        saidas_vencidas = int(pagar.loc[pagar['status'] == 'vencido', 'total'].sum())
+        
+        # Paginação pela chave (data decrescente, seq); formata apenas as movimentações da página
+        pager = pagination.paginate('cash_flow', CASH_FLOW_TABLES, movements_df,
+                                    [('date', False), ('seq', True)], mask, request.args)
+        page_df = pager.rows.drop(columns=['seq'])
+        page_df['date'] = page_df['date'].dt.strftime('%d/%m/%Y')
+        page_df[['type', 'status']] = page_df[['type', 'status']].astype(str)
+        movements_display = page_df.to_dict('records')
         
         # Dados para gráfico (últimos 30 dias - apenas realizados)
-        last_30_days = [today - pd.Timedelta(days=i) for i in range(30)]
-        last_30_days.reverse()
-        
-        chart_labels = []
-        chart_balances = []
-        chart_entradas = []
-        chart_saidas = []
-        
-        running_balance = 0
-        for day in last_30_days:
-            day_movements = [m for m in movements if m['date'].date() == day.date() and m['status'] == 'realizado']
-            
-            day_entrada = sum(m['amount'] for m in day_movements if m['type'] == 'entrada')
-            day_saida = sum(m['amount'] for m in day_movements if m['type'] == 'saida')
-            
-            running_balance += (day_entrada - day_saida)
-            
-            chart_labels.append(day.strftime('%d/%m'))
-            chart_balances.append(running_balance)
-            chart_entradas.append(day_entrada)
-            chart_saidas.append(day_saida)
+        last_30_days = pd.date_range(end=today.normalize(), periods=30, freq='D')
+        daily = (realizado[realizado['date'] >= last_30_days[0]]
+                 .pivot_table(index='date', columns='type', values='total', aggfunc='sum')
+                 .reindex(index=last_30_days, columns=['receita', 'despesa'])
+                 .fillna(0).astype('int64'))
+        
+        # Gráfico em reais
+        chart_labels = [day.strftime('%d/%m') for day in last_30_days]
+        chart_entradas = [v / 100 for v in daily['receita']]
+        chart_saidas = [v / 100 for v in daily['despesa']]
+        chart_balances = [v / 100 for v in (daily['receita'] - daily['despesa']).cumsum()]
         
         chart_data = {
             'labels': chart_labels,
@@ -2456,9 +2301,10 @@ def cash_flow():
                              entradas_vencidas=entradas_vencidas,
                              saidas_vencidas=saidas_vencidas,
                              chart_data=chart_data,
-                             page=page,
-                             total_pages=total_pages,
-                             total=total)
+                             pager=pager,
+                             page=pager.page,
+                             total_pages=pager.total_pages,
+                             total=pager.total)
     except Exception as e:
         flash(f'Erro ao carregar fluxo de caixa: {str(e)}', 'danger')
         return render_template('admin/financial/cash_flow.html',
@@ -2484,64 +2330,62 @@ def dre_report():
         current_year = datetime.now().year
         year = int(request.args.get('year', current_year))
         
-        # Carrega transações financeiras do ano
-        transactions_df = pd.read_csv(os.path.join(DATA_DIR, 'financial_transactions.csv'))
-        transactions_df['date'] = pd.to_datetime(transactions_df['date'])
-        year_transactions = transactions_df[transactions_df['date'].dt.year == year]
-        
-        # Carrega contas a pagar PENDENTES para incluir nas despesas
-        payables_df = pd.read_csv(os.path.join(DATA_DIR, 'accounts_payable.csv'))
-        payables_df['due_date'] = pd.to_datetime(payables_df['due_date'])
-        year_payables = payables_df[(payables_df['due_date'].dt.year == year) & 
-                                     (payables_df['status'] == 'pendente')]
+        # Agregados diários do ano: transações e contas a pagar PENDENTES
+        financial_agg = aggregates.load()
+        year_agg = financial_agg[financial_agg['year'] == year]
+        year_receitas = year_agg[(year_agg['source'] == 'transacao') & (year_agg['type'] == 'receita')]
+        year_despesas = year_agg[(year_agg['source'] == 'transacao') & (year_agg['type'] == 'despesa')]
+        year_payables = year_agg[(year_agg['source'] == 'pagar') & (year_agg['status'] == 'pendente')]
         
         # Agrupa receitas por categoria
-        receitas_grouped = year_transactions[year_transactions['type'] == 'receita'].groupby('category')['amount'].sum()
-        receitas_detalhadas = [{'name': cat, 'amount': float(amt)} for cat, amt in receitas_grouped.items()]
+        receitas_grouped = year_receitas.groupby('category')['total'].sum()
+        receitas_detalhadas = [{'name': cat, 'amount': int(amt)} for cat, amt in receitas_grouped.items()]
         
         # Agrupa despesas por categoria (transações + contas a pagar PENDENTES)
-        despesas_grouped = year_transactions[year_transactions['type'] == 'despesa'].groupby('category')['amount'].sum()
-        despesas_detalhadas = [{'name': cat, 'amount': float(amt)} for cat, amt in despesas_grouped.items()]
+        despesas_grouped = year_despesas.groupby('category')['total'].sum()
+        despesas_detalhadas = [{'name': cat, 'amount': int(amt)} for cat, amt in despesas_grouped.items()]
         
         # Adiciona contas a pagar PENDENTES agrupadas por categoria
-        payables_grouped = year_payables.groupby('category')['amount'].sum()
+        payables_grouped = year_payables.groupby('category')['total'].sum()
         for cat, amt in payables_grouped.items():
             # Procura se a categoria já existe nas despesas
             found = False
             for desp in despesas_detalhadas:
                 if desp['name'] == cat:
-                    desp['amount'] += float(amt)
+                    desp['amount'] += int(amt)
                     found = True
                     break
             if not found:
-                despesas_detalhadas.append({'name': cat, 'amount': float(amt)})
+                despesas_detalhadas.append({'name': cat, 'amount': int(amt)})
         
         # Calcula totais
-        receita_bruta = float(receitas_grouped.sum()) if not receitas_grouped.empty else 0
+        receita_bruta = int(receitas_grouped.sum()) if not receitas_grouped.empty else 0
         despesas_totais = sum(item['amount'] for item in despesas_detalhadas)
         resultado_liquido = receita_bruta - despesas_totais
         
         # Dados mensais para gráfico de evolução
+        months = range(1, 13)
+        receitas_by_month = year_receitas.groupby('month')['total'].sum().reindex(months, fill_value=0)
+        despesas_by_month = year_despesas.groupby('month')['total'].sum().reindex(months, fill_value=0)
+        payables_by_month = year_payables.groupby('month')['total'].sum().reindex(months, fill_value=0)
+        
         monthly_receitas = []
         monthly_despesas = []
         monthly_resultado = []
-        for month in range(1, 13):
-            month_data = year_transactions[year_transactions['date'].dt.month == month]
-            month_payables = year_payables[year_payables['due_date'].dt.month == month]
+        for month in months:
+            rec = int(receitas_by_month[month])
+            desp = int(despesas_by_month[month]) + int(payables_by_month[month])  # Apenas pendentes
             
-            rec = float(month_data[month_data['type'] == 'receita']['amount'].sum())
-            desp = float(month_data[month_data['type'] == 'despesa']['amount'].sum())
-            desp += float(month_payables['amount'].sum())  # Apenas pendentes
-            
-            monthly_receitas.append(rec)
-            monthly_despesas.append(desp)
-            monthly_resultado.append(rec - desp)
+            # Gráficos em reais
+            monthly_receitas.append(rec / 100)
+            monthly_despesas.append(desp / 100)
+            monthly_resultado.append((rec - desp) / 100)
         
         # Dados para gráficos de pizza
         receitas_labels = [item['name'] for item in receitas_detalhadas]
-        receitas_data = [item['amount'] for item in receitas_detalhadas]
+        receitas_data = [item['amount'] / 100 for item in receitas_detalhadas]
         despesas_labels = [item['name'] for item in despesas_detalhadas]
-        despesas_data = [item['amount'] for item in despesas_detalhadas]
+        despesas_data = [item['amount'] / 100 for item in despesas_detalhadas]
         
         # Prepara os dados para o template
         years = range(current_year - 5, current_year + 1)
@@ -2595,26 +2439,130 @@ def get_vehicles_by_customer(customer_id):
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/vehicles/plates')
+@login_required
+def lookup_plates():
+    """Veículos pela placa exata (exact=1) ou pelo começo dela, em ordem de
+    placa; placas antigas e Mercosul (ABC1234 / ABC1C34) valem como a mesma.
+    Aberto a qualquer usuário logado: os atendentes consultam na portaria"""
+    term = request.args.get('q', '')
+    exact = request.args.get('exact') == '1'
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    vehicles = []
+    for vehicle_id in search_index.find_plates(term, prefix=not exact, limit=limit):
+        vehicle = get_record_by_id('vehicles.csv', vehicle_id)
+        if vehicle is None:
+            continue
+        customer = get_record_by_id('customers.csv', vehicle['customer_id'])
+        vehicles.append({
+            'id': int(vehicle['id']),
+            'plate': str(vehicle['plate']).upper(),
+            'customer_id': int(customer['id']) if customer else None,
+            'customer_name': str(customer['name']) if customer else '',
+            'brand': str(vehicle['brand']) if pd.notna(vehicle['brand']) else '',
+            'model': str(vehicle['model']) if pd.notna(vehicle['model']) else '',
+            'color': str(vehicle['color']) if pd.notna(vehicle['color']) else '',
+            'status': str(vehicle['status']) if pd.notna(vehicle['status']) else ''
+        })
+    return jsonify(vehicles)
+
+def autocomplete_args():
+    """(termo, offset, limit) dos endpoints de autocomplete"""
+    term = request.args.get('q', '').strip()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    return term, offset, limit
+
+def autocomplete_response(results, total, offset, limit):
+    """Página no formato dos selects com busca (select2): results, total e more"""
+    return jsonify({'results': results, 'total': total, 'more': offset + limit < total})
+
+@app.route('/api/customers/search')
+@login_required
+def autocomplete_customers():
+    """Clientes por nome, CPF ou placa, em ordem de nome"""
+    term, offset, limit = autocomplete_args()
+    ids, total = search_index.customers_page(term, offset, limit)
+    results = []
+    for customer in filter(None, map(get_customer_by_id, ids)):
+        results.append({
+            'id': int(customer['id']),
+            'text': str(customer['name']),
+            'cpf': str(customer['cpf']) if pd.notna(customer['cpf']) else ''
+        })
+    return autocomplete_response(results, total, offset, limit)
+
+@app.route('/api/vehicles/search')
+@login_required
+def autocomplete_vehicles():
+    """Veículos pela placa (e pelo dono, com customer), em ordem de placa"""
+    term, offset, limit = autocomplete_args()
+    customer_id = request.args.get('customer', type=int)
+    ids, total = search_index.vehicles_page(term, customer_id, offset, limit)
+    results = []
+    for vehicle in filter(None, map(get_vehicle_by_id, ids)):
+        results.append({
+            'id': int(vehicle['id']),
+            'text': vehicle_label(vehicle),
+            'plate': str(vehicle['plate']),
+            'customer_id': int(vehicle['customer_id']) if pd.notna(vehicle['customer_id']) else None
+        })
+    return autocomplete_response(results, total, offset, limit)
+
+@app.route('/api/plans/search')
+@admin_required
+def autocomplete_plans():
+    """Planos ativos pelo nome, em ordem de nome"""
+    term, offset, limit = autocomplete_args()
+    plans_df = read_csv_cached('plans.csv', columns=['id', 'name', 'price', 'duration_days', 'is_active'])
+    plans_df = plans_df[plans_df['is_active'] == True]
+    if term:
+        names = plans_df['name'].map(search_index.normalize_text)
+        plans_df = plans_df[names.str.contains(search_index.normalize_text(term), regex=False)]
+    page_df = plans_df.sort_values(['name', 'id']).iloc[offset:offset + limit]
+    results = [{
+        'id': int(plan['id']),
+        'text': plan_label(plan),
+        'name': str(plan['name']),
+        'price': float(from_cents(plan['price'])) if pd.notna(plan['price']) else None,
+        'duration_days': int(plan['duration_days']) if pd.notna(plan['duration_days']) else None
+    } for plan in page_df.to_dict('records')]
+    return autocomplete_response(results, len(plans_df), offset, limit)
+
+@app.route('/api/admin/data-stats')
+@admin_required
+def data_stats():
+    """Contadores da camada de dados (cache, índices e escritas) por tabela"""
+    return jsonify(repository.get_stats())
+
+@app.route('/api/admin/cache-stats')
+@admin_required
+def cache_stats():
+    """Memória de cada tabela em cache, orçamento e hits/misses/evicções"""
+    return jsonify(repository.cache_usage())
+
+@app.cli.command('generate-receivables')
+def generate_receivables_command():
+    """Gera contas a receber para assinaturas que ainda não têm (rodar via cron)"""
+    created = generate_receivables()
+    print(f'{created} conta(s) a receber gerada(s)')
+
+@app.cli.command('rebuild-aggregates')
+def rebuild_aggregates_command():
+    """Recalcula a tabela de agregados financeiros a partir dos lançamentos"""
+    buckets = aggregates.rebuild()
+    print(f'{buckets} agregado(s) recalculado(s)')
+
 if __name__ == '__main__':
     # Criação dos diretórios e arquivos CSV se não existirem
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
     
-    # Estrutura de arquivos CSV
-    files_to_create = {
-        'users.csv': ['id', 'username', 'password_hash', 'role', 'name', 'created_at', 'updated_at'],
-        'customers.csv': ['id', 'name', 'email', 'phone', 'cpf', 'address', 'created_at', 'updated_at'],
-        'vehicles.csv': ['id', 'customer_id', 'plate', 'model', 'color', 'created_at'],
-        'plans.csv': ['id', 'name', 'description', 'price', 'duration_days', 'is_active', 'created_at', 'updated_at'],
-        'subscriptions.csv': ['id', 'customer_id', 'vehicle_id', 'plan_id', 'start_date', 'end_date', 'status', 'created_at'],
-        'payments.csv': ['id', 'subscription_id', 'amount', 'payment_date', 'payment_method', 'status', 'created_at'],
-        'financial_transactions.csv': ['id', 'description', 'amount', 'date', 'category', 'type', 'related_id', 'created_at']
-    }
-    
-    # Cria os arquivos CSV iniciais se não existirem
-    for filename, columns in files_to_create.items():
+    # Cria os arquivos CSV iniciais (colunas definidas nos esquemas) se não existirem
+    for filename in repository.TABLE_SCHEMAS:
         filepath = os.path.join(DATA_DIR, filename)
-        if not os.path.exists(filepath):
+        # Tabelas particionadas não têm o arquivo único, só o manifesto
+        if not os.path.exists(filepath) and not os.path.exists(os.path.join(DATA_DIR, manifest_file(filename))):
             if filename == 'users.csv':
                 # Cria usuário admin padrão
                 from werkzeug.security import generate_password_hash
@@ -2627,13 +2575,16 @@ if __name__ == '__main__':
                     'role': 'admin',
                     'name': 'Administrador',
                     'created_at': current_time,
-                    'updated_at': current_time
-                }])
-                users_df.to_csv(filepath, index=False)
+                    'status': 'active'
+                }], columns=repository.table_columns(filename))
+                write_csv_atomic(users_df, filepath)
             else:
                 # Cria arquivo vazio com as colunas definidas
-                df = pd.DataFrame(columns=columns)
-                df.to_csv(filepath, index=False)
+                write_csv_atomic(repository.empty_table(filename), filepath)
+    
+    # Gera as contas a receber pendentes de assinaturas antigas (os agregados
+    # se reconstroem sozinhos se os CSVs foram editados, ver aggregates.load)
+    generate_receivables()
     
     # Inicia o servidor Flask
     # O reloader_type='stat' usa polling ao invés de watchdog, evitando reloads desnecessários
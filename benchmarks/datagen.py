@@ -0,0 +1,209 @@
+"""Gerador de bases sintéticas para os benchmarks.
+
+Cria um diretório data/ completo, com as mesmas colunas das tabelas reais
+(repository.TABLE_SCHEMAS), a partir de um único tamanho: n clientes, n
+veículos, n assinaturas e n transações, mais as contas a receber/pagar
+correspondentes. Os valores seguem as distribuições da aplicação (status,
+categorias, vencimentos em torno de hoje) para que filtros e relatórios
+tenham trabalho real a fazer.
+
+Uso: python benchmarks/datagen.py DESTINO N [--seed 42]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import repository  # noqa: E402
+
+FIRST_NAMES = np.array(['Ana', 'Bruno', 'Carla', 'Diego', 'Eduarda', 'Felipe', 'Gabriela',
+                        'Henrique', 'Isabela', 'João', 'Larissa', 'Márcio', 'Natália', 'Otávio',
+                        'Paula', 'Rafael', 'Sofia', 'Thiago', 'Vanessa', 'William'])
+LAST_NAMES = np.array(['Silva', 'Santos', 'Oliveira', 'Souza', 'Lima', 'Pereira', 'Costa',
+                       'Ferreira', 'Almeida', 'Cardoso', 'Ribeiro', 'Gomes', 'Martins', 'Rocha'])
+CITIES = np.array(['São Paulo', 'Rio de Janeiro', 'Belo Horizonte', 'Curitiba', 'Porto Alegre'])
+BRANDS_MODELS = np.array([('Volkswagen', 'Gol'), ('Fiat', 'Uno'), ('Chevrolet', 'Onix'),
+                          ('Hyundai', 'HB20'), ('Nissan', 'Kicks'), ('Toyota', 'Corolla'),
+                          ('Honda', 'CG 160'), ('Jeep', 'Renegade')])
+COLORS = np.array(['Preto', 'Branco', 'Prata', 'Vermelho', 'Cinza', 'Azul'])
+PLANS = [('Plano Moto', 90.0), ('Plano Hatch', 160.0), ('Plano Sedan', 190.0), ('Plano SUV', 220.0)]
+REVENUE_CATEGORIES = np.array(['Mensalidade', 'Avulso', 'Serviços'])
+EXPENSE_CATEGORIES = np.array(['Aluguel', 'Salários', 'Impostos', 'Manutenção', 'Outros'])
+SUPPLIERS = np.array(['INSS', 'Imobiliária Centro', 'Copel', 'Sanepar', 'Contabilidade Lima'])
+PAYMENT_METHODS = np.array(['dinheiro', 'pix', 'cartao_credito', 'cartao_debito', 'boleto'])
+
+
+def _strings(prefix, values):
+    return np.char.add(prefix, values.astype(str))
+
+
+def _digits(rng, n, length):
+    """Strings numéricas de tamanho fixo (CPF, telefone, RENAVAM...)"""
+    return np.char.zfill(rng.integers(0, 10 ** length, n, dtype=np.int64).astype(str), length)
+
+
+def _dates(base, offsets):
+    return (base + pd.to_timedelta(offsets, unit='D')).strftime('%Y-%m-%d')
+
+
+def _write(data_dir, filename, columns):
+    """Salva a tabela na ordem do esquema; colunas não geradas ficam vazias"""
+    n = len(next(iter(columns.values())))
+    df = pd.DataFrame({column: columns.get(column, np.full(n, '', dtype=object))
+                       for column in repository.table_columns(filename)})
+    df.to_csv(os.path.join(data_dir, filename), index=False)
+    return len(df)
+
+
+def generate(data_dir, n, seed=42, users_csv=None):
+    """Gera todas as tabelas em data_dir; retorna o número de linhas de cada uma.
+
+    users.csv vem da base real (users_csv), para que a sessão do admin (id 1)
+    continue válida.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    today = pd.Timestamp.now().normalize()
+    now = today.strftime('%Y-%m-%d %H:%M:%S')
+    rows = {}
+
+    users_csv = users_csv or os.path.join(ROOT, 'data', 'users.csv')
+    pd.read_csv(users_csv).to_csv(os.path.join(data_dir, 'users.csv'), index=False)
+
+    ids = np.arange(1, n + 1)
+    names = np.char.add(np.char.add(rng.choice(FIRST_NAMES, n), ' '), rng.choice(LAST_NAMES, n))
+    rows['customers.csv'] = _write(data_dir, 'customers.csv', {
+        'id': ids,
+        'name': names,
+        'email': np.char.add(_strings('cliente', ids), '@email.com'),
+        'phone': _digits(rng, n, 11),
+        'cpf': _digits(rng, n, 11),
+        'city': rng.choice(CITIES, n),
+        'state': 'SP',
+        'status': rng.choice(['ativo', 'inativo'], n, p=[0.9, 0.1]),
+        'created_at': now,
+        'birth_date': _dates(today, -rng.integers(18 * 365, 70 * 365, n)),
+    })
+
+    # Um veículo por cliente em média, distribuídos aleatoriamente
+    owners = rng.integers(1, n + 1, n)
+    models = BRANDS_MODELS[rng.integers(0, len(BRANDS_MODELS), n)]
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    plates = np.char.add(np.char.add(np.char.add(rng.choice(letters, n), rng.choice(letters, n)),
+                                     rng.choice(letters, n)), np.char.zfill((ids % 10000).astype(str), 4))
+    rows['vehicles.csv'] = _write(data_dir, 'vehicles.csv', {
+        'id': ids,
+        'customer_id': owners,
+        'plate': plates,
+        'brand': models[:, 0],
+        'model': models[:, 1],
+        'color': rng.choice(COLORS, n),
+        'year': rng.integers(2005, 2026, n),
+        'type': rng.choice(['carro', 'moto'], n, p=[0.85, 0.15]),
+        'renavam': _digits(rng, n, 11),
+        'status': 'ativo',
+        'created_at': now,
+    })
+
+    rows['plans.csv'] = _write(data_dir, 'plans.csv', {
+        'id': np.arange(1, len(PLANS) + 1),
+        'name': [name for name, _ in PLANS],
+        'price': [price for _, price in PLANS],
+        'duration_days': 30,
+        'is_active': True,
+        'created_at': now,
+    })
+
+    # Uma assinatura por veículo, iniciadas nos últimos 90 dias
+    plan_ids = rng.integers(1, len(PLANS) + 1, n)
+    prices = np.array([price for _, price in PLANS])[plan_ids - 1]
+    start_offsets = -rng.integers(0, 90, n)
+    status = np.where(start_offsets + 30 < 0, 'vencida', 'ativa')
+    status[rng.random(n) < 0.05] = 'cancelada'
+    rows['subscriptions.csv'] = _write(data_dir, 'subscriptions.csv', {
+        'id': ids,
+        'customer_id': owners,
+        'vehicle_id': ids,
+        'plan_id': plan_ids,
+        'amount': prices,
+        'start_date': _dates(today, start_offsets),
+        'end_date': _dates(today, start_offsets + 30),
+        'status': status,
+        'created_at': now,
+    })
+
+    # Uma conta a receber por assinatura; as vencidas e parte das demais já pagas
+    due_offsets = start_offsets + 30
+    paid = rng.random(n) < 0.6
+    receivable_status = np.where(paid, 'pago', np.where(due_offsets < 0, 'vencido', 'pendente'))
+    plan_names = np.array([name for name, _ in PLANS])[plan_ids - 1]
+    rows['accounts_receivable.csv'] = _write(data_dir, 'accounts_receivable.csv', {
+        'id': ids,
+        'subscription_id': ids,
+        'customer_id': owners,
+        'description': np.char.add(np.char.add(np.char.add('Assinatura ', plan_names), ' - '), names[owners - 1]),
+        'amount': prices,
+        'due_date': _dates(today, due_offsets),
+        'payment_date': np.where(paid, _dates(today, np.minimum(due_offsets, 0)), ''),
+        'status': receivable_status,
+        'payment_method': np.where(paid, rng.choice(PAYMENT_METHODS, n), ''),
+        'created_at': now,
+    })
+
+    # Transações do último ano: receitas (70%) e despesas
+    is_revenue = rng.random(n) < 0.7
+    rows['financial_transactions.csv'] = _write(data_dir, 'financial_transactions.csv', {
+        'id': ids,
+        'description': np.where(is_revenue, 'Recebimento mensalidade', 'Pagamento fornecedor'),
+        'amount': np.round(rng.uniform(20, 900, n), 2),
+        'date': _dates(today, -rng.integers(0, 365, n)),
+        'category': np.where(is_revenue, rng.choice(REVENUE_CATEGORIES, n), rng.choice(EXPENSE_CATEGORIES, n)),
+        'type': np.where(is_revenue, 'receita', 'despesa'),
+        'related_id': rng.integers(1, n + 1, n),
+        'created_at': now,
+    })
+
+    # Contas a pagar: uma para cada 10 transações, vencendo entre -60 e +60 dias
+    m = max(n // 10, 1)
+    payable_due = rng.integers(-60, 60, m)
+    payable_paid = (payable_due < 0) & (rng.random(m) < 0.7)
+    suppliers = rng.choice(SUPPLIERS, m)
+    rows['accounts_payable.csv'] = _write(data_dir, 'accounts_payable.csv', {
+        'id': np.arange(1, m + 1),
+        'supplier': suppliers,
+        'description': suppliers,
+        'amount': np.round(rng.uniform(50, 3000, m), 2),
+        'due_date': _dates(today, payable_due),
+        'payment_date': np.where(payable_paid, _dates(today, payable_due), ''),
+        'status': np.where(payable_paid, 'pago', np.where(payable_due < 0, 'vencido', 'pendente')),
+        'category': rng.choice(EXPENSE_CATEGORIES, m),
+        'payment_method': np.where(payable_paid, rng.choice(PAYMENT_METHODS, m), ''),
+        'created_at': now,
+    })
+
+    # Demais tabelas só com o cabeçalho; o agregado financeiro é calculado
+    # pela própria aplicação (aggregates.rebuild)
+    for filename in repository.TABLE_SCHEMAS:
+        if filename not in rows and filename not in ('users.csv', 'financial_aggregates.csv'):
+            repository.empty_table(filename).to_csv(os.path.join(data_dir, filename), index=False)
+            rows[filename] = 0
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gera uma base sintética do MC PARK MANAGER')
+    parser.add_argument('data_dir')
+    parser.add_argument('size', type=int, help='clientes/veículos/assinaturas/transações')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    for filename, count in generate(args.data_dir, args.size, args.seed).items():
+        print(f'{filename:<30} {count:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""Benchmark das páginas administrativas sobre bases sintéticas.
+
+Para cada tamanho gera uma base com benchmarks/datagen.py e mede cada rota
+pelo test client do Flask, com a sessão do admin: a primeira requisição
+(cache vazio) e depois `repeat` requisições com o cache carregado. Cada rota
+roda em um processo próprio, para que o pico de memória (RSS) seja só dela.
+
+O resultado sai em JSON (stdout ou --output), uma entrada por tamanho/rota:
+latência p50/p95 em ms, pico de RSS em MB, memória das tabelas em cache e
+linhas lidas das tabelas (contador rows_read do repository) na requisição
+fria e em uma quente. --cache-mb limita o cache (ver MCPARK_CACHE_MB).
+A requisição fria parte dos snapshots binários (data/.snapshots), como no
+app; use --no-snapshots para medir a leitura direta dos CSVs.
+
+Uso:
+    python benchmarks/run.py --sizes 1000 10000 --output resultados.json
+    python benchmarks/run.py --sizes 100000 --routes cash_flow dre_report --backend sqlite
+    python benchmarks/run.py --sizes 100000 --cache-mb 64
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ROUTES = {
+    'admin_dashboard': '/admin',
+    'list_customers': '/admin/customers?search=silva&page=2',
+    'list_vehicles': '/admin/vehicles?search=gol&page=2',
+    'list_subscriptions': '/admin/subscriptions?search=hatch&status=ativa&page=2',
+    'list_plans': '/admin/plans',
+    'accounts_receivable': '/admin/financial/accounts-receivable?status=pendente&page=2',
+    'accounts_payable': '/admin/financial/accounts-payable?status=pendente&page=2',
+    'cash_flow': '/admin/financial/cash-flow?type=entrada&page=2',
+    'dre_report': '/admin/reports/dre',
+}
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def _peak_rss_mb():
+    # ru_maxrss vem em KB no Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _rows_read(stats):
+    return sum(counters.get('rows_read', 0) for counters in stats.values())
+
+
+def _rows_loaded(stats):
+    return sum(counters.get('rows_loaded', 0) for counters in stats.values())
+
+
+def measure_route(data_dir, url, repeat, backend, use_snapshots, cache_mb=None):
+    """Mede uma rota no processo atual (chamado pelo worker)"""
+    # O import do app já configura o repository: as variáveis precisam apontar
+    # para a base sintética antes dele, ou a inicialização mexeria em data/
+    os.environ.update({
+        'MCPARK_DATA_DIR': data_dir,
+        'MCPARK_STORAGE': backend,
+        'MCPARK_SQLITE_PATH': os.path.join(data_dir, 'mcpark.db'),
+        'MCPARK_SNAPSHOTS': '1' if use_snapshots else '0',
+        'MCPARK_CACHE_WATCHER': 'stat',
+        'MCPARK_CACHE_SWR': '0',
+    })
+    if cache_mb:
+        os.environ['MCPARK_CACHE_MB'] = str(cache_mb)
+    else:
+        os.environ.pop('MCPARK_CACHE_MB', None)
+    import aggregates
+    import app as mcpark
+    import repository
+
+    # Como no bootstrap da aplicação, o agregado financeiro já existe ao subir
+    aggregates.rebuild()
+    if use_snapshots:
+        # Snapshots já gravados: a requisição fria mede a carga a partir deles
+        for filename in repository.TABLE_SCHEMAS:
+            repository.read_csv_cached(filename)
+    repository.invalidate_cache()
+    baseline_rss = _peak_rss_mb()
+
+    mcpark.app.config['TESTING'] = True
+    client = mcpark.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+
+    repository.reset_stats()
+    started = time.perf_counter()
+    response = client.get(url)
+    cold_ms = (time.perf_counter() - started) * 1000
+    cold_stats = repository.get_stats()
+
+    timings = []
+    warm_stats = {}
+    for _ in range(repeat):
+        repository.reset_stats()
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append((time.perf_counter() - started) * 1000)
+        warm_stats = repository.get_stats()
+    cache = repository.cache_usage()
+
+    return {
+        'url': url,
+        'status_code': response.status_code,
+        'cold_ms': round(cold_ms, 2),
+        'p50_ms': round(float(np.percentile(timings, 50)), 2),
+        'p95_ms': round(float(np.percentile(timings, 95)), 2),
+        'min_ms': round(min(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'rows_loaded': _rows_loaded(cold_stats),
+        'rows_scanned_cold': _rows_read(cold_stats),
+        'rows_scanned_warm': _rows_read(warm_stats),
+        'cache_mb': round(cache['total_bytes'] / 1024 / 1024, 1),
+        'evictions_warm': cache['evictions'],
+        'response_bytes': len(response.data),
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def run_worker(data_dir, route, repeat, backend, use_snapshots, cache_mb=None):
+    """Roda measure_route em um processo novo e devolve o resultado"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', data_dir, route,
+               '--repeat', str(repeat), '--backend', backend]
+    if not use_snapshots:
+        command.append('--no-snapshots')
+    if cache_mb:
+        command += ['--cache-mb', str(cache_mb)]
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=ROOT)
+    if completed.returncode != 0:
+        return {'url': ROUTES[route], 'error': completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=ROOT).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark das rotas administrativas')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--routes', nargs='+', choices=sorted(ROUTES), default=list(ROUTES))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--backend', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-snapshots', action='store_true',
+                        help='carga a frio sempre pelo CSV (sem data/.snapshots)')
+    parser.add_argument('--cache-mb', type=float, help='orçamento de memória do cache (padrão: sem limite)')
+    parser.add_argument('--data-root', help='mantém as bases geradas neste diretório')
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: stdout)')
+    parser.add_argument('--worker', nargs=2, metavar=('DATA_DIR', 'ROUTE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Como no app, snapshots só valem para o backend CSV
+    use_snapshots = not args.no_snapshots and args.backend == 'csv'
+
+    if args.worker:
+        data_dir, route = args.worker
+        print(json.dumps(measure_route(data_dir, ROUTES[route], args.repeat, args.backend, use_snapshots,
+                                       args.cache_mb)))
+        return
+
+    import pandas as pd
+    import datagen
+
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'backend': args.backend,
+            'snapshots': use_snapshots,
+            'cache_mb': args.cache_mb,
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+        },
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            data_dir = os.path.join(args.data_root or tmp, f'data_{size}')
+            if not os.path.exists(os.path.join(data_dir, 'customers.csv')):
+                started = time.perf_counter()
+                datagen.generate(data_dir, size, seed=args.seed)
+                print(f'base {size}: gerada em {time.perf_counter() - started:.1f}s', file=sys.stderr)
+            for route in args.routes:
+                result = run_worker(data_dir, route, args.repeat, args.backend, use_snapshots, args.cache_mb)
+                report['results'].append({'size': size, 'route': route, **result})
+                if 'error' in result:
+                    print(f'{size:>9} {route:<22} ERRO {result["error"]}', file=sys.stderr)
+                else:
+                    print(f'{size:>9} {route:<22} p50 {result["p50_ms"]:>9.1f} ms  '
+                          f'p95 {result["p95_ms"]:>9.1f} ms  RSS {result["peak_rss_mb"]:>7.1f} MB  '
+                          f'cache {result["cache_mb"]:>7.1f} MB  '
+                          f'linhas {result["rows_scanned_warm"]:>9}', file=sys.stderr)
+            if not args.data_root:
+                # Libera o espaço da base antes do próximo tamanho
+                shutil.rmtree(data_dir)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Filtros declarativos das listagens administrativas do MC PARK MANAGER.
+
+Cada listagem descreve os seus filtros em um dicionário parâmetro -> filtro:
+
+    ('text', [colunas])         as colunas contêm o termo, sem diferenciar
+                                acentos e maiúsculas
+    ('equals', coluna[, tipo])  a coluna é igual ao valor (convertido por tipo)
+    ('ids', coluna, busca)      a coluna está entre os ids de busca(termo),
+                                uma busca do search_index
+    ('mask', função)            máscara de função(frame, valor)
+    ('any', [filtros])          algum dos filtros (com o mesmo valor)
+
+mask() junta em uma máscara booleana os filtros dos parâmetros preenchidos.
+Igualdades usam um índice valor -> posições e os textos ficam normalizados
+(search_index.normalize_text), ambos memorizados até as tabelas mudarem.
+
+Todo backend de armazenamento é lido pelo cache do repository, então os
+filtros sempre rodam sobre os DataFrames em memória.
+"""
+import numpy as np
+import pandas as pd
+
+import repository
+import search_index
+
+
+def _value_index(frame, column):
+    """(valores distintos, posições ordenadas por valor, limites de cada valor)"""
+    codes, uniques = pd.factorize(frame[column])
+    order = np.argsort(codes, kind='stable')
+    # Vazios (código -1) ficam antes do primeiro limite
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    return pd.Index(uniques), order, bounds
+
+
+def _text_column(frame, columns):
+    """Colunas juntas em um texto minúsculo e sem acentos por linha"""
+    text = frame[columns[0]].fillna('').astype(str)
+    for column in columns[1:]:
+        text = text + '\n' + frame[column].fillna('').astype(str)
+    return text.map(search_index.normalize_text)
+
+
+def _equals(name, tables, frame, column, value):
+    values, order, bounds = repository.get_derived_for(
+        f'filters:{name}:{column}', tables, frame, lambda frame: _value_index(frame, column))
+    selected = np.zeros(len(frame), dtype=bool)
+    position = values.get_indexer([value])[0]
+    if position >= 0:
+        selected[order[bounds[position]:bounds[position + 1]]] = True
+    return pd.Series(selected, index=frame.index)
+
+
+def _compile(name, tables, frame, spec, value):
+    kind = spec[0]
+    if kind == 'text':
+        text = repository.get_derived_for(
+            f'filters:{name}:text:{",".join(spec[1])}', tables, frame,
+            lambda frame: _text_column(frame, spec[1]))
+        return text.str.contains(search_index.normalize_text(value), regex=False)
+    if kind == 'equals':
+        if len(spec) > 2:
+            try:
+                value = spec[2](value)
+            except (TypeError, ValueError):
+                # Valor que a coluna não pode ter: nada passa
+                return pd.Series(False, index=frame.index)
+        return _equals(name, tables, frame, spec[1], value)
+    if kind == 'ids':
+        return frame[spec[1]].isin(spec[2](value))
+    if kind == 'mask':
+        return spec[1](frame, value)
+    if kind == 'any':
+        selected = pd.Series(False, index=frame.index)
+        for part in spec[1]:
+            selected |= _compile(name, tables, frame, part, value)
+        return selected
+    raise ValueError(f'Filtro desconhecido: {kind}')
+
+
+def mask(name, tables, frame, specs, args):
+    """Máscara das linhas de frame que passam nos filtros de specs com valor
+    em args (parâmetros da requisição); name e tables como em
+    pagination.paginate"""
+    selected = pd.Series(True, index=frame.index)
+    for param, spec in specs.items():
+        value = (args.get(param) or '').strip()
+        if value:
+            selected &= _compile(name, tables, frame, spec, value)
+    return selected
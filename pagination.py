@@ -0,0 +1,164 @@
+"""Paginação por cursor (keyset) das listagens administrativas do MC PARK MANAGER.
+
+Cada listagem tem um índice ordenado pelas suas colunas de ordenação
+(numéricas ou datas, terminando em uma coluna única, como o id), guardado
+com repository.get_derived até alguma tabela de origem mudar. Uma página
+parte do cursor (a chave da última ou da primeira linha exibida, codificada
+em base64) ou do número da página, conta os registros que passam nos filtros
+em vez de montar listas, e só as linhas exibidas viram dicionários.
+"""
+import base64
+import binascii
+import json
+
+import numpy as np
+import pandas as pd
+
+import repository
+
+PER_PAGE = 15
+
+
+class Page:
+    """Linhas de uma página (DataFrame) e a posição dela na listagem"""
+
+    def __init__(self, rows, offset, total, per_page, next_cursor, prev_cursor):
+        self.rows = rows
+        self.offset = offset
+        self.total = total
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def page(self):
+        return self.offset // self.per_page + 1
+
+    @property
+    def total_pages(self):
+        return (self.total + self.per_page - 1) // self.per_page
+
+    @property
+    def first(self):
+        return self.offset + 1 if len(self.rows) else 0
+
+    @property
+    def last(self):
+        return self.offset + len(self.rows)
+
+
+def _sort_key(series, ascending):
+    """Coluna em valores crescentes na ordem pedida (vazios sempre no fim)"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        values = series.to_numpy(dtype='datetime64[ns]')
+        missing = np.isnat(values)
+        values = values.view(np.int64)
+        values = values if ascending else -values
+        return np.where(missing, np.iinfo(np.int64).max, values)
+    if pd.api.types.is_integer_dtype(series) and not series.isna().any():
+        values = series.to_numpy(dtype=np.int64)
+        return values if ascending else -values
+    values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+    values = values if ascending else -values
+    return np.where(np.isnan(values), np.inf, values)
+
+
+def _build_index(frame, order_by):
+    """Ordem das linhas pelas colunas (None se o frame já está nela) e as
+    chaves de ordenação já ordenadas"""
+    keys = [_sort_key(frame[column], ascending) for column, ascending in order_by]
+    # lexsort ordena pela última chave primeiro
+    order = np.lexsort(keys[::-1]) if keys and len(frame) else np.arange(len(frame))
+    if np.array_equal(order, np.arange(len(frame))):
+        return None, keys
+    return order, [key[order] for key in keys]
+
+
+def sorted_index(name, tables, frame, order_by):
+    """Índice ordenado da listagem, memorizado enquanto as tabelas não mudam
+    (frame: DataFrame do cache ou derivado dele, ver get_derived_for)"""
+    return repository.get_derived_for(f'pagination:{name}', tables, frame,
+                                      lambda frame: _build_index(frame, order_by))
+
+
+def encode_cursor(values):
+    data = json.dumps([value.item() for value in values]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Chave do cursor, ou None se ele não é válido para a listagem"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if (not isinstance(values, list) or len(values) != size or
+            not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                    for value in values)):
+        return None
+    return values
+
+
+def _bound(keys, values, after):
+    """Posição ordenada logo depois (after) ou logo antes da chave do cursor"""
+    lo, hi = 0, len(keys[0]) if keys else 0
+    for key, value in zip(keys, values):
+        value = np.asarray(value).astype(key.dtype)
+        start = lo + int(np.searchsorted(key[lo:hi], value, 'left'))
+        end = lo + int(np.searchsorted(key[lo:hi], value, 'right'))
+        if start == end:
+            return start
+        lo, hi = start, end
+    return hi if after else lo
+
+
+def paginate(name, tables, frame, order_by, mask=None, args=None, per_page=PER_PAGE):
+    """Página da listagem ordenada por order_by ([(coluna, crescente), ...]).
+
+    mask (Series booleana alinhada ao frame) filtra as linhas; args são os
+    parâmetros da requisição: 'after' e 'before' (cursores de
+    Page.next_cursor/prev_cursor) ou 'page' (número da página).
+    """
+    args = args if args is not None else {}
+    order, keys = sorted_index(name, tables, frame, order_by)
+
+    # Posições ordenadas das linhas que passam nos filtros
+    if mask is None:
+        positions = None
+        total = len(frame)
+    else:
+        selected = np.asarray(mask, dtype=bool)
+        positions = np.flatnonzero(selected if order is None else selected[order])
+        total = len(positions)
+
+    def offset_of(position):
+        return position if positions is None else int(np.searchsorted(positions, position))
+
+    after = decode_cursor(args.get('after') or '', len(keys))
+    before = decode_cursor(args.get('before') or '', len(keys))
+    if after is not None:
+        start = offset_of(_bound(keys, after, after=True))
+    elif before is not None:
+        start = max(offset_of(_bound(keys, before, after=False)) - per_page, 0)
+    else:
+        try:
+            page = max(int(args.get('page', 1)), 1)
+        except (TypeError, ValueError):
+            page = 1
+        start = (page - 1) * per_page
+    if start >= total:
+        # Além do fim (página inexistente ou linhas removidas): última página
+        start = max((total - 1) // per_page * per_page, 0)
+
+    shown = np.arange(start, min(start + per_page, total))
+    if positions is not None:
+        shown = positions[shown]
+    rows = frame.iloc[shown if order is None else order[shown]]
+
+    def cursor(position):
+        return encode_cursor([key[position] for key in keys])
+
+    next_cursor = cursor(shown[-1]) if start + len(shown) < total else None
+    prev_cursor = cursor(shown[0]) if start > 0 and len(shown) else None
+    return Page(rows, start, total, per_page, next_cursor, prev_cursor)
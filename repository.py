@@ -0,0 +1,1235 @@
+"""Camada de acesso a dados do MC PARK MANAGER.
+
+Toda leitura e escrita de tabelas passa por aqui: o cache em memória
+(invalidado por assinatura de arquivo ou pelo watcher inotify, LRU com
+orçamento de memória opcional), os índices por chave primária, os esquemas
+de cada tabela e os contadores de uso.
+O backend físico (CSV ou SQLite) é definido em configure().
+
+Vários processos podem usar o mesmo data_dir: as transações de escrita são
+serializadas entre eles pelo backend e cada tabela tem uma versão (a
+assinatura do arquivo) para escritas otimistas (ver read_versioned).
+
+As tabelas de PARTITIONED_TABLES ficam em partições por mês no backend CSV;
+read_period e read_latest leem só as partições de que a consulta precisa.
+"""
+import functools
+import io
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+import numpy as np
+import pandas as pd
+
+from storage import UNDATED, InotifyWatcher, SnapshotCache, partitioned_table
+
+# Copy-on-write: as cópias rasas que read_csv_cached entrega só duplicam os
+# dados quando alguém escreve nelas, então o cache nunca é alterado por
+# engano. Vale para todo o processo, qualquer que seja o módulo que importa este
+pd.set_option('mode.copy_on_write', True)
+
+SNAPSHOT_DIR = '.snapshots'
+# Muda quando a conversão de _apply_schema muda: snapshots antigos são descartados
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MIN_ROWS = 10000  # Abaixo disso o CSV é lido tão rápido quanto o snapshot
+MEMORY_SAMPLE_ROWS = 20000  # Acima disso o texto das tabelas é medido por amostra (ver _frame_bytes)
+CONFLICT_RETRIES = 3  # Tentativas de retry_on_conflict
+SEQUENCE_TABLE = 'sequences.csv'  # Último id reservado de cada tabela (ver allocate_ids)
+ID_BLOCK_SIZE = 64  # Ids reservados de uma vez em sequences.csv por processo
+# Tabelas que só crescem, particionadas por mês pela coluna de data (ver read_period)
+PARTITIONED_TABLES = {
+    'financial_transactions.csv': 'date',
+    'vehicle_movements.csv': 'date_time',
+}
+
+# Esquema de cada tabela: coluna -> tipo lógico, na ordem das colunas do
+# arquivo. Na carga, 'str' e 'category' são lidas como texto (telefone, CPF e
+# RENAVAM não viram float), 'category' vira pd.Categorical (status, tipos e
+# categorias, com poucos valores distintos) e 'date'/'datetime' viram
+# datetime64; 'int', 'float' e 'bool' seguem a inferência do pandas.
+# 'money' fica em reais no arquivo e em centavos (int64) no cache e em toda a
+# API deste módulo: leituras devolvem e escritas recebem centavos
+TABLE_SCHEMAS = {
+    'users.csv': {
+        'id': 'int', 'username': 'str', 'password_hash': 'str', 'role': 'str', 'name': 'str',
+        'email': 'str', 'phone': 'str', 'created_at': 'datetime', 'last_login': 'datetime',
+        'status': 'str',
+    },
+    'customers.csv': {
+        'id': 'int', 'name': 'str', 'email': 'str', 'phone': 'str', 'cpf': 'str', 'rg': 'str',
+        'date_of_birth': 'date', 'address': 'str', 'address_number': 'str', 'complement': 'str',
+        'neighborhood': 'str', 'city': 'str', 'state': 'category', 'zip_code': 'str', 'notes': 'str',
+        'status': 'category', 'created_at': 'datetime', 'updated_at': 'datetime', 'phone2': 'str',
+        'birth_date': 'date', 'cep': 'str', 'street': 'str', 'number': 'str',
+    },
+    'vehicles.csv': {
+        'id': 'int', 'customer_id': 'int', 'plate': 'str', 'brand': 'str', 'model': 'str',
+        'color': 'str', 'year': 'int', 'type': 'category', 'renavam': 'str', 'chassis': 'str',
+        'notes': 'str', 'status': 'category', 'created_at': 'datetime', 'updated_at': 'datetime',
+    },
+    'plans.csv': {
+        'id': 'int', 'name': 'str', 'description': 'str', 'price': 'money', 'duration_days': 'int',
+        'is_active': 'bool', 'created_at': 'datetime', 'updated_at': 'datetime',
+    },
+    'subscriptions.csv': {
+        'id': 'int', 'customer_id': 'int', 'vehicle_id': 'int', 'plan_id': 'int', 'amount': 'money',
+        'start_date': 'date', 'end_date': 'date', 'status': 'category', 'created_at': 'datetime',
+        'updated_at': 'datetime',
+    },
+    'payments.csv': {
+        'id': 'int', 'subscription_id': 'int', 'amount': 'money', 'payment_date': 'date',
+        'payment_method': 'category', 'status': 'category', 'created_at': 'datetime',
+    },
+    'financial_transactions.csv': {
+        'id': 'int', 'description': 'str', 'amount': 'money', 'date': 'date', 'category': 'category',
+        'type': 'category', 'related_id': 'int', 'created_at': 'datetime',
+    },
+    'accounts_receivable.csv': {
+        'id': 'int', 'subscription_id': 'int', 'customer_id': 'int', 'description': 'str',
+        'amount': 'money', 'due_date': 'date', 'payment_date': 'date', 'status': 'category',
+        'payment_method': 'category', 'notes': 'str', 'created_at': 'datetime', 'updated_at': 'datetime',
+    },
+    'accounts_payable.csv': {
+        'id': 'int', 'supplier': 'str', 'description': 'str', 'amount': 'money', 'due_date': 'date',
+        'payment_date': 'date', 'status': 'category', 'category': 'category', 'payment_method': 'category',
+        'notes': 'str', 'created_at': 'datetime', 'updated_at': 'datetime',
+    },
+    'cash_flow.csv': {
+        'id': 'int', 'date': 'date', 'description': 'str', 'type': 'category', 'category': 'category',
+        'amount': 'money', 'balance': 'money', 'payment_method': 'category', 'reference_id': 'int',
+        'notes': 'str', 'created_at': 'datetime',
+    },
+    'revenue_categories.csv': {
+        'id': 'int', 'name': 'str', 'description': 'str', 'percentage_allocation': 'float',
+        'is_active': 'bool', 'created_at': 'datetime',
+    },
+    'financial_aggregates.csv': {
+        'year': 'int', 'month': 'int', 'day': 'int', 'source': 'str', 'type': 'str',
+        'status': 'str', 'category': 'str', 'total': 'money', 'count': 'int',
+    },
+    'sequences.csv': {
+        'table': 'str', 'last_id': 'int',
+    },
+    'aggregate_sources.csv': {
+        'table': 'str', 'version': 'str',
+    },
+    'vehicle_documents.csv': {
+        'id': 'int', 'vehicle_id': 'int', 'type': 'str', 'name': 'str', 'filename': 'str',
+        'expiration_date': 'date', 'notes': 'str', 'created_at': 'datetime', 'user_id': 'int',
+    },
+    'vehicle_history.csv': {
+        'id': 'int', 'vehicle_id': 'int', 'action': 'str', 'changes': 'str', 'user_id': 'int',
+        'created_at': 'datetime',
+    },
+    'vehicle_movements.csv': {
+        'id': 'int', 'vehicle_id': 'int', 'type': 'str', 'date_time': 'datetime', 'notes': 'str',
+        'user_id': 'int', 'created_at': 'datetime',
+    },
+    'vehicle_photos.csv': {
+        'id': 'int', 'vehicle_id': 'int', 'filename': 'str', 'description': 'str',
+        'upload_date': 'datetime', 'created_at': 'datetime', 'user_id': 'int',
+    },
+    'vehicle_services.csv': {
+        'id': 'int', 'vehicle_id': 'int', 'type': 'str', 'description': 'str', 'date': 'date',
+        'status': 'str', 'cost': 'money', 'responsible': 'str', 'notes': 'str',
+        'created_at': 'datetime', 'user_id': 'int',
+    },
+}
+
+# Sistema de cache global. CSV_CACHE é um LRU: a ordem é a do último uso (o
+# menos usado primeiro) e, com orçamento (ver configure), as tabelas menos
+# usadas saem quando a soma de CACHE_BYTES passa dele
+CSV_CACHE = OrderedDict()
+CACHE_LOCK = threading.Lock()
+CACHE_SIGNATURES = {}  # Assinatura (mtime/tamanho/inode) de cada arquivo no momento da leitura
+CACHE_BYTES = {}  # Memória de cada tabela em cache (ver _frame_bytes)
+_TABLE_LOCKS = {}  # Lock de carga de cada tabela (ver _load_frame)
+_INVALIDATIONS = Counter()  # Invalidações por tabela (None = todas), para cargas concorrentes
+_REFRESHING = set()  # Tabelas sendo recarregadas em segundo plano (stale-while-revalidate)
+PK_INDEX = {}  # Índices id -> linha, por arquivo (ver get_pk_index)
+DERIVED_CACHE = {}  # Resultados calculados a partir das tabelas (ver get_derived)
+
+# Contadores de uso por tabela (ver get_stats)
+STATS = defaultdict(Counter)
+_STATS_LOCK = threading.Lock()
+
+# Hooks chamados após as escritas, por tabela (ver register_write_hook);
+# WRITE_LOCK serializa as transações de escrita (ver transaction)
+WRITE_HOOKS = defaultdict(list)
+WRITE_LOCK = threading.RLock()
+# Transação de escrita aberta na thread atual (ver transaction)
+_TRANSACTION = threading.local()
+# Tabelas com linhas sendo anexadas ao arquivo e ao cache (ver insert_records);
+# o watcher ignora os eventos delas até o cache ser atualizado
+APPENDING = set()
+# Ids já reservados em sequences.csv e ainda não entregues, por tabela:
+# [próximo id, fim exclusivo]; só mudam dentro de uma transação (ver allocate_ids)
+_ID_BLOCKS = {}
+
+storage = None
+cache_watcher = None
+snapshots = None
+cache_max_bytes = None  # Orçamento do cache em bytes (None = sem limite)
+stale_while_revalidate = False  # Servir a versão em cache enquanto a recarga roda (ver _load_frame)
+
+
+class ConflictError(Exception):
+    """A tabela mudou (em outra thread ou processo) depois da leitura em que
+    uma escrita otimista se baseou"""
+
+
+def configure(backend, data_dir, watch=False, use_snapshots=False, max_cache_bytes=None, serve_stale=False):
+    """Define o backend de armazenamento e, opcionalmente, o watcher inotify,
+    os snapshots binários das tabelas (em data_dir/.snapshots), o orçamento
+    de memória do cache (None = sem limite) e o stale-while-revalidate"""
+    global storage, cache_watcher, snapshots, cache_max_bytes, stale_while_revalidate
+    storage = backend
+    cache_max_bytes = max_cache_bytes
+    stale_while_revalidate = serve_stale
+    restored = storage.recover()
+    if restored:
+        print(f'Aviso: transações interrompidas desfeitas em {", ".join(restored)}')
+    storage.partition_tables(PARTITIONED_TABLES)
+    snapshots = SnapshotCache(os.path.join(data_dir, SNAPSHOT_DIR)) if use_snapshots else None
+    invalidate_cache()
+    _ID_BLOCKS.clear()
+    cache_watcher = None
+    if watch:
+        watcher = InotifyWatcher(data_dir, _on_data_file_changed)
+        if watcher.start():
+            cache_watcher = watcher
+        else:
+            print('Aviso: inotify indisponível, usando verificação por mtime dos arquivos')
+
+
+def table_exists(filename):
+    return _get_cached_frame(filename) is not None
+
+
+def _schema(filename):
+    """Esquema da tabela (o da tabela inteira, para arquivos de partição)"""
+    return TABLE_SCHEMAS.get(partitioned_table(filename) or filename, {})
+
+
+def table_columns(filename):
+    """Colunas declaradas no esquema da tabela (lista vazia se não houver)"""
+    return list(_schema(filename))
+
+
+def empty_table(filename):
+    """DataFrame vazio com as colunas do esquema"""
+    return pd.DataFrame(columns=table_columns(filename))
+
+
+def _count(filename, key, amount=1):
+    with _STATS_LOCK:
+        STATS[filename][key] += amount
+
+
+def get_stats():
+    """Cópia dos contadores: leituras, hits/misses do cache, linhas lidas, etc."""
+    with _STATS_LOCK:
+        return {table: dict(counter) for table, counter in STATS.items()}
+
+
+def reset_stats():
+    with _STATS_LOCK:
+        STATS.clear()
+
+
+def _optimize_dtypes(df, keep=()):
+    """Otimiza tipos de dados para reduzir memória (colunas em keep, como os
+    centavos, ficam em int64: somas e diferenças não podem estourar)"""
+    for col in df.columns:
+        if df[col].dtype == 'int64' and col not in keep:
+            df[col] = pd.to_numeric(df[col], downcast='integer', errors='ignore')
+    return df
+
+
+def _frame_bytes(df, appended=False):
+    """Memória do DataFrame, como memory_usage(deep=True). Acima de
+    MEMORY_SAMPLE_ROWS linhas o texto das colunas object é medido em uma
+    amostra e extrapolado: medir cada string custaria quase tanto quanto a
+    carga. Com appended=True (linhas anexadas a uma tabela já medida) o
+    índice e as categorias, que já estão na conta, ficam de fora."""
+    total = 0 if appended else df.index.memory_usage(deep=True)
+    step = max(len(df) // MEMORY_SAMPLE_ROWS, 1)
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object and step > 1:
+            sample = values.iloc[::step]
+            total += sample.memory_usage(index=False, deep=True) * len(values) / len(sample)
+        elif appended and isinstance(values.dtype, pd.CategoricalDtype):
+            total += values.cat.codes.nbytes
+        else:
+            total += values.memory_usage(index=False, deep=True)
+    return int(total)
+
+
+def _read_dtypes(filename):
+    """dtype do read_csv para as colunas de texto do esquema"""
+    return {col: str for col, kind in _schema(filename).items() if kind in ('str', 'category')}
+
+
+def _as_text(values):
+    """Números vindos do SQLite (colunas importadas como REAL) de volta a
+    texto, sem o '.0' dos inteiros"""
+    text = values.astype(object)
+    present = values.notna()
+    if values.dtype.kind == 'f':
+        integral = present & (values % 1 == 0)
+        text[integral] = values[integral].astype('int64').astype(str)
+        present &= ~integral
+    text[present] = values[present].astype(str)
+    return text
+
+
+def _strip_float_suffix(values):
+    """Texto de uma coluna numérica que já foi salva como float ('9834.0'),
+    sem o '.0' dos inteiros, como _as_text faz com os REAL do SQLite.
+
+    Só confere a coluna inteira quando o primeiro valor tem o sufixo: as
+    colunas de texto comuns (nomes, e-mails) não pagam a varredura.
+    """
+    present = values.dropna()
+    if present.empty or not isinstance(present.iloc[0], str) or not re.fullmatch(r'-?\d+\.0+', present.iloc[0]):
+        return values
+    return values.str.replace(r'^(-?\d+)\.0+$', r'\1', regex=True)
+
+
+def _money_columns(filename):
+    return [col for col, kind in _schema(filename).items() if kind == 'money']
+
+
+def to_cents(value):
+    """Valor em reais (número, Decimal ou texto do formulário) em centavos.
+
+    Valor vazio ou inválido levanta ValueError, como float().
+    """
+    try:
+        return int((Decimal(str(value).strip().replace(',', '.')) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'valor monetário inválido: {value!r}') from None
+
+
+def from_cents(cents):
+    """Centavos em reais (Decimal exato); None se vazio"""
+    if cents is None or pd.isna(cents):
+        return None
+    return Decimal(int(cents)) / 100
+
+
+def _cents(values):
+    """Coluna em reais -> centavos: int64, ou Int64 se houver vazios"""
+    cents = (values.astype('float64') * 100).round()
+    return cents.astype('int64') if cents.notna().all() else cents.astype('Int64')
+
+
+def _to_stored(filename, data):
+    """Centavos -> reais nas colunas 'money', para gravar (DataFrame ou dict)"""
+    columns = [col for col in _money_columns(filename) if col in data]
+    if not columns:
+        return data
+    if isinstance(data, pd.DataFrame):
+        return data.assign(**{col: pd.to_numeric(data[col], errors='coerce').astype('float64') / 100
+                              for col in columns})
+    stored = dict(data)
+    for col in columns:
+        value = pd.to_numeric(stored[col], errors='coerce')
+        stored[col] = float(value) / 100 if pd.notna(value) else None
+    return stored
+
+
+def _apply_schema(filename, df):
+    """Converte as colunas lidas para os tipos do esquema (ver TABLE_SCHEMAS).
+
+    Uma coluna de datas com algum valor que não é data continua texto, para
+    não perder o valor original.
+    """
+    for col, kind in _schema(filename).items():
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if kind == 'money':
+            # Texto que não é número fica como está, como nas datas
+            if values.dtype.kind == 'f' or (values.dtype == object and values.isna().all()):
+                df[col] = _cents(values)
+            elif values.dtype.kind in 'iu':
+                df[col] = values.astype('int64') * 100
+        elif kind in ('date', 'datetime'):
+            if values.dtype.kind != 'M':
+                parsed = pd.to_datetime(values, format='ISO8601', errors='coerce')
+                if parsed.notna().sum() == values.notna().sum():
+                    df[col] = parsed
+        elif kind in ('str', 'category'):
+            if values.dtype == object and kind == 'str' and values.isna().all():
+                # Coluna vazia: NaN float ocupa 8 bytes por linha, não um objeto
+                df[col] = values.astype('float64')
+                continue
+            if values.dtype.kind in 'iuf':
+                values = df[col] = _as_text(values)
+            elif values.dtype == object:
+                values = df[col] = _strip_float_suffix(values)
+            if kind == 'category' and not isinstance(values.dtype, pd.CategoricalDtype):
+                df[col] = values.astype('category')
+    return df
+
+
+def _snapshot_key(filename, signature):
+    """Assinatura do arquivo mais o esquema: mudar o esquema invalida os snapshots"""
+    if signature is None:
+        return None
+    return [signature, sorted(_schema(filename).items()), SNAPSHOT_VERSION]
+
+
+def _in_transaction():
+    return getattr(_TRANSACTION, 'active', False)
+
+
+def _table_lock(filename):
+    """Lock da carga de uma tabela: CACHE_LOCK só protege os dicionários e
+    nunca fica com quem lê um arquivo"""
+    with CACHE_LOCK:
+        return _TABLE_LOCKS.setdefault(filename, threading.RLock())
+
+
+def _cached_entry(filename, revalidate=False, allow_stale=False):
+    """(DataFrame, versão) da entrada do cache se ela puder ser usada, senão None.
+
+    Com o watcher ativo as entradas só saem do cache por evento; sem ele
+    compara a assinatura atual do arquivo com a da última leitura. Dentro de
+    transações a assinatura é sempre conferida: o evento de uma escrita de
+    outro processo pode ainda não ter chegado. Com allow_stale, uma entrada
+    desatualizada ainda é devolvida e a recarga vai para o fundo.
+    """
+    with CACHE_LOCK:
+        if filename not in CSV_CACHE:
+            return None
+        df, signature = CSV_CACHE[filename], CACHE_SIGNATURES[filename]
+    trusted = cache_watcher is not None and not revalidate and not _in_transaction()
+    if not trusted and storage.signature(filename) != signature:
+        if not allow_stale:
+            return None
+        _schedule_refresh(filename)
+        _count(filename, 'stale_hits')
+        return df, signature
+    _count(filename, 'cache_hits')
+    with CACHE_LOCK:
+        if CSV_CACHE.get(filename) is df:
+            CSV_CACHE.move_to_end(filename)
+    return df, signature
+
+
+def _load_frame(filename, force_reload=False, revalidate=False):
+    """(DataFrame do cache, versão); (None, None) se a tabela não existir.
+
+    Só a carga da própria tabela trava: leituras simultâneas da mesma tabela
+    esperam uma única carga (single-flight) e as demais tabelas continuam
+    disponíveis. Com stale_while_revalidate (ver configure) quem encontra a
+    tabela desatualizada fica com a versão em cache enquanto uma thread a
+    recarrega; escritas e leituras versionadas sempre veem a atual.
+    """
+    allow_stale = stale_while_revalidate and not revalidate and not _in_transaction()
+    if not force_reload:
+        entry = _cached_entry(filename, revalidate, allow_stale)
+        if entry is not None:
+            return entry
+    with _table_lock(filename):
+        if not force_reload:
+            # Quem esperou pela carga de outra thread já encontra a tabela pronta
+            entry = _cached_entry(filename, revalidate)
+            if entry is not None:
+                _count(filename, 'load_waits')
+                return entry
+
+        # Lê o arquivo e armazena no cache (assinatura tirada antes da leitura,
+        # para que uma escrita concorrente force nova leitura)
+        _count(filename, 'cache_misses')
+        with CACHE_LOCK:
+            generation = _INVALIDATIONS[filename], _INVALIDATIONS[None]
+        started = time.perf_counter()
+        signature = storage.signature(filename)
+        df = snapshots.load(filename, _snapshot_key(filename, signature)) if snapshots is not None else None
+        if df is not None:
+            _count(filename, 'snapshot_hits')
+        else:
+            try:
+                df = storage.read(filename, dtype=_read_dtypes(filename))
+            except FileNotFoundError:
+                return None, None
+            df = _apply_schema(filename, _optimize_dtypes(df, keep=_money_columns(filename)))
+            if snapshots is not None and len(df) >= SNAPSHOT_MIN_ROWS:
+                snapshots.save(filename, _snapshot_key(filename, signature), df)
+        size = _frame_bytes(df)
+
+        with CACHE_LOCK:
+            # Invalidada durante a leitura (escrita deste processo): o que foi
+            # lido pode ser anterior a ela e, com o watcher, ficaria no cache
+            if generation == (_INVALIDATIONS[filename], _INVALIDATIONS[None]):
+                PK_INDEX.pop(filename, None)
+                _cache_put(filename, df, signature, size)
+        _count(filename, 'rows_loaded', len(df))
+        _count(filename, 'load_ms', round((time.perf_counter() - started) * 1000, 3))
+        return df, signature
+
+
+def _schedule_refresh(filename):
+    """Recarrega a tabela em uma thread, se ainda não houver uma recarregando"""
+    with CACHE_LOCK:
+        if filename in _REFRESHING:
+            return
+        _REFRESHING.add(filename)
+    threading.Thread(target=_refresh, args=(filename,), name='mcpark-refresh', daemon=True).start()
+
+
+def _refresh(filename):
+    try:
+        _load_frame(filename, revalidate=True)
+        _count(filename, 'refreshes')
+    except Exception as e:
+        # A próxima leitura tenta de novo
+        print(f'Aviso: falha ao recarregar {filename}: {e}')
+    finally:
+        with CACHE_LOCK:
+            _REFRESHING.discard(filename)
+
+
+def _cache_put(filename, df, signature, size):
+    """Guarda a tabela como a mais recente do LRU e, com orçamento, descarta as
+    usadas há mais tempo até o cache caber nele; a mais recente sempre fica,
+    mesmo que sozinha passe do orçamento (chamar com CACHE_LOCK)"""
+    CSV_CACHE[filename] = df
+    CSV_CACHE.move_to_end(filename)
+    CACHE_SIGNATURES[filename] = signature
+    CACHE_BYTES[filename] = size
+    if cache_max_bytes is None:
+        return
+    total = sum(CACHE_BYTES.values())
+    while total > cache_max_bytes and len(CSV_CACHE) > 1:
+        victim = next(iter(CSV_CACHE))
+        total -= CACHE_BYTES.get(victim, 0)
+        _drop(victim)
+        _count(victim, 'evictions')
+
+
+def cache_usage():
+    """Memória de cada tabela em cache (bytes, da usada há mais tempo para a
+    mais recente), o total, o orçamento e os hits, misses e evicções somados"""
+    with CACHE_LOCK:
+        tables = {filename: CACHE_BYTES.get(filename, 0) for filename in CSV_CACHE}
+    with _STATS_LOCK:
+        # Só as tabelas: get_derived conta hits e misses com as próprias chaves
+        counters = [counter for key, counter in STATS.items() if key.endswith('.csv')]
+        totals = {key: sum(counter[key] for counter in counters)
+                  for key in ('cache_hits', 'cache_misses', 'evictions')}
+    return {'tables': tables, 'total_bytes': sum(tables.values()), 'max_bytes': cache_max_bytes, **totals}
+
+
+def _get_cached_frame(filename, force_reload=False):
+    """Retorna o DataFrame do cache sem copiar (None se a tabela não existir).
+
+    O objeto é compartilhado entre as requisições e não deve ser alterado.
+    """
+    return _load_frame(filename, force_reload)[0]
+
+
+def _project(df, columns):
+    """Só as colunas pedidas (as que a tabela tiver), na ordem pedida"""
+    if columns is None:
+        return df
+    return df[[col for col in columns if col in df.columns]]
+
+
+def read_csv_cached(filename, force_reload=False, mutable=False, columns=None):
+    """Lê arquivo CSV com cache para melhorar performance.
+
+    Retorna um snapshot copy-on-write do cache (sem copiar os dados); com
+    mutable=True retorna uma cópia completa e independente. Com columns,
+    só as colunas informadas. Tabelas inexistentes voltam vazias, com as
+    colunas do esquema. As colunas já vêm nos tipos do esquema (datas em
+    datetime64, categorias em pd.Categorical).
+    """
+    _count(filename, 'reads')
+    df = _get_cached_frame(filename, force_reload)
+    if df is None:
+        return _project(empty_table(filename), columns)
+    _count(filename, 'rows_read', len(df))
+    return _project(df, columns).copy(deep=mutable)
+
+
+def read_versioned(filename, columns=None):
+    """read_csv_cached junto com a versão da tabela lida, para passar como
+    expected_version às escritas que dependem dessa leitura.
+
+    A versão é a assinatura do arquivo, que muda a cada escrita na tabela,
+    de qualquer processo; a leitura sempre a confere, mesmo com o watcher.
+    """
+    _count(filename, 'reads')
+    df, version = _load_frame(filename, revalidate=True)
+    if df is None:
+        return _project(empty_table(filename), columns), None
+    _count(filename, 'rows_read', len(df))
+    return _project(df, columns).copy(deep=False), version
+
+
+def _current_or_partitions(filename):
+    """(tabela inteira em cache e atualizada, None) ou (None, partições do
+    backend); (None, None) se o backend não particiona a tabela"""
+    cached = _fresh_cached(filename)
+    if cached is not None:
+        return cached, None
+    return None, storage.partitions(filename)
+
+
+def _load_partition(filename, name):
+    """Uma partição, com entrada própria no cache: a escrita em um mês não
+    invalida os outros. A assinatura é sempre conferida, porque o evento do
+    watcher pode chegar depois da escrita que alterou a partição."""
+    _count(filename, 'partitions_read')
+    return _load_frame(name, revalidate=True)[0]
+
+
+def _concat_partitions(filename, frames):
+    """Partições juntas, na ordem dada, como numa leitura da tabela inteira"""
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return empty_table(filename)
+    if len(frames) > 1:
+        # Cada partição tem as suas categorias: sem unificar, o concat
+        # transformaria as colunas em object
+        for col in frames[0].columns:
+            if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+                categories = sorted({value for frame in frames for value in frame[col].dropna().unique()})
+                frames = [frame.assign(**{col: pd.Categorical(frame[col].astype(object), categories=categories)})
+                          for frame in frames]
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    _count(filename, 'rows_read', len(df))
+    return df
+
+
+def read_period(filename, start=None, end=None, columns=None, include_undated=False):
+    """Linhas de uma tabela de PARTITIONED_TABLES com a data entre start e end,
+    inclusive (Timestamps; None = sem limite).
+
+    Se a tabela inteira já está em cache, filtra dela; senão lê só as
+    partições dos meses do período. Linhas sem data válida ficam de fora
+    quando há algum limite, a não ser com include_undated.
+    """
+    _count(filename, 'reads')
+    df, partitions = _current_or_partitions(filename)
+    if partitions is not None:
+        if start is None and end is None:
+            names = [name for _, name in partitions]
+        else:
+            first = start.strftime('%Y-%m') if start is not None else '0000-00'
+            last = end.strftime('%Y-%m') if end is not None else '9999-99'
+            names = [name for key, name in partitions
+                     if (include_undated and key == UNDATED) or (key != UNDATED and first <= key <= last)]
+        df = _concat_partitions(filename, [_load_partition(filename, name) for name in names])
+    else:
+        df = df if df is not None else _get_cached_frame(filename)
+        if df is None:
+            return _project(empty_table(filename), columns)
+        _count(filename, 'rows_read', len(df))
+    if start is not None or end is not None:
+        dates = df[PARTITIONED_TABLES[filename]]
+        if dates.dtype.kind != 'M':
+            dates = pd.to_datetime(dates, format='ISO8601', errors='coerce')
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates <= end
+        if include_undated:
+            mask |= dates.isna()
+        df = df[mask]
+    return _project(df, columns).copy(deep=False)
+
+
+def read_latest(filename, count, columns=None):
+    """Ao menos as count linhas de data mais recente de uma tabela de
+    PARTITIONED_TABLES (podem vir mais: quem chama ordena e corta).
+
+    Lê as partições do último mês para trás até juntar count linhas; se a
+    tabela inteira já está em cache, devolve ela.
+    """
+    df, partitions = _current_or_partitions(filename)
+    if partitions is None:
+        return read_csv_cached(filename, columns=columns)
+    _count(filename, 'reads')
+    frames, found = [], 0
+    for _, name in reversed(partitions):
+        if found >= count:
+            break
+        frame = _load_partition(filename, name)
+        frames.insert(0, frame)
+        found += len(frame) if frame is not None else 0
+    return _project(_concat_partitions(filename, frames), columns).copy(deep=False)
+
+
+def get_pk_index(filename):
+    """Índice id -> linha (dict) da tabela, construído uma vez por carga do cache.
+
+    Os dicts são compartilhados; use get_record_by_id para obter uma cópia.
+    """
+    df = _get_cached_frame(filename)
+    if df is None:
+        return {}
+    with CACHE_LOCK:
+        entry = PK_INDEX.get(filename)
+    # O índice só vale para o mesmo DataFrame que o gerou
+    if entry is not None and entry[0] is df:
+        return entry[1]
+    # Construído com o lock da tabela, como a carga: uma thread constrói, as
+    # outras que precisam do mesmo índice esperam por ele
+    with _table_lock(filename):
+        with CACHE_LOCK:
+            entry = PK_INDEX.get(filename)
+        if entry is not None and entry[0] is df:
+            return entry[1]
+        index = {}
+        if 'id' in df.columns:
+            for row in df.to_dict('records'):
+                if pd.notna(row['id']):
+                    # Em ids duplicados vale a primeira linha, como no filtro original
+                    index.setdefault(int(row['id']), row)
+        with CACHE_LOCK:
+            if CSV_CACHE.get(filename) is df:
+                PK_INDEX[filename] = (df, index)
+        _count(filename, 'index_builds')
+        return index
+
+
+def get_record_by_id(filename, record_id):
+    """Busca uma linha pelo id em O(1); retorna uma cópia em dict ou None"""
+    _count(filename, 'lookups')
+    try:
+        key = int(record_id)
+    except (TypeError, ValueError):
+        return None
+    row = get_pk_index(filename).get(key)
+    return dict(row) if row is not None else None
+
+
+def map_by_id(keys, df, column):
+    """Join vetorizado pela chave primária: mapeia uma Series de ids para a coluna de df.
+
+    Ids sem correspondência viram NaN; em ids duplicados vale a primeira linha.
+    """
+    if df is None or 'id' not in df.columns or column not in df.columns:
+        return pd.Series(np.nan, index=keys.index, dtype=object)
+    lookup = df.drop_duplicates('id').set_index('id')[column]
+    return keys.map(lookup)
+
+
+def lookup_column(filename, keys, column):
+    """map_by_id sobre a tabela em cache"""
+    _count(filename, 'joins')
+    return map_by_id(keys, _get_cached_frame(filename), column)
+
+
+def get_derived(key, tables, builder):
+    """Memoriza builder(*frames) até alguma das tabelas ser recarregada.
+
+    Os frames recebidos e o resultado são compartilhados entre requisições:
+    filtre ou copie antes de alterar.
+    """
+    frames = tuple(_get_cached_frame(table) for table in tables)
+    with CACHE_LOCK:
+        entry = DERIVED_CACHE.get(key)
+        if entry is not None and all(a is b for a, b in zip(entry[1], frames)):
+            _count(key, 'cache_hits')
+            return entry[2]
+    _count(key, 'cache_misses')
+    for table, frame in zip(tables, frames):
+        if frame is not None:
+            _count(table, 'rows_read', len(frame))
+    result = builder(*(frame if frame is not None else empty_table(table)
+                       for frame, table in zip(frames, tables)))
+    with CACHE_LOCK:
+        # Só guarda se nenhuma tabela foi recarregada durante o cálculo
+        if all(CSV_CACHE.get(table) is frame for table, frame in zip(tables, frames)):
+            DERIVED_CACHE[key] = (tuple(tables), frames, result)
+    return result
+
+
+def get_derived_for(key, tables, frame, builder):
+    """get_derived de builder(frame) para um frame lido do cache (ou derivado
+    dele com get_derived); se o cache já tem outro frame, calcula sem memorizar"""
+    entry = get_derived(key, tables, lambda *frames: (frame, builder(frame)))
+    if entry[0] is not frame:
+        return builder(frame)
+    return entry[1]
+
+
+def _drop(filename):
+    """Tira a tabela do cache com o índice e os resultados derivados dela,
+    que a manteriam na memória (chamar com CACHE_LOCK)"""
+    CSV_CACHE.pop(filename, None)
+    CACHE_SIGNATURES.pop(filename, None)
+    CACHE_BYTES.pop(filename, None)
+    PK_INDEX.pop(filename, None)
+    for key in [k for k, entry in DERIVED_CACHE.items() if filename in entry[0]]:
+        del DERIVED_CACHE[key]
+
+
+def invalidate_cache(filename=None):
+    """Invalida o cache de um arquivo específico ou de todos"""
+    with CACHE_LOCK:
+        _INVALIDATIONS[filename or None] += 1
+        if filename:
+            _drop(filename)
+        else:
+            CSV_CACHE.clear()
+            CACHE_SIGNATURES.clear()
+            CACHE_BYTES.clear()
+            PK_INDEX.clear()
+            DERIVED_CACHE.clear()
+
+
+def _on_data_file_changed(name):
+    """Callback do watcher: invalida as tabelas guardadas no arquivo alterado"""
+    tables = storage.tables_for_file(name) if name is not None else None
+    if tables is None:
+        invalidate_cache()
+    else:
+        for table in tables:
+            # Escritas que já atualizaram o cache (ver insert_records) mantêm a entrada
+            with CACHE_LOCK:
+                if table in APPENDING or (table in CSV_CACHE and
+                                          storage.signature(table) == CACHE_SIGNATURES.get(table)):
+                    continue
+                stale = stale_while_revalidate and table in CSV_CACHE
+            if stale:
+                # A versão antiga continua servindo até a recarga terminar
+                _schedule_refresh(table)
+            else:
+                invalidate_cache(table)
+
+
+def register_write_hook(tables, hook):
+    """Registra hook(tabela, linhas_antigas, linhas_novas, versão_anterior),
+    chamado após cada escrita nas tabelas informadas com DataFrames das linhas
+    afetadas e a versão da tabela antes da escrita (ver table_version)"""
+    for table in tables:
+        WRITE_HOOKS[table].append(hook)
+
+
+def _run_hooks(filename, old_rows, new_rows, old_version):
+    for hook in WRITE_HOOKS.get(filename, ()):
+        hook(filename, old_rows, new_rows, old_version)
+
+
+def table_version(filename):
+    """Versão atual da tabela, a mesma de read_versioned, sem ler a tabela"""
+    return storage.signature(filename)
+
+
+def _old_rows(filename, record_id=None):
+    """Linhas atuais (uma ou todas) para calcular o delta dos hooks"""
+    if record_id is None:
+        return read_csv_cached(filename)
+    row = get_record_by_id(filename, record_id)
+    return pd.DataFrame([row]) if row is not None else empty_table(filename)
+
+
+@contextmanager
+def transaction():
+    """Agrupa escritas em uma ou mais tabelas: se algo falhar no meio, todas
+    são desfeitas (inclusive as dos hooks).
+
+    Todas as funções de escrita abrem uma; as chamadas dentro de outra fazem
+    parte dela. Só retorna depois que as escritas chegaram ao disco, com o
+    fsync feito em grupo com as transações concorrentes (ver storage.GroupCommit).
+    Enquanto ela está aberta nenhuma outra thread ou processo escreve, e as
+    leituras conferem a versão de cada tabela: ler e escrever dentro da mesma
+    transação nunca perde a escrita de outro worker.
+    """
+    if _in_transaction():
+        yield
+        return
+    with WRITE_LOCK:
+        restored = storage.begin()
+        if restored:
+            # Transação de um worker que morreu no meio, desfeita agora
+            print(f'Aviso: transações interrompidas desfeitas em {", ".join(restored)}')
+            for filename in restored:
+                invalidate_cache(filename)
+        _TRANSACTION.active = True
+        # Os ids entregues na transação voltam aos blocos se ela for desfeita
+        id_blocks = {table: list(block) for table, block in _ID_BLOCKS.items()}
+        try:
+            yield
+        except BaseException:
+            _TRANSACTION.active = False
+            _ID_BLOCKS.clear()
+            _ID_BLOCKS.update(id_blocks)
+            storage.rollback()
+            invalidate_cache()
+            _count('transactions', 'rollbacks')
+            raise
+        _TRANSACTION.active = False
+        ticket = storage.commit()
+    # A espera pelo disco fica fora do lock para que outras transações
+    # entrem no mesmo lote de fsync
+    storage.wait_durable(ticket)
+    _count('transactions', 'commits')
+
+
+def retry_on_conflict(func):
+    """Repete func quando ela termina em ConflictError, até CONFLICT_RETRIES
+    vezes; func deve reler os dados (read_versioned) a cada execução"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(CONFLICT_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except ConflictError:
+                if attempt == CONFLICT_RETRIES - 1:
+                    raise
+                _count('transactions', 'retries')
+    return wrapper
+
+
+def _check_version(filename, expected_version):
+    """ConflictError se a tabela não está mais na versão lida pelo chamador.
+
+    Chamado dentro da transação: a tabela não muda até ela terminar. Note que
+    a versão muda também com as escritas anteriores da própria transação.
+    """
+    if expected_version is not None and storage.signature(filename) != expected_version:
+        _count(filename, 'conflicts')
+        raise ConflictError(f'{filename} foi alterada por outra escrita; tente novamente')
+
+
+def save_csv_and_invalidate(df, filename, expected_version=None):
+    """Salva a tabela inteira e invalida o cache"""
+    with transaction():
+        _check_version(filename, expected_version)
+        old_rows = _old_rows(filename) if filename in WRITE_HOOKS else None
+        old_version = storage.signature(filename) if old_rows is not None else None
+        storage.write(filename, _to_stored(filename, df))
+        invalidate_cache(filename)
+        _count(filename, 'rewrites')
+        if 'id' in df.columns and filename != SEQUENCE_TABLE:
+            _advance_sequence(filename, pd.to_numeric(df['id'], errors='coerce').max())
+        if old_rows is not None:
+            _run_hooks(filename, old_rows, df, old_version)
+
+
+def insert_record(filename, record, expected_version=None):
+    """Insere uma linha na tabela (ver insert_records)"""
+    insert_records(filename, [record], expected_version)
+
+
+def insert_new_record(filename, record, expected_version=None):
+    """Insere a linha com o próximo id da tabela e retorna esse id.
+
+    O id vem da sequência da tabela (ver allocate_ids), reservado na mesma
+    transação da inserção: threads e processos concorrentes nunca recebem o mesmo.
+    """
+    with transaction():
+        _check_version(filename, expected_version)
+        new_id = allocate_ids(filename)
+        insert_records(filename, [{'id': new_id, **{k: v for k, v in record.items() if k != 'id'}}])
+    return new_id
+
+
+def _parse_appended(filename, cached, records):
+    """Linhas novas com os tipos que uma releitura do arquivo inteiro daria,
+    ou None quando o tipo depende de todo o arquivo (ex.: texto em coluna numérica)"""
+    # As linhas passam pelo CSV, como na releitura; colunas de texto continuam
+    # texto. Colunas object lidas do CSV são só texto ou só bool (com vazios),
+    # então o primeiro valor preenchido diz qual é o caso
+    dtypes = _read_dtypes(filename)
+    for col in cached.columns:
+        if cached[col].dtype == object and not cached.empty:
+            first = next((value for value in cached[col].to_numpy() if pd.notna(value)), None)
+            if not isinstance(first, bool):
+                dtypes[col] = str
+    text = pd.DataFrame(records, columns=cached.columns).to_csv(index=False)
+    raw = pd.read_csv(io.StringIO(text), dtype=dtypes)
+    new_rows = _apply_schema(filename, raw.copy())
+    if cached.empty:
+        return new_rows
+    for col in cached.columns:
+        old, new = cached[col].dtype, new_rows[col].dtype
+        if isinstance(old, pd.CategoricalDtype):
+            continue  # Categorias conciliadas em _append_to_cache
+        if old.kind == 'M':
+            # Na releitura a coluna só continua data se todos os valores forem datas
+            if new.kind != 'M':
+                return None
+            continue
+        if old == object and col in dtypes:
+            # Texto (inclusive datas que a releitura manteria como texto)
+            new_rows[col] = raw[col]
+            continue
+        if old.kind in 'iuf' and new.kind in 'iuf':
+            continue
+        if old == object:
+            # Coluna de bool com vazios: só aceita bool ou vazio
+            if new != bool and not new_rows[col].isna().all():
+                return None
+            new_rows[col] = new_rows[col].astype(object)
+        elif old == new:
+            continue
+        elif new_rows[col].isna().all():
+            # Coluna sem valor nas linhas novas: int vira float, bool vira object
+            new_rows[col] = new_rows[col].astype('float64' if old.kind in 'iuf' else object)
+        elif not cached[col].notna().any():
+            continue  # Coluna que estava vazia assume o tipo dos valores novos
+        else:
+            return None
+    return new_rows
+
+
+def _merge_categories(cached, new_rows):
+    """Deixa as colunas categóricas das duas partes com as mesmas categorias
+    (em ordem alfabética, como numa releitura), para que o concat as mantenha"""
+    for col in cached.columns:
+        if not isinstance(cached[col].dtype, pd.CategoricalDtype):
+            continue
+        categories = cached[col].cat.categories
+        added = new_rows[col].dropna().unique()
+        if not set(added) <= set(categories):
+            categories = pd.Index(sorted(set(categories) | set(added)))
+            cached = cached.assign(**{col: cached[col].cat.set_categories(categories)})
+        new_rows[col] = pd.Categorical(new_rows[col].astype(object), categories=categories)
+    return cached, new_rows
+
+
+def _fresh_cached(filename):
+    """DataFrame em cache se ele ainda é a versão atual do arquivo, senão None
+    (a assinatura do arquivo é lida fora do CACHE_LOCK)"""
+    with CACHE_LOCK:
+        cached, signature = CSV_CACHE.get(filename), CACHE_SIGNATURES.get(filename)
+    if cached is not None and signature != storage.signature(filename):
+        return None
+    return cached
+
+
+def _append_to_cache(filename, cached, records):
+    """Acrescenta ao DataFrame em cache (e ao índice por id) as linhas que
+    acabaram de ser anexadas ao arquivo, sem reler a tabela"""
+    new_rows = _parse_appended(filename, cached, records)
+    if new_rows is None:
+        invalidate_cache(filename)
+        return
+    if cached.empty:
+        df = new_rows
+    else:
+        df = pd.concat(_merge_categories(cached, new_rows), ignore_index=True)
+    df = _optimize_dtypes(df, keep=_money_columns(filename))
+    signature = storage.signature(filename)
+    added = _frame_bytes(df.iloc[len(cached):], appended=True)
+    with CACHE_LOCK:
+        # Um leitor pode ter relido o arquivo (já com as linhas novas) enquanto isso
+        if CSV_CACHE.get(filename) is not cached:
+            return
+        _cache_put(filename, df, signature, CACHE_BYTES.get(filename, 0) + added)
+        entry = PK_INDEX.pop(filename, None)
+        # Se algum tipo mudou (ex.: int -> float) as linhas antigas do índice
+        # ficariam diferentes de uma releitura: o índice é refeito sob demanda
+        same_kinds = [dtype.kind for dtype in cached.dtypes] == [dtype.kind for dtype in df.dtypes]
+        if entry is not None and entry[0] is cached and same_kinds:
+            index = entry[1]
+            for row in df.iloc[len(cached):].to_dict('records'):
+                if pd.notna(row['id']):
+                    index.setdefault(int(row['id']), row)
+            PK_INDEX[filename] = (df, index)
+    _count(filename, 'appends', len(records))
+
+
+def insert_records(filename, records, expected_version=None):
+    """Insere várias linhas de uma vez.
+
+    Se o backend anexar as linhas ao fim do arquivo (CSV) e a tabela em cache
+    estiver atualizada, o cache recebe as linhas novas em vez de ser invalidado.
+    """
+    if not records:
+        return
+    with transaction():
+        _check_version(filename, expected_version)
+        old_version = storage.signature(filename) if filename in WRITE_HOOKS else None
+        cached = _fresh_cached(filename)
+        with CACHE_LOCK:
+            # Substituída enquanto a assinatura era conferida: invalida no fim
+            if cached is not None and CSV_CACHE.get(filename) is not cached:
+                cached = None
+            if cached is not None:
+                APPENDING.add(filename)
+        try:
+            stored = [_to_stored(filename, record) for record in records]
+            appended = storage.insert_many(filename, stored)
+            if appended and cached is not None:
+                _append_to_cache(filename, cached, stored)
+            else:
+                invalidate_cache(filename)
+        finally:
+            with CACHE_LOCK:
+                APPENDING.discard(filename)
+        _count(filename, 'inserts', len(records))
+        if filename != SEQUENCE_TABLE:
+            # Ids informados pelo chamador (fora da sequência) não podem ser entregues de novo
+            ids = [record.get('id') for record in records]
+            _advance_sequence(filename, pd.to_numeric(pd.Series(ids, dtype=object), errors='coerce').max())
+        if filename in WRITE_HOOKS:
+            _run_hooks(filename, empty_table(filename), pd.DataFrame(records), old_version)
+
+
+def update_record(filename, record_id, values, expected_version=None):
+    """Atualiza as colunas informadas de uma linha e invalida o cache"""
+    with transaction():
+        _check_version(filename, expected_version)
+        old_rows = _old_rows(filename, record_id) if filename in WRITE_HOOKS else None
+        old_version = storage.signature(filename) if old_rows is not None else None
+        updated = storage.update(filename, record_id, _to_stored(filename, values))
+        invalidate_cache(filename)
+        _count(filename, 'updates')
+        if updated and old_rows is not None:
+            _run_hooks(filename, old_rows, old_rows.assign(**values), old_version)
+    return updated
+
+
+def delete_record(filename, record_id, expected_version=None):
+    """Remove uma linha da tabela e invalida o cache"""
+    with transaction():
+        _check_version(filename, expected_version)
+        old_rows = _old_rows(filename, record_id) if filename in WRITE_HOOKS else None
+        old_version = storage.signature(filename) if old_rows is not None else None
+        deleted = storage.delete(filename, record_id)
+        invalidate_cache(filename)
+        _count(filename, 'deletes')
+        if deleted and old_rows is not None:
+            _run_hooks(filename, old_rows, empty_table(filename), old_version)
+    return deleted
+
+
+def _max_id(filename):
+    """Maior id da tabela (0 se vazia)"""
+    cached = _fresh_cached(filename)
+    try:
+        if cached is not None and 'id' in cached.columns:
+            # Tabela em cache e atualizada: evita reler a coluna de ids do arquivo
+            current = cached['id'].max()
+            return int(current) if pd.notna(current) else 0
+        return storage.max_id(filename)
+    except (KeyError, ValueError, TypeError):
+        return 0
+
+
+def _last_allocated(filename):
+    """(tabela de sequências, último id entregue da tabela ou None)"""
+    sequences = read_csv_cached(SEQUENCE_TABLE, mutable=True)
+    # A carga reduz o tipo dos inteiros (int8, int16...): o próximo valor pode não caber
+    sequences['last_id'] = pd.to_numeric(sequences['last_id'], errors='coerce').astype('Int64')
+    match = sequences.loc[sequences['table'] == filename, 'last_id']
+    return sequences, (int(match.iloc[0]) if not match.empty and pd.notna(match.iloc[0]) else None)
+
+
+def _store_sequence(sequences, filename, last_id):
+    if (sequences['table'] == filename).any():
+        sequences.loc[sequences['table'] == filename, 'last_id'] = last_id
+    else:
+        row = pd.DataFrame([{'table': filename, 'last_id': last_id}])
+        sequences = pd.concat([sequences, row], ignore_index=True) if not sequences.empty else row
+    save_csv_and_invalidate(sequences[['table', 'last_id']], SEQUENCE_TABLE)
+
+
+def _cached_ids_between(filename, start, end):
+    """True se a tabela em cache tem algum id em [start, end), sem conferir o
+    arquivo (False se não está em cache)"""
+    with CACHE_LOCK:
+        cached = CSV_CACHE.get(filename)
+    if cached is None or 'id' not in cached.columns or cached.empty:
+        return False
+    ids = pd.to_numeric(cached['id'], errors='coerce')
+    return bool(((ids >= start) & (ids < end)).any())
+
+
+def allocate_ids(filename, count=1):
+    """Reserva count ids consecutivos da tabela e retorna o primeiro.
+
+    A sequência de cada tabela fica em sequences.csv (último id reservado) e
+    é atualizada na transação de quem pede: não lê a tabela, ids de uma
+    transação desfeita voltam à sequência e threads e processos concorrentes
+    nunca recebem o mesmo id. Ids de linhas apagadas não são reutilizados.
+    Na primeira reserva a sequência parte do maior id da tabela.
+
+    Cada processo reserva ID_BLOCK_SIZE ids de uma vez (ou o lote inteiro,
+    se maior) e entrega os próximos da memória: a maioria das inserções não
+    regrava sequences.csv. Ids de um bloco não usado até o processo terminar
+    ficam sem uso. Os ids acima do bloco, de outros processos, não o afetam.
+    """
+    with transaction():
+        block = _ID_BLOCKS.get(filename)
+        # O bloco guarda só os ids ainda não entregues por este processo: um
+        # deles já na tabela foi gravado por fora da sequência
+        if block is not None and _cached_ids_between(filename, block[0], block[1]):
+            block = None
+        if block is None or block[1] - block[0] < count:
+            sequences, last_id = _last_allocated(filename)
+            if last_id is None:
+                last_id = _max_id(filename)
+            reserved = max(count, ID_BLOCK_SIZE)
+            _store_sequence(sequences, filename, last_id + reserved)
+            block = [last_id + 1, last_id + reserved + 1]
+        first = block[0]
+        _ID_BLOCKS[filename] = [first + count, block[1]]
+    _count(filename, 'ids_allocated', count)
+    return first
+
+
+def _advance_sequence(filename, max_id):
+    """Garante que a sequência já passou de max_id (ids gravados sem allocate_ids)"""
+    if pd.isna(max_id):
+        return
+    block = _ID_BLOCKS.get(filename)
+    if block is not None:
+        if max_id < block[0]:
+            # Ids entregues por allocate_ids: já estão reservados em sequences.csv
+            return
+        # Id informado dentro (ou além) do bloco: os ids restantes não valem mais
+        del _ID_BLOCKS[filename]
+    sequences, last_id = _last_allocated(filename)
+    # Sem sequência ainda: a primeira reserva parte do maior id da tabela
+    if last_id is not None and last_id < max_id:
+        _store_sequence(sequences, filename, int(max_id))
+
+
+def get_next_id(filename):
+    """Reserva e retorna o próximo id da tabela (ver allocate_ids); chamar
+    dentro da transação que insere a linha, para que um rollback o devolva"""
+    return allocate_ids(filename)
+
+
+def _after_fork():
+    """No processo filho (workers do gunicorn com --preload) as threads do pai
+    não existem: recria os locks e o watcher, mantendo o cache já carregado"""
+    global CACHE_LOCK, _STATS_LOCK, WRITE_LOCK, _TABLE_LOCKS, cache_watcher
+    CACHE_LOCK, _STATS_LOCK, WRITE_LOCK = threading.Lock(), threading.Lock(), threading.RLock()
+    _TABLE_LOCKS = {}
+    APPENDING.clear()
+    _REFRESHING.clear()
+    # Os blocos de ids do pai não podem ser entregues também pelos filhos
+    _ID_BLOCKS.clear()
+    if storage is None:
+        return
+    if cache_watcher is not None:
+        cache_watcher.stop()
+        watcher = InotifyWatcher(cache_watcher.directory, _on_data_file_changed)
+        cache_watcher = watcher if watcher.start() else None
+    # Escritas entre o fork e o novo watcher não geraram evento
+    for filename in list(CSV_CACHE):
+        if storage.signature(filename) != CACHE_SIGNATURES.get(filename):
+            invalidate_cache(filename)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
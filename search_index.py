@@ -0,0 +1,344 @@
+"""Índice de busca em memória do MC PARK MANAGER.
+
+Guarda o nome (minúsculo e sem acentos) e o CPF (só dígitos) de cada cliente
+e a placa (só letras e números) de cada veículo, com os trigramas de cada
+texto apontando para os ids. Uma busca intersecta as listas dos trigramas do
+termo e confere só os candidatos, em vez de percorrer as tabelas. Nomes e
+placas também ficam ordenados, para busca exata e por prefixo (find_plates)
+e para as páginas do autocomplete (customers_page, vehicles_page).
+
+O índice acompanha o cache do repository: quando uma tabela é recarregada,
+só as linhas que mudaram desde a última versão indexada são reindexadas.
+"""
+import heapq
+import threading
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import repository
+
+GRAM = 3
+# Chaves reindexadas desde a última compactação, em proporção ao índice: acima
+# disso os trigramas são remontados (os de textos antigos saem nessa hora)
+COMPACT_RATIO = 0.2
+COMPACT_MIN = 1000
+
+
+def normalize_text(value):
+    """Minúsculo e sem acentos ('João' -> 'joao'); '' para valores vazios"""
+    if not isinstance(value, str):
+        return ''
+    if value.isascii():
+        return value.lower()
+    decomposed = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def normalize_alnum(value):
+    """Só letras e números, minúsculo e sem acentos (placas e termos de busca)"""
+    return ''.join(filter(str.isalnum, normalize_text(value)))
+
+
+def normalize_plate(value):
+    """Placa em maiúsculas, só letras e números, com a letra Mercosul trocada
+    pelo dígito do formato antigo (ABC1C34 -> ABC1234): as duas formas da
+    mesma placa, e os prefixos delas, têm a mesma chave"""
+    plate = normalize_alnum(value).upper()
+    if len(plate) >= 5 and plate[:3].isalpha() and plate[3].isdigit() and 'A' <= plate[4] <= 'J':
+        plate = plate[:4] + str(ord(plate[4]) - ord('A')) + plate[5:]
+    return plate
+
+
+def normalize_digits(value):
+    """Só os dígitos (CPF)"""
+    return ''.join(filter(str.isdigit, value)) if isinstance(value, str) else ''
+
+
+def _grams(text):
+    """Códigos dos trigramas do texto (três code points em um int64)"""
+    return {ord(text[i]) << 42 | ord(text[i + 1]) << 21 | ord(text[i + 2])
+            for i in range(len(text) - GRAM + 1)}
+
+
+def _gram_pairs(keys, texts):
+    """(códigos, chaves) de todos os trigramas dos textos, ordenados e sem
+    repetição; os textos de mesmo tamanho viram uma matriz de code points"""
+    texts = np.array(texts, dtype=object)
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    codes, owners = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for length in np.unique(lengths[lengths >= GRAM]).tolist():
+        rows = np.flatnonzero(lengths == length)
+        chars = (np.array(texts[rows].tolist(), dtype=f'U{length}')
+                 .view(np.uint32).reshape(len(rows), length).astype(np.int64))
+        codes.append((chars[:, :-2] << 42 | chars[:, 1:-1] << 21 | chars[:, 2:]).ravel())
+        owners.append(np.repeat(keys[rows], length - GRAM + 1))
+    codes, owners = np.concatenate(codes), np.concatenate(owners)
+    order = np.lexsort((owners, codes))
+    codes, owners = codes[order], owners[order]
+    unique = np.ones(len(codes), dtype=bool)
+    unique[1:] = (codes[1:] != codes[:-1]) | (owners[1:] != owners[:-1])
+    return codes[unique], owners[unique]
+
+
+class TrigramIndex:
+    """Texto normalizado de cada chave e, por trigrama, as chaves que o contêm.
+
+    A base fica em um array ordenado, montado de uma vez; as chaves
+    reindexadas depois vão para um delta em sets até a próxima compactação.
+    Trigramas de textos antigos podem sobrar até lá: a busca sempre confere
+    o texto atual dos candidatos.
+    """
+
+    def __init__(self):
+        self.texts = {}
+        self._offsets = {}  # código do trigrama -> (início, fim) em _keys
+        self._keys = np.empty(0, dtype=np.int64)
+        self._delta = defaultdict(set)
+        self._pending = 0
+
+    def set(self, key, text):
+        if self.texts.get(key) == text:
+            return
+        self.texts[key] = text
+        for gram in _grams(text):
+            self._delta[gram].add(key)
+        self._pending += 1
+
+    def remove(self, key):
+        self.texts.pop(key, None)
+
+    def load(self, texts):
+        """Substitui todos os textos e remonta a base"""
+        self.texts = dict(texts)
+        self.compact()
+
+    def compact(self):
+        """Remonta a base a partir dos textos atuais e esvazia o delta"""
+        keys = np.fromiter(self.texts, dtype=np.int64, count=len(self.texts))
+        codes, self._keys = _gram_pairs(keys, list(self.texts.values()))
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        ends = np.append(starts[1:], len(codes))
+        self._offsets = dict(zip(codes[starts].tolist(), zip(starts.tolist(), ends.tolist())))
+        self._delta.clear()
+        self._pending = 0
+
+    def maybe_compact(self):
+        if self._pending > max(COMPACT_MIN, COMPACT_RATIO * len(self.texts)):
+            self.compact()
+
+    def _postings(self, gram):
+        start, end = self._offsets.get(gram, (0, 0))
+        keys = self._keys[start:end]
+        delta = self._delta.get(gram)
+        if delta:
+            keys = np.union1d(keys, np.fromiter(delta, dtype=np.int64, count=len(delta)))
+        return keys
+
+    def search(self, needle):
+        """Chaves cujo texto contém needle (já normalizado); nenhuma se ele é vazio"""
+        if not needle:
+            # '' está contido em qualquer texto: um termo só de pontuação não filtra nada
+            return set()
+        if len(needle) < GRAM:
+            # Termos curtos não têm trigrama: percorre os textos
+            return {key for key, text in self.texts.items() if needle in text}
+        candidates = None
+        for postings in sorted(map(self._postings, _grams(needle)), key=len):
+            candidates = postings if candidates is None else np.intersect1d(candidates, postings,
+                                                                            assume_unique=True)
+            if not len(candidates):
+                return set()
+        # Os trigramas não garantem a ordem nem a posição: confere o texto
+        return {key for key in candidates.tolist() if needle in self.texts.get(key, '')}
+
+
+class SortedIndex:
+    """Chaves ordenadas pelo texto normalizado, para busca exata e por prefixo
+    com bisect (O(log n)); inclusões e remoções mantêm a ordem"""
+
+    def __init__(self):
+        self.texts = {}
+        self._sorted = []  # (texto, chave)
+
+    def set(self, key, text):
+        if self.texts.get(key) == text:
+            return
+        self.remove(key)
+        self.texts[key] = text
+        insort(self._sorted, (text, key))
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is not None:
+            del self._sorted[bisect_left(self._sorted, (text, key))]
+
+    def load(self, texts):
+        self.texts = dict(texts)
+        self._sorted = sorted((text, key) for key, text in self.texts.items())
+
+    def maybe_compact(self):
+        pass
+
+    def find(self, text, prefix=False, limit=None):
+        """Chaves com o texto igual a text (ou começando por ele), na ordem do texto"""
+        start = bisect_left(self._sorted, (text,))
+        if prefix:
+            end = bisect_left(self._sorted, (text + '\U0010ffff',), start)
+        else:
+            end = bisect_right(self._sorted, (text, float('inf')), start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return [key for _, key in self._sorted[start:end]]
+
+    def page(self, keys=None, offset=0, limit=20):
+        """Chaves de uma página (todas ou só as informadas), na ordem do texto"""
+        if keys is None:
+            return [key for _, key in self._sorted[offset:offset + limit]]
+        # Só as primeiras offset + limit: não ordena todas as encontradas
+        first = heapq.nsmallest(offset + limit, ((self.texts[key], key) for key in keys if key in self.texts))
+        return [key for _, key in first[offset:]]
+
+
+# Índices de cada tabela (nome -> coluna, normalização e tipo) e as colunas
+# que só são guardadas junto (o dono de cada veículo)
+FIELDS = {
+    'customers.csv': {
+        'name': ('name', normalize_text, TrigramIndex),
+        'cpf': ('cpf', normalize_digits, TrigramIndex),
+        'name_sorted': ('name', normalize_text, SortedIndex),
+    },
+    'vehicles.csv': {
+        'plate': ('plate', normalize_alnum, TrigramIndex),
+        'plate_sorted': ('plate', normalize_plate, SortedIndex),
+    },
+}
+EXTRA_COLUMNS = {'vehicles.csv': ['customer_id']}
+
+_LOCK = threading.Lock()
+_indexes = {}  # tabela -> {nome: índice}
+_rows = {}  # tabela -> colunas de FIELDS e EXTRA_COLUMNS por id, na versão indexada
+
+
+def _by_id(table, df):
+    """Colunas indexadas por id (ids vazios ficam de fora; em ids duplicados
+    vale a primeira linha)"""
+    columns = list(dict.fromkeys(column for column, _, _ in FIELDS[table].values()))
+    columns += EXTRA_COLUMNS.get(table, [])
+    df = df[df['id'].notna()]
+    df = df[[col for col in columns if col in df.columns]].astype(object).set_index(df['id'].astype('int64'))
+    return df[~df.index.duplicated()].reindex(columns=columns)
+
+
+def _sync(table, df):
+    """Reindexa as linhas de df que mudaram desde a versão indexada"""
+    current = _by_id(table, df)
+    with _LOCK:
+        fields = _indexes.setdefault(table, {name: kind() for name, (_, _, kind) in FIELDS[table].items()})
+        previous = _rows.get(table)
+        if previous is None:
+            removed, changed = [], current.index
+        else:
+            removed = previous.index.difference(current.index)
+            old = previous.reindex(current.index)
+            same = ((old == current) | (old.isna() & current.isna())).all(axis=1)
+            changed = current.index[~same.to_numpy()]
+        for name, (column, normalize, _) in FIELDS[table].items():
+            index = fields[name]
+            values = zip(changed.tolist(), map(normalize, current.loc[changed, column].tolist()))
+            if previous is None:
+                index.load(values)
+                continue
+            for key in removed:
+                index.remove(key)
+            for key, text in values:
+                index.set(key, text)
+            index.maybe_compact()
+        _rows[table] = current
+    return fields
+
+
+def _fields(table):
+    """Índices da tabela na versão em cache (só sincroniza quando ela muda)"""
+    return repository.get_derived(f'search_index:{table}', (table,), lambda df: _sync(table, df))
+
+
+def _search_customers(customers, vehicles, term):
+    """search_customers com os índices já sincronizados (chamar com _LOCK)"""
+    text, alnum = normalize_text(term).strip(), normalize_alnum(term)
+    # Campos em que o termo normalizado fica vazio ('-', '.', ' ') não entram na busca
+    ids = customers['name'].search(text) if text else set()
+    if not alnum:
+        return ids
+    ids |= customers['cpf'].search(alnum)
+    vehicle_ids = vehicles['plate'].search(alnum)
+    if vehicle_ids:
+        owners = pd.to_numeric(_rows['vehicles.csv'].loc[list(vehicle_ids), 'customer_id'], errors='coerce')
+        ids |= set(owners.dropna().astype('int64').tolist())
+    return ids
+
+
+def search_customers(term):
+    """Ids dos clientes cujo nome, CPF ou placa de algum veículo contém o termo,
+    sem diferenciar acentos e maiúsculas (CPF e placa sem pontuação)"""
+    customers, vehicles = _fields('customers.csv'), _fields('vehicles.csv')
+    with _LOCK:
+        return _search_customers(customers, vehicles, term)
+
+
+def search_customer_names(term):
+    """Ids dos clientes cujo nome contém o termo, sem diferenciar acentos e maiúsculas"""
+    customers = _fields('customers.csv')
+    with _LOCK:
+        return customers['name'].search(normalize_text(term))
+
+
+def customers_page(term='', offset=0, limit=20):
+    """(ids de uma página de clientes em ordem de nome, total encontrado);
+    com termo, só os de search_customers"""
+    customers, vehicles = _fields('customers.csv'), _fields('vehicles.csv')
+    with _LOCK:
+        names = customers['name_sorted']
+        if not term:
+            return names.page(None, offset, limit), len(names.texts)
+        ids = _search_customers(customers, vehicles, term)
+        return names.page(ids, offset, limit), len(ids)
+
+
+def search_plates(term):
+    """Ids dos veículos cuja placa contém o termo (só letras e números)"""
+    vehicles = _fields('vehicles.csv')
+    with _LOCK:
+        return vehicles['plate'].search(normalize_alnum(term))
+
+
+def find_plates(term, prefix=False, limit=None):
+    """Ids dos veículos com a placa igual ao termo (ou começando por ele), em
+    ordem de placa; antiga e Mercosul valem como a mesma placa"""
+    plate = normalize_plate(term)
+    if not plate:
+        return []
+    vehicles = _fields('vehicles.csv')
+    with _LOCK:
+        return vehicles['plate_sorted'].find(plate, prefix, limit)
+
+
+def vehicles_page(term='', customer_id=None, offset=0, limit=20):
+    """(ids de uma página de veículos em ordem de placa, total encontrado),
+    filtrados pela placa (contém o termo) e pelo dono"""
+    vehicles = _fields('vehicles.csv')
+    with _LOCK:
+        plates = vehicles['plate_sorted']
+        ids = None
+        if term:
+            ids = vehicles['plate'].search(normalize_alnum(term))
+        if customer_id is not None:
+            owners = pd.to_numeric(_rows['vehicles.csv']['customer_id'], errors='coerce')
+            owned = set(owners.index[owners == customer_id].tolist())
+            ids = owned if ids is None else ids & owned
+        if ids is None:
+            return plates.page(None, offset, limit), len(plates.texts)
+        return plates.page(ids, offset, limit), len(ids)
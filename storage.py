@@ -0,0 +1,1234 @@
+"""Motores de armazenamento das tabelas do MC PARK MANAGER.
+
+Cada tabela é identificada pelo nome do arquivo CSV (ex.: 'customers.csv').
+O backend CSV mantém o comportamento original (um arquivo por tabela); o
+backend SQLite guarda as mesmas tabelas em um único banco em modo WAL e
+aplica inserções, atualizações e exclusões linha a linha.
+
+Cada backend também expõe a assinatura de cada tabela (mtime/tamanho/inode
+do arquivo no CSV, a versão da tabela no SQLite), usada pelo cache para saber
+quando recarregar, e
+InotifyWatcher permite receber essas mudanças do kernel em vez de consultar
+os arquivos a cada leitura. SnapshotCache guarda uma cópia binária e tipada
+de cada tabela para que a carga a frio não precise reinterpretar o texto.
+
+As escritas acontecem em transações (begin/commit/rollback): no SQLite são
+as do próprio banco; no CSV cada arquivo é trocado de forma atômica
+(temporário + rename), um journal de desfazer (CsvJournal) permite voltar
+atrás em operações que alteram várias tabelas e GroupCommit faz o fsync das
+transações confirmadas em lotes. Com vários processos (workers do gunicorn)
+sobre o mesmo data_dir, FileLock serializa as transações do backend CSV
+entre eles; o SQLite já faz isso com BEGIN IMMEDIATE.
+
+Tabelas que só crescem (transações, movimentações) podem ser particionadas
+por mês no backend CSV (ver CsvStorage.partition_tables): cada mês em um
+arquivo 'tabela@AAAA-MM.csv' e a lista de partições em 'tabela@manifest.json'.
+"""
+import ctypes
+import ctypes.util
+import io
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:  # fcntl só existe em sistemas POSIX: sem ele não há lock entre processos
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _file_signature(path):
+    """(mtime_ns, tamanho, inode) do arquivo, ou None se ele não existir"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+JOURNAL_DIR = '.journal'
+LOCK_FILE = '.lock'
+READ_ATTEMPTS = 3  # Releituras de um CSV que mudou durante a leitura antes de travar
+_COMMITTED = '.committed'  # Marca, no journal, uma transação confirmada à espera do fsync
+_TMP_SUFFIX = '.tmp'
+PARTITION_SEP = '@'  # tabela@AAAA-MM.csv, tabela@manifest.json
+UNDATED = 'undated'  # Partição das linhas sem data válida
+_txids = itertools.count()
+_boot_time = None
+
+
+def _tmp_path(path):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}{_TMP_SUFFIX}'
+
+
+def _write_atomic(path, write):
+    """Chama write(temporário) e renomeia o temporário por cima do original:
+    quem lê (ou um crash no meio) vê o arquivo antigo inteiro ou o novo inteiro"""
+    tmp_path = _tmp_path(path)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_csv_atomic(df, path):
+    _write_atomic(path, lambda tmp_path: df.to_csv(tmp_path, index=False))
+
+
+def partition_file(table, key):
+    """Arquivo da partição `key` ('AAAA-MM' ou UNDATED) da tabela"""
+    return f'{table.removesuffix(".csv")}{PARTITION_SEP}{key}.csv'
+
+
+def manifest_file(table):
+    return f'{table.removesuffix(".csv")}{PARTITION_SEP}manifest.json'
+
+
+def partitioned_table(filename):
+    """Tabela a que pertence um arquivo de partição ou manifesto (None se não for um)"""
+    if PARTITION_SEP not in filename:
+        return None
+    return filename.split(PARTITION_SEP, 1)[0] + '.csv'
+
+
+def partition_keys(values):
+    """Partição ('AAAA-MM' ou UNDATED) de cada valor de uma coluna de datas"""
+    if values.dtype.kind != 'M':
+        values = pd.to_datetime(values, format='ISO8601', errors='coerce')
+    return values.dt.strftime('%Y-%m').fillna(UNDATED)
+
+
+def _partition_order(key):
+    # Linhas sem data primeiro, depois os meses em ordem
+    return key != UNDATED, key
+
+
+class _PartitionReader(io.RawIOBase):
+    """Os arquivos das partições lidos em sequência como um único CSV: o
+    cabeçalho vem do manifesto e o de cada arquivo é pulado. O read_csv vê o
+    mesmo texto que veria no arquivo da tabela inteira, então infere os
+    mesmos tipos."""
+
+    def __init__(self, columns, paths):
+        super().__init__()
+        self._pending = pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8')
+        self._paths = list(paths)
+        self._file = None
+        self._last = b'\n'
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self, size):
+        while True:
+            if self._pending:
+                chunk, self._pending = self._pending[:size], self._pending[size:]
+                return chunk
+            if self._file is None:
+                if not self._paths:
+                    return b''
+                try:
+                    self._file = open(self._paths.pop(0), 'rb')
+                except FileNotFoundError:
+                    continue  # Removida depois da leitura do manifesto: a assinatura acusa
+                self._file.readline()
+                self._last = b'\n'
+                continue
+            chunk = self._file.read(size)
+            if chunk:
+                self._last = chunk[-1:]
+                return chunk
+            self._file.close()
+            self._file = None
+            if self._last != b'\n':
+                # Arquivo editado à mão pode terminar sem quebra de linha
+                self._pending = b'\n'
+
+    def readinto(self, buffer):
+        chunk = self._next_chunk(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _system_boot_time():
+    """Instante do boot (segundos desde a época), de /proc/stat; 0 se indisponível"""
+    global _boot_time
+    if _boot_time is None:
+        _boot_time = 0
+        try:
+            with open('/proc/stat') as f:
+                for line in f:
+                    if line.startswith('btime '):
+                        _boot_time = int(line.split()[1])
+                        break
+        except (OSError, ValueError):
+            pass
+    return _boot_time
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _to_db_value(value):
+    """Converte valores do pandas/numpy para tipos aceitos pelo sqlite3.
+
+    Texto vazio vira NULL, como acontece no round-trip pelo CSV.
+    """
+    if value is None or value is pd.NaT or (isinstance(value, str) and value == ''):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+class CsvJournal:
+    """Journal de desfazer de uma transação no backend CSV.
+
+    Antes da primeira alteração de cada tabela na transação, guarda em
+    data_dir/.journal/<id>/ o necessário para voltar ao estado anterior: um
+    hard link para o arquivo (reescritas trocam o arquivo por rename, então o
+    link preserva o original), um arquivo vazio 'tabela.size-N' com o tamanho
+    anterior (linhas anexadas) ou 'tabela.absent' se a tabela não existia.
+    Como são só operações de diretório, sistemas de arquivos com journal
+    (ext4, xfs) as persistem antes das alterações que vêm depois delas, sem
+    fsync próprio. Enquanto o diretório existir a transação não está
+    confirmada: undo() a desfaz e apagar o diretório a confirma. A marca
+    '.committed' indica que ela foi confirmada e só falta o fsync (ver
+    CsvStorage.recover).
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        txid = f'{time.time_ns():020d}-{os.getpid()}-{next(_txids)}'
+        self.directory = os.path.join(data_dir, JOURNAL_DIR, txid)
+        os.makedirs(self.directory)
+        self.tables = set()
+        self._backups = set()
+
+    def before_rewrite(self, table):
+        """Chamado antes de substituir o arquivo da tabela"""
+        if table in self._backups:
+            return
+        path = os.path.join(self.data_dir, table)
+        if os.path.exists(path):
+            try:
+                os.link(path, os.path.join(self.directory, table))
+            except OSError:  # sistema de arquivos sem hard links
+                shutil.copy2(path, os.path.join(self.directory, table))
+        elif table not in self.tables:
+            open(os.path.join(self.directory, table + '.absent'), 'w').close()
+        self.tables.add(table)
+        self._backups.add(table)
+
+    def before_append(self, table, size):
+        """Chamado antes de anexar linhas a um arquivo com `size` bytes"""
+        if table not in self.tables:
+            open(os.path.join(self.directory, f'{table}.size-{size}'), 'w').close()
+            self.tables.add(table)
+
+    def mark_committed(self):
+        open(os.path.join(self.directory, _COMMITTED), 'w').close()
+
+    @staticmethod
+    def finish(directory, data_dir):
+        """Conclui uma transação confirmada cujo processo morreu antes do fsync:
+        os dados já estão no cache de páginas do kernel, falta só o disco"""
+        tables = set()
+        for name in os.listdir(directory):
+            if not name.startswith('.'):
+                tables.add(name.rsplit('.size-', 1)[0] if '.size-' in name else name.removesuffix('.absent'))
+        for table in tables:
+            if os.path.exists(os.path.join(data_dir, table)):
+                _fsync_path(os.path.join(data_dir, table))
+        _fsync_path(data_dir)
+        shutil.rmtree(directory)
+
+    @staticmethod
+    def undo(directory, data_dir):
+        """Restaura as tabelas registradas no diretório e o remove; retorna as tabelas"""
+        names = [name for name in os.listdir(directory) if not name.startswith('.')]
+        tables = set()
+        for name in names:
+            if name.endswith('.absent'):
+                table = name[:-len('.absent')]
+                if os.path.exists(os.path.join(data_dir, table)):
+                    os.remove(os.path.join(data_dir, table))
+            elif '.size-' not in name:
+                table = name
+                os.replace(os.path.join(directory, name), os.path.join(data_dir, table))
+            else:
+                continue
+            tables.add(table)
+        # Tamanhos por último: uma tabela anexada e depois reescrita volta
+        # primeiro ao arquivo original e então perde as linhas anexadas
+        for name in names:
+            if '.size-' in name:
+                table, size = name.rsplit('.size-', 1)
+                path = os.path.join(data_dir, table)
+                if os.path.exists(path) and os.path.getsize(path) > int(size):
+                    os.truncate(path, int(size))
+                tables.add(table)
+        shutil.rmtree(directory)
+        return tables
+
+
+class GroupCommit:
+    """Faz o fsync das transações confirmadas em lotes, em uma thread própria.
+
+    Quem confirma entrega os descritores dos arquivos alterados e espera.
+    Enquanto um lote está indo para o disco as confirmações seguintes se
+    acumulam e vão todas no próximo fsync, em vez de um fsync por escrita. Só
+    depois do fsync os journals do lote são apagados.
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._cond = threading.Condition()
+        self._queue = []
+        self._thread = None
+        self._pid = os.getpid()
+
+    def submit(self, fds, journal_dir):
+        entry = {'fds': fds, 'journal': journal_dir, 'done': threading.Event(), 'error': None}
+        if self._pid != os.getpid():
+            # Processo criado por fork (worker do gunicorn com --preload): a
+            # thread e a fila pertencem ao processo pai
+            self._cond, self._queue, self._thread, self._pid = threading.Condition(), [], None, os.getpid()
+        with self._cond:
+            self._queue.append(entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mcpark-group-commit', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    @staticmethod
+    def wait(entry):
+        entry['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch, self._queue = self._queue, []
+            error = None
+            try:
+                synced = set()
+                for entry in batch:
+                    for fd in entry['fds']:
+                        st = os.fstat(fd)
+                        if (st.st_dev, st.st_ino) not in synced:
+                            os.fsync(fd)
+                            synced.add((st.st_dev, st.st_ino))
+                _fsync_path(self.data_dir)
+                for entry in batch:
+                    shutil.rmtree(entry['journal'])
+                _fsync_path(os.path.join(self.data_dir, JOURNAL_DIR))
+            except OSError as e:
+                # Os journals que sobraram são desfeitos na próxima inicialização
+                error = e
+            for entry in batch:
+                for fd in entry['fds']:
+                    os.close(fd)
+                entry['error'] = error
+                entry['done'].set()
+
+
+class FileLock:
+    """Lock entre processos com fcntl.flock sobre um arquivo.
+
+    O lock exclusivo é de uma thread por vez (quem chama serializa as
+    escritas do próprio processo); o compartilhado pode ser tomado por várias
+    threads e processos ao mesmo tempo. Cada aquisição abre o arquivo de novo,
+    para que processos criados por fork não herdem o lock do pai.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _open(self):
+        return os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+
+    def held(self):
+        """True se alguma thread deste processo tem o lock exclusivo"""
+        return self._fd is not None and self._pid == os.getpid()
+
+    def acquire(self):
+        if self._fd is not None and self._pid != os.getpid():
+            # Descritor herdado do pai: fechar a cópia não solta o lock dele
+            os.close(self._fd)
+            self._fd = None
+        fd = self._open()
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd, self._pid = fd, os.getpid()
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)  # Fechar o descritor solta o flock
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def shared(self):
+        fd = self._open()
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+
+class CsvStorage:
+    """Armazena cada tabela em um arquivo CSV dentro de data_dir.
+
+    Com durable=True cada transação só termina depois do fsync dos arquivos
+    alterados (em grupo, ver GroupCommit); com False as trocas continuam
+    atômicas, mas sem esperar o disco. Cada transação segura o lock exclusivo
+    de data_dir/.lock do begin() ao commit()/rollback(), então processos
+    diferentes escrevem um de cada vez; leituras não travam (ver read).
+
+    Nas tabelas particionadas (ver partition_tables) read, write, header e
+    max_id tratam as partições como um arquivo só; inserções anexam à
+    partição do mês de cada linha e update/delete reescrevem só a partição
+    da linha.
+    """
+
+    name = 'csv'
+
+    def __init__(self, data_dir, durable=True):
+        self.data_dir = data_dir
+        self.durable = durable
+        self._local = threading.local()
+        self._committer = GroupCommit(data_dir) if durable else None
+        self.lock = FileLock(os.path.join(data_dir, LOCK_FILE))
+        self.partitioned = {}  # Tabela particionada por mês -> coluna de data
+        self._manifests = {}  # Tabela -> (assinatura, conteúdo) do último manifesto lido
+
+    def path(self, table):
+        return os.path.join(self.data_dir, table)
+
+    def _tables(self, names):
+        """Tabelas guardadas nos arquivos informados (partições -> a tabela)"""
+        return {table for name in names for table in self.tables_for_file(name)}
+
+    def _journal(self):
+        return getattr(self._local, 'journal', None)
+
+    def begin(self):
+        """Abre a transação com o lock exclusivo; retorna as tabelas restauradas
+        de transações que um processo que morreu deixou pela metade"""
+        self.lock.acquire()
+        try:
+            restored = self._resolve_journals(startup=False)
+            self._local.journal = CsvJournal(self.data_dir)
+        except BaseException:
+            self.lock.release()
+            raise
+        return sorted(self._tables(restored))
+
+    def commit(self):
+        """Confirma a transação; retorna o que wait_durable deve esperar"""
+        journal, self._local.journal = self._journal(), None
+        try:
+            if not self.durable:
+                shutil.rmtree(journal.directory)
+                return None
+            journal.mark_committed()
+            # Descritores abertos agora: o fsync vale para estes arquivos mesmo
+            # que uma transação seguinte já os tenha trocado por rename
+            fds = [os.open(self.path(table), os.O_RDONLY) for table in journal.tables
+                   if os.path.exists(self.path(table))]
+        finally:
+            self.lock.release()
+        return self._committer.submit(fds, journal.directory)
+
+    def wait_durable(self, ticket):
+        if ticket is not None:
+            GroupCommit.wait(ticket)
+
+    def rollback(self):
+        """Desfaz a transação; retorna as tabelas restauradas"""
+        journal, self._local.journal = self._journal(), None
+        try:
+            return self._tables(CsvJournal.undo(journal.directory, self.data_dir))
+        finally:
+            self.lock.release()
+
+    def _resolve_journals(self, startup):
+        """Trata os journals de processos que já morreram, do mais novo para o
+        mais antigo: transações confirmadas neste boot só perderam o fsync e
+        são concluídas; as demais são desfeitas. Na inicialização os journals
+        com o pid do próprio processo são de uma execução anterior."""
+        root = os.path.join(self.data_dir, JOURNAL_DIR)
+        if not os.path.isdir(root):
+            return set()
+        restored = set()
+        for txid in sorted(os.listdir(root), reverse=True):
+            started, pid = (int(part) for part in txid.split('-')[:2])
+            directory = os.path.join(root, txid)
+            this_boot = started // 10 ** 9 >= _system_boot_time()
+            if this_boot and (_pid_alive(pid) or (pid == os.getpid() and not startup)):
+                continue
+            if this_boot and os.path.exists(os.path.join(directory, _COMMITTED)):
+                CsvJournal.finish(directory, self.data_dir)
+            else:
+                restored |= CsvJournal.undo(directory, self.data_dir)
+        return restored
+
+    def recover(self):
+        """Resolve transações interrompidas (ver _resolve_journals) e remove
+        temporários que sobraram de escritas atômicas"""
+        if not os.path.isdir(self.data_dir):
+            return []
+        with self.lock.exclusive():
+            restored = self._resolve_journals(startup=True)
+            for name in os.listdir(self.data_dir):
+                if name.endswith(_TMP_SUFFIX) and ('.csv.' in name or '.json.' in name):
+                    if not _pid_alive(int(name[:-len(_TMP_SUFFIX)].split('.')[-2])):
+                        os.remove(os.path.join(self.data_dir, name))
+        return sorted(self._tables(restored))
+
+    def partition_tables(self, columns):
+        """Particiona por mês as tabelas de `columns` (tabela -> coluna de
+        data). As que ainda estão em um arquivo só são convertidas agora, em
+        uma transação: um crash no meio volta ao arquivo original."""
+        self.partitioned.update(columns)
+        for table in columns:
+            if not os.path.exists(self.path(table)):
+                continue
+            self.begin()
+            try:
+                self.write(table, self._read_text(table))
+            except BaseException:
+                self.rollback()
+                raise
+            self.wait_durable(self.commit())
+
+    def _manifest_entry(self, table):
+        """(assinatura, conteúdo) do manifesto; (None, None) se a tabela não for
+        particionada ou ainda não tiver um"""
+        if table not in self.partitioned:
+            return None, None
+        path = self.path(manifest_file(table))
+        signature = _file_signature(path)
+        if signature is None:
+            return None, None
+        entry = self._manifests.get(table)
+        if entry is None or entry[0] != signature:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    entry = (signature, json.load(f))
+            except FileNotFoundError:
+                return None, None
+            self._manifests[table] = entry
+        return entry
+
+    def partitions(self, table):
+        """[(mês 'AAAA-MM' ou UNDATED, arquivo)] da tabela, na ordem em que read
+        as junta; None se ela não for particionada"""
+        manifest = self._manifest_entry(table)[1]
+        if manifest is None:
+            return None
+        return [(key, partition_file(table, key)) for key in manifest['partitions']]
+
+    def _write_manifest(self, table, columns, keys):
+        name = manifest_file(table)
+        journal = self._journal()
+        if journal is not None:
+            journal.before_rewrite(name)
+        manifest = {'column': self.partitioned[table], 'columns': list(columns),
+                    'partitions': sorted(keys, key=_partition_order)}
+
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=1)
+        _write_atomic(self.path(name), write)
+
+    def _remove(self, name):
+        path = self.path(name)
+        if os.path.exists(path):
+            journal = self._journal()
+            if journal is not None:
+                journal.before_rewrite(name)
+            os.remove(path)
+
+    def _write_partitions(self, table, df):
+        """Grava a tabela inteira nas partições por mês e o manifesto; remove
+        as partições que ficaram sem linhas e o arquivo único, se ainda existir"""
+        column = self.partitioned[table]
+        keys = partition_keys(df[column]) if column in df.columns else pd.Series(UNDATED, index=df.index)
+        old = {name for _, name in self.partitions(table) or []}
+        written = set()
+        for key, rows in df.groupby(keys.to_numpy(), sort=False):
+            self.write(partition_file(table, key), rows)
+            written.add(key)
+        for name in old - {partition_file(table, key) for key in written}:
+            self._remove(name)
+        self._write_manifest(table, df.columns, written)
+        self._remove(table)
+
+    def _insert_partitioned(self, table, records):
+        """Anexa cada linha à partição do seu mês. Retorna True se todas
+        foram para a última partição (o fim da tabela), False se não, e None
+        se a tabela ainda não existir ou as linhas trouxerem colunas novas"""
+        manifest = self._manifest_entry(table)[1]
+        if manifest is None:
+            return None
+        columns = manifest['columns']
+        if any(key not in columns for record in records for key in record):
+            return None
+        keys = partition_keys(pd.Series([record.get(manifest['column']) for record in records], dtype=object))
+        groups = {}
+        for key, record in zip(keys, records):
+            groups.setdefault(key, []).append(record)
+        existing = set(manifest['partitions'])
+        for key, rows in groups.items():
+            name = partition_file(table, key)
+            if key not in existing or not self.append(name, rows):
+                self.write(name, pd.DataFrame(rows, columns=columns))
+        if not set(groups) <= existing:
+            existing |= set(groups)
+            self._write_manifest(table, columns, existing)
+        return set(groups) == {max(existing, key=_partition_order)}
+
+    def _partition_with_id(self, table, record_id):
+        """Arquivo da partição com a linha (só a coluna id de cada uma é lida,
+        das mais recentes para as mais antigas); None se nenhuma tiver"""
+        for _, name in reversed(self.partitions(table)):
+            try:
+                ids = pd.read_csv(self.path(name), usecols=['id'])['id']
+            except (FileNotFoundError, pd.errors.EmptyDataError, ValueError):
+                continue
+            if self._id_mask(ids.to_frame(), record_id).any():
+                return name
+        return None
+
+    def _open(self, table):
+        """Arquivo da tabela para o read_csv (as partições juntas, se houver)"""
+        manifest = self._manifest_entry(table)[1]
+        if manifest is None:
+            return open(self.path(table), 'rb')
+        paths = [self.path(partition_file(table, key)) for key in manifest['partitions']]
+        return io.BufferedReader(_PartitionReader(manifest['columns'], paths), 1024 * 1024)
+
+    def _read_file(self, table, dtype=None):
+        try:
+            with self._open(table) as f:
+                return pd.read_csv(f, dtype=dtype)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    def _read_text(self, table):
+        """Tabela com todos os valores como o texto do arquivo (vazios = ''),
+        para reescritas que não alteram as demais células (ex.: '0123' não
+        vira 123 nem 9834 vira 9834.0)"""
+        try:
+            with self._open(table) as f:
+                return pd.read_csv(f, dtype=str, keep_default_na=False)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    def read(self, table, dtype=None):
+        """Lê a tabela inteira; FileNotFoundError se ela não existir. dtype
+        vai para o read_csv (ex.: {'phone': str}).
+
+        Reescritas trocam o arquivo por rename e nunca aparecem pela metade,
+        mas linhas anexadas por outro processo durante a leitura sim: se a
+        assinatura mudou, lê de novo e, depois de READ_ATTEMPTS tentativas,
+        com o lock compartilhado (que espera a transação em andamento).
+        """
+        for _ in range(READ_ATTEMPTS):
+            before = self.signature(table)
+            df = self._read_file(table, dtype)
+            if self.signature(table) == before:
+                return df
+        if self.lock.held():
+            # Quem escreve é uma thread deste processo, que pode estar
+            # esperando o lock de carga da tabela que o leitor segura
+            return df
+        with self.lock.shared():
+            return self._read_file(table, dtype)
+
+    def write(self, table, df):
+        if table in self.partitioned:
+            self._write_partitions(table, df)
+            return
+        journal = self._journal()
+        if journal is not None:
+            journal.before_rewrite(table)
+        write_csv_atomic(df, self.path(table))
+
+    def header(self, table):
+        """Colunas do cabeçalho do arquivo (None se ele não existir ou estiver vazio)"""
+        manifest = self._manifest_entry(table)[1]
+        if manifest is not None:
+            return list(manifest['columns']) or None
+        try:
+            return list(pd.read_csv(self.path(table), nrows=0).columns)
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            return None
+
+    def append(self, table, records):
+        """Acrescenta as linhas ao fim do arquivo, na ordem do cabeçalho.
+
+        Retorna False, sem gravar nada, se o arquivo não tiver cabeçalho ou se
+        alguma linha trouxer uma coluna que não está nele.
+        """
+        columns = self.header(table)
+        if not columns or any(key not in columns for record in records for key in record):
+            return False
+        text = pd.DataFrame(records, columns=columns).to_csv(index=False, header=False)
+        with open(self.path(table), 'a+b') as f:
+            size = f.seek(0, os.SEEK_END)
+            journal = self._journal()
+            if journal is not None:
+                journal.before_append(table, size)
+            # Arquivo editado à mão pode terminar sem quebra de linha
+            if size:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            f.write(text.encode('utf-8'))
+        return True
+
+    def insert(self, table, record):
+        return self.insert_many(table, [record])
+
+    def insert_many(self, table, records):
+        """Insere as linhas; retorna True se elas foram anexadas ao fim do
+        arquivo e False se a tabela foi reescrita (colunas novas)"""
+        if table in self.partitioned:
+            appended = self._insert_partitioned(table, records)
+            if appended is not None:
+                return appended
+        elif self.append(table, records):
+            return True
+        try:
+            df = self._read_text(table)
+        except FileNotFoundError:
+            df = pd.DataFrame()
+        new_rows = pd.DataFrame(records)
+        df = pd.concat([df, new_rows], ignore_index=True) if not df.empty else new_rows
+        self.write(table, df)
+        return False
+
+    def _id_mask(self, df, record_id):
+        return pd.to_numeric(df['id'], errors='coerce') == int(record_id)
+
+    def _file_with_id(self, table, record_id, columns=()):
+        """Arquivo a reescrever para alterar a linha: a partição dela, ou a
+        tabela inteira se não for particionada ou se ganhar colunas novas"""
+        header = self.header(table) if self.partitions(table) is not None else None
+        if header is None or any(col not in header for col in columns):
+            return table
+        return self._partition_with_id(table, record_id)
+
+    def update(self, table, record_id, values):
+        """Atualiza as colunas informadas da linha com o id dado"""
+        name = self._file_with_id(table, record_id, values)
+        if name is None:
+            return False
+        df = self._read_text(name)
+        mask = self._id_mask(df, record_id)
+        if not mask.any():
+            return False
+        for col, value in values.items():
+            if col not in df.columns:
+                df[col] = ''
+            df.loc[mask, col] = value
+        if name == table:
+            self.write(table, df)
+            return True
+        # Linha cuja data mudou de mês vai para a partição do novo mês
+        key = name.rsplit(PARTITION_SEP, 1)[1].removesuffix('.csv')
+        moved = (partition_keys(df[self.partitioned[table]]) != key).to_numpy()
+        self.write(name, df[~moved])
+        if moved.any():
+            self._insert_partitioned(table, df[moved].to_dict('records'))
+        return True
+
+    def delete(self, table, record_id):
+        name = self._file_with_id(table, record_id)
+        if name is None:
+            return False
+        df = self._read_text(name)
+        mask = self._id_mask(df, record_id)
+        if not mask.any():
+            return False
+        self.write(name, df[~mask])
+        return True
+
+    def max_id(self, table):
+        """Maior id da tabela (0 se vazia ou inexistente)"""
+        try:
+            with self._open(table) as f:
+                ids = pd.read_csv(f, usecols=['id'])['id']
+        except (FileNotFoundError, pd.errors.EmptyDataError, ValueError):
+            return 0
+        return int(ids.max()) if not ids.empty and pd.notna(ids.max()) else 0
+
+    def signature(self, table):
+        """Muda sempre que o arquivo da tabela é alterado ou substituído (nas
+        particionadas, o manifesto ou qualquer partição)"""
+        signature, manifest = self._manifest_entry(table)
+        if manifest is None:
+            return _file_signature(self.path(table))
+        return signature, tuple(_file_signature(self.path(partition_file(table, key)))
+                                for key in manifest['partitions'])
+
+    def tables_for_file(self, filename):
+        """Tabelas afetadas por uma mudança no arquivo (None = todas); uma
+        partição afeta a tabela e a si mesma (lida sozinha por read_period)"""
+        table = partitioned_table(filename)
+        if table is not None and filename.endswith('.json'):
+            return [table]
+        if table is not None and filename.endswith('.csv'):
+            return [table, filename]
+        return [filename] if filename.endswith('.csv') else []
+
+
+class SqliteStorage:
+    """Armazena as tabelas em um banco SQLite (WAL) com operações por linha.
+
+    Na primeira vez que uma tabela é acessada ela é importada do CSV
+    correspondente em data_dir, se existir (inclusive de partições, ver
+    partition_tables). No banco as tabelas não são particionadas.
+
+    Cada tabela tem uma versão em VERSION_TABLE, incrementada na mesma
+    transação de cada escrita nela: é a assinatura usada pelo cache, então
+    escrever em uma tabela não invalida as outras.
+    """
+
+    name = 'sqlite'
+    VERSION_TABLE = '_versions'
+
+    def __init__(self, db_path, data_dir):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._known_tables = set()
+        self._pid = os.getpid()
+        self.partitioned = {}
+
+    def _conn(self):
+        if self._pid != os.getpid():
+            # Conexões abertas antes de um fork não podem ser usadas no filho
+            self._local, self._schema_lock, self._pid = threading.local(), threading.Lock(), os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.VERSION_TABLE}" '
+                         '(name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE/COMMIT, ou só a conexão se já houver uma transação
+        aberta por begin() (ela é confirmada ou desfeita como um todo)"""
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def begin(self):
+        """BEGIN IMMEDIATE: trava as escritas dos outros processos até o fim"""
+        self._conn().execute('BEGIN IMMEDIATE')
+        return []
+
+    def commit(self):
+        self._conn().execute('COMMIT')
+
+    def wait_durable(self, ticket):
+        pass  # O WAL do SQLite cuida da durabilidade
+
+    def rollback(self):
+        self._conn().execute('ROLLBACK')
+        # Tabelas importadas dentro da transação deixaram de existir
+        self._known_tables.clear()
+        return None
+
+    def recover(self):
+        return []  # O SQLite recupera o WAL sozinho ao abrir o banco
+
+    def partition_tables(self, columns):
+        """Só para importar essas tabelas do CSV já particionado"""
+        self.partitioned.update(columns)
+
+    def partitions(self, table):
+        return None  # Tabela inteira no banco: o filtro por data é do chamador
+
+    @staticmethod
+    def _table_name(table):
+        name = table[:-4] if table.endswith('.csv') else table
+        if not name.replace('_', '').isalnum():
+            raise ValueError(f'Nome de tabela inválido: {table}')
+        return name
+
+    @staticmethod
+    def _column_type(dtype):
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(dtype):
+            return 'REAL'
+        return 'TEXT'
+
+    def _bump_version(self, conn, table):
+        """Nova versão da tabela, dentro da transação da escrita"""
+        conn.execute(f'INSERT INTO "{self.VERSION_TABLE}" (name, version) VALUES (?, 1) '
+                     'ON CONFLICT(name) DO UPDATE SET version = version + 1', (table,))
+
+    def _columns(self, conn, name):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info("{name}")')]
+
+    def _create_table(self, conn, name, df):
+        has_pk = 'id' in df.columns and df['id'].notna().all() and df['id'].is_unique
+        cols = []
+        for col in df.columns:
+            if col == 'id' and has_pk:
+                cols.append('"id" INTEGER PRIMARY KEY')
+            else:
+                cols.append(f'"{col}" {self._column_type(df[col].dtype)}')
+        conn.execute(f'CREATE TABLE "{name}" ({", ".join(cols)})')
+        # Índices para as buscas por chave estrangeira (customer_id, plan_id...)
+        for col in df.columns:
+            if col.endswith('_id') or (col == 'id' and not has_pk):
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{name}_{col}" ON "{name}" ("{col}")')
+
+    def _insert_frame(self, conn, name, df):
+        if df.empty:
+            return
+        cols = ', '.join(f'"{c}"' for c in df.columns)
+        marks = ', '.join('?' for _ in df.columns)
+        rows = [[_to_db_value(v) for v in row] for row in df.astype(object).itertuples(index=False)]
+        conn.executemany(f'INSERT INTO "{name}" ({cols}) VALUES ({marks})', rows)
+
+    def _ensure_table(self, table, sample=None):
+        """Garante que a tabela exista, importando o CSV na primeira vez"""
+        name = self._table_name(table)
+        if name in self._known_tables:
+            return name
+        with self._schema_lock:
+            conn = self._conn()
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+            ).fetchone()
+            if not exists:
+                source = CsvStorage(self.data_dir)
+                source.partitioned = self.partitioned
+                try:
+                    df = source.read(table)
+                except FileNotFoundError:
+                    if sample is None:
+                        raise
+                    df = sample.iloc[0:0]
+                with self._transaction():
+                    self._create_table(conn, name, df)
+                    self._insert_frame(conn, name, df)
+            self._known_tables.add(name)
+        return name
+
+    def _ensure_columns(self, conn, name, columns):
+        """Cria as colunas que faltam; retorna True se criou alguma"""
+        existing = set(self._columns(conn, name))
+        added = [col for col in columns if col not in existing]
+        for col in added:
+            conn.execute(f'ALTER TABLE "{name}" ADD COLUMN "{col}"')
+        return bool(added)
+
+    def _appends_at_end(self, conn, name, df):
+        """True se as linhas de df vão para o fim da leitura (ORDER BY rowid):
+        sem id como chave primária o rowid só cresce; com ela, o rowid é o
+        próprio id e os ids novos precisam ser crescentes e maiores que os atuais"""
+        if not any(row[1] == 'id' and row[5] for row in conn.execute(f'PRAGMA table_info("{name}")')):
+            return True
+        ids = pd.to_numeric(df['id'], errors='coerce') if 'id' in df.columns else None
+        if ids is None or ids.isna().any() or not ids.is_monotonic_increasing or not ids.is_unique:
+            return False
+        current = conn.execute(f'SELECT MAX(rowid) FROM "{name}"').fetchone()[0]
+        return current is None or ids.iloc[0] > current
+
+    def read(self, table, dtype=None):
+        """Lê a tabela inteira; as colunas TEXT já vêm como texto (dtype é do
+        backend CSV e fica sem uso aqui)"""
+        name = self._ensure_table(table)
+        df = pd.read_sql_query(f'SELECT * FROM "{name}" ORDER BY rowid', self._conn())
+        # NULL vira NaN, como na leitura do CSV
+        return df.fillna(np.nan)
+
+    def write(self, table, df):
+        """Substitui todo o conteúdo da tabela (usado apenas em cargas em lote)"""
+        name = self._ensure_table(table, sample=df)
+        with self._transaction() as conn:
+            self._ensure_columns(conn, name, df.columns)
+            conn.execute(f'DELETE FROM "{name}"')
+            self._insert_frame(conn, name, df)
+            self._bump_version(conn, table)
+
+    def insert(self, table, record):
+        return self.insert_many(table, [record])
+
+    def insert_many(self, table, records):
+        """Insere as linhas em uma transação; retorna True se elas ficam no
+        fim da tabela, como o append do CSV (o cache só acrescenta as linhas),
+        e False se a leitura as poria no meio ou se a tabela ganhou colunas"""
+        if not records:
+            return False
+        df = pd.DataFrame(records)
+        name = self._ensure_table(table, sample=df)
+        with self._transaction() as conn:
+            added = self._ensure_columns(conn, name, df.columns)
+            appended = not added and self._appends_at_end(conn, name, df)
+            self._insert_frame(conn, name, df)
+            self._bump_version(conn, table)
+        return appended
+
+    def update(self, table, record_id, values):
+        name = self._ensure_table(table)
+        with self._transaction() as conn:
+            self._ensure_columns(conn, name, values.keys())
+            assignments = ', '.join(f'"{col}" = ?' for col in values)
+            params = [_to_db_value(v) for v in values.values()] + [int(record_id)]
+            cursor = conn.execute(f'UPDATE "{name}" SET {assignments} WHERE id = ?', params)
+            if cursor.rowcount > 0:
+                self._bump_version(conn, table)
+        return cursor.rowcount > 0
+
+    def delete(self, table, record_id):
+        name = self._ensure_table(table)
+        with self._transaction() as conn:
+            cursor = conn.execute(f'DELETE FROM "{name}" WHERE id = ?', (int(record_id),))
+            if cursor.rowcount > 0:
+                self._bump_version(conn, table)
+        return cursor.rowcount > 0
+
+    def max_id(self, table):
+        try:
+            name = self._ensure_table(table)
+        except FileNotFoundError:
+            return 0
+        row = self._conn().execute(f'SELECT MAX(id) FROM "{name}"').fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    def signature(self, table):
+        """Inode do banco e versão da tabela (ver VERSION_TABLE). Tabelas
+        nunca escritas têm versão 0, inclusive antes e depois da importação do
+        CSV, que não muda o conteúdo. Dentro de uma transação inclui as
+        escritas dela."""
+        conn = self._conn()
+        row = conn.execute(f'SELECT version FROM "{self.VERSION_TABLE}" WHERE name = ?', (table,)).fetchone()
+        return (os.stat(self.db_path).st_ino, row[0] if row is not None else 0)
+
+    def tables_for_file(self, filename):
+        """Todas as tabelas com versão para mudanças no banco ou no WAL: o
+        cache só invalida aquelas cuja versão mudou"""
+        base = os.path.basename(self.db_path)
+        if filename not in (base, base + '-wal'):
+            return []
+        return [row[0] for row in self._conn().execute(f'SELECT name FROM "{self.VERSION_TABLE}"')]
+
+
+class InotifyWatcher:
+    """Observa um diretório com inotify (somente Linux) em uma thread daemon.
+
+    callback(nome_do_arquivo) é chamado a cada criação, alteração, remoção ou
+    renomeação; callback(None) quando o kernel descarta eventos (overflow).
+    """
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory, callback):
+        self.directory = directory
+        self.callback = callback
+        self._fd = None
+        self._thread = None
+
+    def start(self):
+        """Inicia a observação; retorna False se inotify não estiver disponível"""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), self.WATCH_MASK) < 0:
+            os.close(fd)
+            return False
+        self._fd = fd
+        self._thread = threading.Thread(target=self._run, name='mcpark-inotify', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Fecha o inotify; a thread, se existir, termina na próxima leitura"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                self.callback(None if mask & self.IN_Q_OVERFLOW else name)
+
+
+class SnapshotCache:
+    """Snapshots binários das tabelas já carregadas, em um diretório próprio.
+
+    Cada snapshot guarda a assinatura do arquivo de origem no momento da
+    leitura e só é usado enquanto ela não mudar. O formato é Feather (Arrow
+    IPC, colunar e lido com memory map); tabelas com colunas que o Arrow não
+    representa ficam sem snapshot e são lidas do CSV.
+
+    O pyarrow só é importado aqui: sem snapshots os backends não dependem dele.
+    """
+
+    SIGNATURE_KEY = b'mcpark_signature'
+
+    def __init__(self, directory):
+        try:
+            import pyarrow
+            import pyarrow.feather
+        except ImportError:
+            raise RuntimeError('Os snapshots das tabelas precisam do pyarrow: instale-o '
+                               '(pip install pyarrow) ou desative-os com MCPARK_SNAPSHOTS=0') from None
+        self._pa, self._feather = pyarrow, pyarrow.feather
+        self.directory = directory
+
+    def _path(self, table):
+        return os.path.join(self.directory, f'{table}.feather')
+
+    def load(self, table, signature):
+        """DataFrame do snapshot, ou None se não houver um com essa assinatura"""
+        if signature is None:
+            return None
+        try:
+            arrow_table = self._feather.read_table(self._path(table), memory_map=True)
+        except (OSError, self._pa.ArrowException):
+            return None
+        metadata = arrow_table.schema.metadata or {}
+        if metadata.get(self.SIGNATURE_KEY, b'').decode() != json.dumps(signature):
+            return None
+        df = arrow_table.to_pandas()
+        # O Arrow devolve None nos textos ausentes; o read_csv devolve NaN
+        text = df.columns[df.dtypes == object]
+        if len(text):
+            df[text] = df[text].where(df[text].notna(), np.nan)
+        return df
+
+    def save(self, table, signature, df):
+        """Grava o snapshot de forma atômica (arquivo temporário + rename)"""
+        if signature is None:
+            return
+        path = self._path(table)
+        try:
+            arrow_table = self._pa.Table.from_pandas(df)
+        except (self._pa.ArrowException, ValueError, TypeError):
+            # Colunas com tipos misturados: sem snapshot (o antigo não vale mais)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        metadata = dict(arrow_table.schema.metadata or {})
+        metadata[self.SIGNATURE_KEY] = json.dumps(signature).encode()
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._feather.write_feather(arrow_table.replace_schema_metadata(metadata), tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            # O snapshot é só uma otimização: sem espaço ou permissão, segue sem ele
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def create_storage(backend, data_dir, sqlite_path=None, durable=True):
+    """Instancia o backend configurado ('csv' ou 'sqlite')"""
+    if backend == 'sqlite':
+        return SqliteStorage(sqlite_path or os.path.join(data_dir, 'mcpark.db'), data_dir)
+    if backend == 'csv':
+        return CsvStorage(data_dir, durable=durable)
+    raise ValueError(f'Backend de armazenamento desconhecido: {backend}')